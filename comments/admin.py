@@ -1,14 +1,30 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.forms.models import BaseInlineFormSet
+from django.utils.html import format_html, format_html_join
 
+import archive
+import history
 import models
 
 
+class HistoryFormSet(BaseInlineFormSet):
+
+    def get_queryset(self):
+        # the compact rows get their texts back
+        if not hasattr(self, '_reconstructed'):
+            self._reconstructed = history.reconstruct(list(super(HistoryFormSet, self).get_queryset()))
+        return self._reconstructed
+
+
 class HistoryInline(admin.TabularInline):
     model = models.History
+    formset = HistoryFormSet
     extra = 0
+    fields = readonly_fields = ['event_date', 'user', 'old_comment', 'new_comment', 'old_is_removed',
+                                'new_is_removed']
 
     def has_add_permission(self, request):
         return False
@@ -16,10 +32,62 @@ class HistoryInline(admin.TabularInline):
     def has_delete_permission(self, request, obj=None):
         return False
 
-    def has_change_permission(self, request, obj=None):
-        return False
-
 
 @admin.register(models.Comment)
 class CommentAdmin(admin.ModelAdmin):
     inlines = [HistoryInline]
+
+
+@admin.register(models.ArchivedComment)
+class ArchivedCommentAdmin(admin.ModelAdmin):
+    list_display = ['id', '__unicode__', 'user', 'submit_date', 'is_removed', 'reason', 'archived_at']
+    list_filter = ['reason', 'is_removed']
+    search_fields = ['comment']
+    date_hierarchy = 'archived_at'
+    fields = readonly_fields = ['content_type', 'object_pk', 'user', 'changed_by', 'comment', 'submit_date',
+                                'is_removed', 'path', 'reason', 'archived_at', 'history']
+    actions = ['restore', 'recover']
+
+    def has_add_permission(self, request):
+        return False
+
+    def history(self, obj):
+        # the history of an archived comment stays in the history table
+        histories = history.reconstruct(list(models.History.objects.filter(comment_id=obj.id)))
+        return format_html_join('', '<p>{} {}: {} &rarr; {}, removed {} &rarr; {}</p>', (
+            (item.event_date, item.user or '', item.old_comment, item.new_comment, item.old_is_removed,
+             item.new_is_removed) for item in histories))
+
+    def restore(self, request, queryset):
+        count = archive.restore(queryset.values_list('id', flat=True))
+        self.message_user(request, '%s comments restored.' % count, messages.SUCCESS)
+    restore.short_description = 'Restore the threads of the selected comments'
+
+    def recover(self, request, queryset):
+        comments = [archive.recover(pk, request.user) for pk in queryset.filter(is_removed=True).values_list(
+            'id', flat=True)]
+        self.message_user(request, '%s comments recovered.' % len(comments), messages.SUCCESS)
+    recover.short_description = 'Recover the selected removed comments'
+
+
+@admin.register(models.Profile)
+class ProfileAdmin(admin.ModelAdmin):
+    list_display = ['date', 'method', 'path', 'status', 'duration', 'query_count', 'query_time', 'serializer_time',
+                    'user']
+    list_filter = ['view', 'status']
+    search_fields = ['path']
+    date_hierarchy = 'date'
+    fields = readonly_fields = ['date', 'method', 'path', 'view', 'status', 'user', 'duration', 'query_count',
+                                'query_time', 'serializer_time', 'statements', 'profile']
+
+    def has_add_permission(self, request):
+        return False
+
+    def statements(self, obj):
+        return format_html_join('', '<p>{} {}ms</p><pre>{}</pre>{}', (
+            (query['database'], '%.2f' % (query['time'] * 1000), query['sql'],
+             format_html('<pre>{}</pre>', query['explain']) if query.get('explain') else '')
+            for query in obj.queries))
+
+    def profile(self, obj):
+        return format_html('<pre>{}</pre>', obj.python_profile)
@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from celery import signals as celery_signals
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 from django.db.models.signals import post_migrate
 
-from signals import create_history_trigger
+from signals import create_counter_triggers, create_history_trigger
+import metrics
 
 
 class CommentsConfig(AppConfig):
@@ -12,3 +15,11 @@ class CommentsConfig(AppConfig):
 
     def ready(self):
         post_migrate.connect(create_history_trigger, self)
+        post_migrate.connect(create_counter_triggers, self)
+        # the queries of the requests and the tasks are counted by the cursors, see metrics.py
+        connection_created.connect(metrics.connection_created)
+        # the timings of the tasks, see metrics.py
+        celery_signals.before_task_publish.connect(metrics.task_published)
+        celery_signals.task_prerun.connect(metrics.task_started)
+        celery_signals.task_postrun.connect(metrics.task_finished)
+        celery_signals.worker_process_shutdown.connect(metrics.worker_stopping)
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+The archive of the cold comments. The removed comments, which nobody has changed for COMMENTS_ARCHIVE_REMOVED_AFTER
+days, and the threads of the entities, which nobody has commented or changed for COMMENTS_ARCHIVE_DORMANT_AFTER days,
+are moved from the comments table into the ArchivedComment one by a periodic task, in batches of
+COMMENTS_ARCHIVE_BATCH_SIZE. The comments table and its indexes keep the live comments only.
+
+A removed comment is archived once it has no replies left in the table, so a tree, which hides the replies of a removed
+comment, isn't changed by the archive. A dormant thread is moved as a whole. The comments keep their ids, their
+history stays in the history table. An archived thread is moved back as a whole: by `restore`, when a comment of it
+is recovered in the admin, replied to, or the entity is commented again. The counters and the trees see the moves as
+the deletes and the inserts of the comments. A thread moved either way makes the exports made before not reused, the
+history doesn't have the moves.
+
+The list of the comments and the child comment trees show the archived ones with the `include_archived` query param.
+"""
+from __future__ import unicode_literals
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.db.models import DateTimeField, IntegerField
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+from django.utils.encoding import force_text
+
+import models
+import progress
+import trees
+
+# the columns of the model, the search vector of the comments table isn't archived
+COLUMNS = ('id, content_type_id, object_pk, user_id, changed_by_id, comment, submit_date, is_removed, path, '
+           'parent')
+
+# A removed comment without replies, the removed ones as well, whose last change is older than the date.
+# The replies are found by the parent index, the last change by the history index.
+SQL_REMOVED = r"""
+SELECT c.id FROM {table} c
+WHERE c.is_removed AND c.id > %(after)s
+  AND NOT EXISTS (SELECT 1 FROM {table} r WHERE r.parent = c.id)
+  AND coalesce((SELECT max(h.event_date) FROM {history_table} h WHERE h.comment_id = c.id), c.submit_date)
+    < %(before)s
+ORDER BY c.id
+LIMIT %(limit)s
+"""
+
+# An entity whose thread hasn't changed since the date, and which has comments in the table
+SQL_DORMANT = r"""
+SELECT n.content_type_id, n.object_pk FROM {counter_table} n
+WHERE n.content_type_id <> %(comment_type)s AND (n.content_type_id, n.object_pk) > (%(after_type)s, %(after_pk)s)
+GROUP BY n.content_type_id, n.object_pk
+HAVING max(greatest(n.last_modified, n.last_activity)) < %(before)s
+  AND EXISTS (SELECT 1 FROM {table} c WHERE c.content_type_id = n.content_type_id AND c.object_pk = n.object_pk)
+ORDER BY n.content_type_id, n.object_pk
+LIMIT %(limit)s
+"""
+
+# The comments are checked again by the delete, a comment recovered or replied to in between stays
+SQL_ARCHIVE_REMOVED = r"""
+WITH moved AS (
+  DELETE FROM {table} c
+  WHERE c.id = ANY(%(ids)s) AND c.is_removed AND NOT EXISTS (SELECT 1 FROM {table} r WHERE r.parent = c.id)
+  RETURNING {columns}
+)
+INSERT INTO {archive_table} ({columns}, archived_at, reason)
+SELECT {columns}, now(), 'removed' FROM moved
+RETURNING path
+"""
+
+# Every comment of the entity is a root of a subtree, see `models.path_end`
+SQL_ARCHIVE_THREAD = r"""
+WITH roots AS (
+  SELECT id AS root FROM {table} WHERE content_type_id = %(content_type_id)s AND object_pk = %(object_pk)s
+), moved AS (
+  DELETE FROM {table} c USING roots
+  WHERE c.path >= ARRAY[roots.root] AND c.path < ARRAY[roots.root + 1]
+  RETURNING {columns}
+)
+INSERT INTO {archive_table} ({columns}, archived_at, reason)
+SELECT {columns}, now(), 'dormant' FROM moved
+RETURNING path
+"""
+
+# The threads of the archived comments and the ones of the entities are moved back as a whole
+SQL_RESTORE = r"""
+WITH roots AS (
+  SELECT path[1] AS root FROM {archive_table} WHERE id = ANY(%(ids)s)
+  UNION
+  SELECT id FROM {archive_table}
+  WHERE (content_type_id, object_pk) IN (SELECT * FROM unnest(%(content_type_ids)s::int[], %(object_pks)s::text[]))
+), moved AS (
+  DELETE FROM {archive_table} a USING roots
+  WHERE a.path >= ARRAY[roots.root] AND a.path < ARRAY[roots.root + 1]
+  RETURNING {columns}
+)
+INSERT INTO {table} ({columns})
+SELECT {columns} FROM moved
+RETURNING path
+"""
+
+# The counters of an archived comment are the ones of its archived replies
+SQL_REPLY_COUNT = r"""
+SELECT count(*) FROM {archive_table} r WHERE r.parent = {archive_table}.id AND NOT r.is_removed
+"""
+
+SQL_LAST_ACTIVITY = r"""
+SELECT coalesce(max(r.submit_date), {archive_table}.submit_date) FROM {archive_table} r
+WHERE r.parent = {archive_table}.id AND NOT r.is_removed
+"""
+
+# the trees of the archive are the ones of trees.py read from the archive table
+SQL_GET_CHILDREN = trees.SQL_GET_CHILDREN.replace('comments_comment', 'comments_archivedcomment')
+SQL_GET_REPLIES = trees.SQL_GET_REPLIES.replace('comments_comment', 'comments_archivedcomment')
+
+
+def get_removed_after():
+    return getattr(settings, 'COMMENTS_ARCHIVE_REMOVED_AFTER', 30)
+
+
+def get_dormant_after():
+    return getattr(settings, 'COMMENTS_ARCHIVE_DORMANT_AFTER', 365)
+
+
+def get_batch_size():
+    return getattr(settings, 'COMMENTS_ARCHIVE_BATCH_SIZE', 1000)
+
+
+def format_sql(sql):
+    return sql.format(table=models.Comment._meta.db_table, archive_table=models.ArchivedComment._meta.db_table,
+                      history_table=models.History._meta.db_table, counter_table=models.Counter._meta.db_table,
+                      columns=COLUMNS)
+
+
+def archive_removed(days=None, batch_size=None):
+    """
+    Moves the removed comments unchanged for the days into the archive, returns their number. The comments whose
+    replies are archived by a pass are archived by the next one.
+    """
+    days = get_removed_after() if days is None else days
+    batch_size = batch_size or get_batch_size()
+    if days is None:
+        return 0
+    before = timezone.now() - timedelta(days=days)
+    count = 0
+    while True:
+        archived, after = 0, 0
+        while True:
+            with connection.cursor() as cursor:
+                cursor.execute(format_sql(SQL_REMOVED), {'after': after, 'before': before, 'limit': batch_size})
+                ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                break
+            after = ids[-1]
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(format_sql(SQL_ARCHIVE_REMOVED), {'ids': ids})
+                paths = [row[0] for row in cursor.fetchall()]
+                trees.invalidate(paths)
+            archived += len(paths)
+        count += archived
+        if not archived:
+            return count
+
+
+def archive_dormant(days=None, batch_size=None):
+    """
+    Moves the threads of the entities unchanged for the days into the archive, returns the number of the comments
+    """
+    days = get_dormant_after() if days is None else days
+    batch_size = batch_size or get_batch_size()
+    if days is None:
+        return 0
+    params = {'comment_type': ContentType.objects.get_for_model(models.Comment).pk, 'after_type': 0, 'after_pk': '',
+              'before': timezone.now() - timedelta(days=days), 'limit': batch_size}
+    count = 0
+    while True:
+        with connection.cursor() as cursor:
+            cursor.execute(format_sql(SQL_DORMANT), params)
+            entities = cursor.fetchall()
+        if not entities:
+            return count
+        params['after_type'], params['after_pk'] = entities[-1]
+        for content_type_id, object_pk in entities:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(format_sql(SQL_ARCHIVE_THREAD),
+                               {'content_type_id': content_type_id, 'object_pk': object_pk})
+                paths = [row[0] for row in cursor.fetchall()]
+                # the roots aren't in the comments table anymore to find the entity by them
+                trees.invalidate(paths, [(content_type_id, object_pk)])
+                if paths:
+                    progress.forget_keys()
+            count += len(paths)
+
+
+def restore(ids=(), entities=()):
+    """
+    Moves the threads of the archived comments with the ids and the archived threads of the entities back into the
+    comments table, returns the number of the comments restored
+    """
+    ids, entities = list(ids), list(entities)
+    if not ids and not entities:
+        return 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(format_sql(SQL_RESTORE), {
+            'ids': ids, 'content_type_ids': [content_type_id for content_type_id, object_pk in entities],
+            'object_pks': [force_text(object_pk) for content_type_id, object_pk in entities]})
+        paths = [row[0] for row in cursor.fetchall()]
+        if paths:
+            trees.invalidate(paths)
+            progress.forget_keys()
+    return len(paths)
+
+
+def recover(comment_id, user=None):
+    """
+    Recovers the removed comment, which can be archived, returns it
+    """
+    with transaction.atomic():
+        restore([comment_id])
+        comment = models.Comment.objects.select_for_update().get(pk=comment_id)
+        if comment.is_removed:
+            comment.is_removed = False
+            comment.changed_by = user
+            comment.save(update_fields=['is_removed', 'changed_by'])
+    return comment
+
+
+def annotate_comments(queryset):
+    """
+    Adds `reply_count` and `last_activity` of every archived comment to the queryset, like
+    `counters.annotate_comments` does for the comments
+    """
+    return queryset.annotate(
+        reply_count=RawSQL(format_sql(SQL_REPLY_COUNT), [], IntegerField()),
+        last_activity=RawSQL(format_sql(SQL_LAST_ACTIVITY), [], DateTimeField()))
+
+
+def fetch_tree(content_type_id, object_id):
+    """
+    Reads the tree of the archived comments on the entity, the archive isn't cached
+    """
+    with connection.cursor() as cursor:
+        if int(content_type_id) == ContentType.objects.get_for_model(models.Comment).id:
+            cursor.execute(SQL_GET_REPLIES, (object_id,))
+        else:
+            cursor.execute(SQL_GET_CHILDREN, (force_text(object_id), content_type_id))
+        return trees.dictfetchall(cursor)
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the hot paths. They are run by the `benchmark` management command, each inside a transaction which
+is rolled back, so they can be run against a development database.
+"""
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import itertools
+from random import Random
+import timeit
+
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from rest_framework.renderers import JSONRenderer
+
+import bulk
+import counters
+import datagen
+import history
+import models
+import search
+import serializers
+import signals
+import trees
+from trees import SQL_GET_CHILDREN, SQL_GET_REPLIES
+
+
+# The query used before the materialized path was introduced, without the columns out of the model
+SQL_GET_CHILDREN_RECURSIVE = r"""
+WITH RECURSIVE r AS (
+  SELECT c1.id, c1.content_type_id, c1.object_pk, c1.user_id, c1.changed_by_id, c1.comment, c1.submit_date,
+         c1.is_removed, btrim(u1.first_name || ' ' || u1.last_name) AS user_name
+  FROM comments_comment c1
+  JOIN auth_user u1 ON u1.id = c1.user_id
+  WHERE c1.object_pk = %s AND c1.content_type_id = %s AND c1.is_removed = false
+
+  UNION
+
+  SELECT c2.id, c2.content_type_id, c2.object_pk, c2.user_id, c2.changed_by_id, c2.comment, c2.submit_date,
+         c2.is_removed, btrim(u2.first_name || ' ' || u2.last_name) AS user_name
+  FROM comments_comment c2
+  JOIN auth_user u2 ON u2.id = c2.user_id
+  JOIN r ON c2.content_type_id = %s AND c2.object_pk::bigint = r.id AND c2.is_removed = false
+)
+
+SELECT * FROM r ORDER BY submit_date;
+"""
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+def measure(func, repeat):
+    """
+    Returns the best and the median time of the function in milliseconds
+    """
+    timings = sorted(timeit.repeat(func, number=1, repeat=repeat))
+    return timings[0] * 1000, timings[len(timings) // 2] * 1000
+
+
+def get_bench_user():
+    return get_user_model().objects.get_or_create(username='benchmark')[0]
+
+
+def create_thread(user, depth, width):
+    """
+    Creates an article with a comment having `depth` levels of replies, `width` replies on each level.
+    Replies of a level are spread evenly between comments of the previous level.
+    Returns the article and the root comment.
+    The comments are inserted in bulk, so no notifications are sent.
+    """
+    article = models.Article.objects.create(text='benchmark')
+    article_ct = ContentType.objects.get_for_model(models.Article)
+    comment_ct = ContentType.objects.get_for_model(models.Comment)
+    root_id = models.reserve_ids(models.Comment, 1)[0]
+    root = models.Comment.objects.bulk_create([models.Comment(
+        id=root_id, path=[root_id], content_type=article_ct, object_pk=article.pk, comment='root', user=user)])[0]
+    level = [root]
+    for depth_index in range(depth):
+        ids = models.reserve_ids(models.Comment, width)
+        replies = []
+        for i, pk in enumerate(ids):
+            parent = level[i % len(level)]
+            replies.append(models.Comment(id=pk, path=parent.path + [pk], content_type=comment_ct,
+                                          object_pk=parent.pk, parent=parent.pk, comment='reply %s' % i, user=user))
+        models.Comment.objects.bulk_create(replies)
+        level = replies
+    return article, root
+
+
+def fetch_children(sql, params):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return len(cursor.fetchall())
+
+
+@benchmark('tree')
+def tree_benchmark(repeat):
+    """
+    Compares the recursive query with the materialized path on deep and wide threads
+    """
+    user = get_bench_user()
+    article_ct = ContentType.objects.get_for_model(models.Article)
+    comment_ct = ContentType.objects.get_for_model(models.Comment)
+    shapes = [('deep', models.MAX_THREAD_DEPTH - 1, 1), ('wide', 1, 5000), ('bushy', 8, 500)]
+    results = []
+    for shape, depth, width in shapes:
+        article, root = create_thread(user, depth, width)
+        connection.cursor().execute('ANALYZE comments_comment')
+        targets = [
+            ('article', (str(article.pk), article_ct.pk, comment_ct.pk),
+             SQL_GET_CHILDREN, (str(article.pk), article_ct.pk)),
+            ('comment', (str(root.pk), comment_ct.pk, comment_ct.pk),
+             SQL_GET_REPLIES, (root.pk,)),
+        ]
+        for target, recursive_params, path_sql, path_params in targets:
+            rows = fetch_children(path_sql, path_params)
+            assert rows == fetch_children(SQL_GET_CHILDREN_RECURSIVE, recursive_params)
+            cte_best, cte_median = measure(lambda: fetch_children(SQL_GET_CHILDREN_RECURSIVE, recursive_params),
+                                           repeat)
+            path_best, path_median = measure(lambda: fetch_children(path_sql, path_params), repeat)
+            results.append(OrderedDict([
+                ('shape', shape), ('target', target), ('rows', rows),
+                ('cte_best_ms', cte_best), ('cte_median_ms', cte_median),
+                ('path_best_ms', path_best), ('path_median_ms', path_median),
+            ]))
+    return results
+
+
+@benchmark('bulk')
+def bulk_benchmark(repeat):
+    """
+    Compares creating, editing and removing comments one by one with the bulk functions.
+    The notifications are published on commit, so only their dispatching is measured.
+    """
+    user = get_bench_user()
+    article = models.Article.objects.create(text='benchmark')
+    article_ct = ContentType.objects.get_for_model(models.Article)
+    # the single item path of a thousand comments takes seconds
+    repeat = min(repeat, 5)
+    results = []
+    for size in (10, 100, 1000):
+        def single():
+            comments = [models.Comment.objects.create(content_type=article_ct, object_pk=article.pk,
+                                                      comment='single', user=user) for i in range(size)]
+            for comment in comments:
+                comment.comment = 'edited'
+                comment.changed_by = user
+                comment.save()
+            for comment in comments:
+                if comment.is_deletable():
+                    comment.is_removed = True
+                    comment.save(update_fields=['is_removed', 'changed_by'])
+
+        def batch():
+            items = [{'content_type': article_ct.pk, 'object_pk': str(article.pk), 'comment': 'bulk'}] * size
+            ids = [result['id'] for result in bulk.create_comments(items, user)]
+            bulk.update_comments([{'id': pk, 'comment': 'edited'} for pk in ids], user)
+            bulk.remove_comments(ids, user)
+
+        single_median = measure(single, repeat)[1]
+        bulk_median = measure(batch, repeat)[1]
+        results.append(OrderedDict([
+            ('size', size),
+            ('single_median_ms', single_median), ('bulk_median_ms', bulk_median),
+            ('single_items_per_s', size * 1000 / single_median), ('bulk_items_per_s', size * 1000 / bulk_median),
+        ]))
+    return results
+
+
+@benchmark('history')
+def history_benchmark(repeat):
+    """
+    Compares the row and the statement history triggers on mass updates of a thread.
+    The trigger is changed inside the benchmark transaction, so it's restored by the rollback.
+    """
+    user = get_bench_user()
+    article, root = create_thread(user, 1, 10000)
+    comments = models.Comment.objects.filter(path__0=root.pk)
+    results = []
+    for variant in sorted(signals.HISTORY_TRIGGERS):
+        signals.install_history_trigger(variant)
+        for size in (100, 10000):
+            pks = list(comments.order_by('id').values_list('id', flat=True)[:size])
+            texts = iter(range(repeat))
+            best, median = measure(lambda: comments.filter(id__in=pks).update(comment='edit %s' % next(texts),
+                                                                                changed_by=user), repeat)
+            results.append(OrderedDict([
+                ('trigger', variant), ('rows', size), ('best_ms', best), ('median_ms', median),
+            ]))
+    return results
+
+
+def get_history_size(comment_ids):
+    """
+    Returns the stored size of the texts of the history of the comments in kilobytes
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT sum(pg_column_size(old_comment) + pg_column_size(new_comment) "
+                       "+ coalesce(pg_column_size(delta), 0)) FROM comments_history WHERE comment_id = ANY(%s)",
+                       [comment_ids])
+        return cursor.fetchone()[0] / 1024.0
+
+
+@benchmark('history_compaction')
+def history_compaction_benchmark(repeat):
+    """
+    Measures the storage saved by the compaction of the history and the cost of rebuilding the texts
+    """
+    user = get_bench_user()
+    article_ct = ContentType.objects.get_for_model(models.Article)
+    article = models.Article.objects.create(text='benchmark')
+    results = []
+    for length, edits in [(300, 50), (2500, 50), (2500, 200)]:
+        ids = models.reserve_ids(models.Comment, 20)
+        models.Comment.objects.bulk_create([
+            models.Comment(id=pk, path=[pk], content_type=article_ct, object_pk=article.pk, user=user,
+                           comment=' '.join('w%s' % (i * 7919 % 1009) for i in range(length // 5)))
+            for pk in ids])
+        with connection.cursor() as cursor:
+            # small edits at random places, a change per statement
+            for i in range(edits):
+                cursor.execute("UPDATE comments_comment SET comment = overlay(comment PLACING %s "
+                               "FROM (1 + floor(random() * (length(comment) - 5)))::int FOR 3) WHERE id = ANY(%s)",
+                               ['e%02d' % (i % 100), ids])
+        histories = models.History.objects.filter(comment_id__in=ids)
+        full_size = get_history_size(ids)
+        compaction = measure(lambda: history.compact_history(), 1)[0]
+        compact_size = get_history_size(ids)
+        page = lambda: history.reconstruct(list(histories.order_by('-event_date', '-id')[:100]))
+        results.append(OrderedDict([
+            ('text', length), ('changes', edits * len(ids)),
+            ('full_kb', full_size), ('compact_kb', compact_size), ('saved_pct', 100 - compact_size * 100 / full_size),
+            ('compaction_ms', compaction),
+            ('page_ms', measure(page, repeat)[1]),
+            ('versions_ms', measure(lambda: history.get_versions(ids[0]), repeat)[1]),
+        ]))
+    return results
+
+
+@benchmark('serialization')
+def serialization_benchmark(repeat):
+    """
+    Compares CommentSerializer with the values() fast path of the list, the query included
+    """
+    user = get_bench_user()
+    article, root = create_thread(user, 1, 1000)
+    queryset = counters.annotate_comments(models.Comment.objects.filter(path__0=root.pk).select_related('user'))
+    rows = serializers.get_row_serializer()
+    results = []
+    for size in (100, 1000):
+        page = queryset.order_by('submit_date', 'id')[:size]
+        serializer = lambda: serializers.CommentSerializer(page, many=True).data
+        fast = lambda: rows.serialize(rows.get_rows(page))
+        assert JSONRenderer().render(serializer()) == JSONRenderer().render(fast())
+        serializer_median = measure(serializer, repeat)[1]
+        fast_median = measure(fast, repeat)[1]
+        results.append(OrderedDict([
+            ('rows', size),
+            ('serializer_median_ms', serializer_median), ('fast_median_ms', fast_median),
+            ('serializer_rows_per_s', size * 1000 / serializer_median), ('fast_rows_per_s', size * 1000 / fast_median),
+        ]))
+    return results
+
+
+@benchmark('stream')
+def stream_benchmark(repeat):
+    """
+    Compares the time to the first rows of the child comment tree built in memory and the streamed one
+    """
+    user = get_bench_user()
+    comment_ct = ContentType.objects.get_for_model(models.Comment)
+    repeat = min(repeat, 5)
+    results = []
+    for size in (1000, 50000):
+        article, root = create_thread(user, 1, size)
+        whole = lambda: JSONRenderer().render(trees.fetch_tree(comment_ct.pk, root.pk))
+        # the opening bracket and the first batch of rows
+        first = lambda: list(itertools.islice(trees.stream_tree(comment_ct.pk, root.pk), 2))
+        streamed = lambda: b''.join(trees.stream_tree(comment_ct.pk, root.pk))
+        results.append(OrderedDict([
+            ('rows', size),
+            ('whole_first_rows_ms', measure(whole, repeat)[1]),
+            ('stream_first_rows_ms', measure(first, repeat)[1]),
+            ('stream_all_ms', measure(streamed, repeat)[1]),
+        ]))
+    return results
+
+
+@benchmark('nested')
+def nested_benchmark(repeat):
+    """
+    Compares the whole child comment tree with the first screen of the nested one (3 levels of 10 replies)
+    """
+    user = get_bench_user()
+    comment_ct = ContentType.objects.get_for_model(models.Comment)
+    link = lambda content_type_id, object_id, key: '/child-comments/%s/%s/' % (content_type_id, object_id)
+    results = []
+    for shape, depth, width in [('wide', 1, 50000), ('bushy', 8, 5000)]:
+        article, root = create_thread(user, depth, width)
+        connection.cursor().execute('ANALYZE comments_comment')
+        whole = lambda: JSONRenderer().render(trees.fetch_tree(comment_ct.pk, root.pk))
+        nested = lambda: JSONRenderer().render(trees.get_nested_tree(comment_ct.pk, root.pk, 3, 10, link)[0])
+        results.append(OrderedDict([
+            ('shape', shape), ('comments', depth * width),
+            ('whole_ms', measure(whole, repeat)[1]), ('whole_kb', len(whole()) / 1024.0),
+            ('nested_ms', measure(nested, repeat)[1]), ('nested_kb', len(nested()) / 1024.0),
+        ]))
+    return results
+
+
+def create_corpus(user, articles, size):
+    """
+    Creates the articles with `size` comments spread over them, the words are used with the frequencies of a natural
+    language, see `datagen.Words`. Returns the articles and the words from the most frequent one.
+    """
+    words = datagen.Words(Random(0))
+    article_ct = ContentType.objects.get_for_model(models.Article)
+    created = [models.Article.objects.create(text='benchmark') for i in range(articles)]
+    for start in range(0, size, 10000):
+        ids = models.reserve_ids(models.Comment, min(10000, size - start))
+        models.Comment.objects.bulk_create([
+            models.Comment(id=pk, path=[pk], content_type=article_ct, object_pk=created[pk % articles].pk, user=user,
+                           comment=words.text()) for pk in ids])
+    return created, words.words
+
+
+@benchmark('search')
+def search_benchmark(repeat):
+    """
+    Compares the full-text search with `icontains` on a corpus of 100 000 comments: the first page of the comments
+    with a frequent, a rare and a missing word, on all the articles and on one of them
+    """
+    user = get_bench_user()
+    articles, words = create_corpus(user, 100, 100000)
+    connection.cursor().execute('ANALYZE comments_comment')
+    article_ct = ContentType.objects.get_for_model(models.Article)
+    comments = counters.annotate_comments(models.Comment.objects.filter(is_removed=False).select_related('user'))
+    rows = serializers.get_row_serializer()
+    results = []
+    for frequency, word in [('frequent', words[0]), ('rare', words[500]), ('missing', 'zuzuzu')]:
+        for scope, queryset in [('all', comments),
+                                ('article', comments.filter(content_type=article_ct, object_pk=articles[0].pk))]:
+            contains = queryset.filter(comment__icontains=word).order_by('-submit_date', '-id')
+            found = search.search_comments(queryset, word).order_by(*search.SEARCH_ORDERING)
+            results.append(OrderedDict([
+                ('word', frequency), ('scope', scope),
+                ('icontains_rows', contains.count()), ('search_rows', found.count()),
+                ('icontains_page_ms', measure(lambda: rows.serialize(rows.get_rows(contains)[:20]), repeat)[1]),
+                ('search_page_ms', measure(lambda: rows.serialize(rows.get_rows(found, 'rank')[:20]), repeat)[1]),
+            ]))
+    return results
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Set based writes of many comments. A batch costs a few statements whatever its size. The functions return a result
+per item in the order of the items, {'id': ..., 'status': ...} for the done ones and {'status': ..., 'errors': ...}
+for the rest. The statements should be run in a transaction.
+"""
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, router
+from rest_framework.exceptions import ValidationError
+
+from comments import archive, counters, notifications, trees
+import models
+import serializers
+
+
+# Only the changed comments are updated, so the others get neither a history record nor a notification
+SQL_UPDATE_COMMENTS = r"""
+UPDATE {table} c SET comment = v.comment, changed_by_id = %s
+FROM (VALUES {values}) AS v(id, comment)
+WHERE c.id = v.id AND NOT c.is_removed AND c.comment IS DISTINCT FROM v.comment
+RETURNING c.id, c.content_type_id, c.object_pk, c.comment, c.user_id, c.path;
+"""
+
+SQL_REMOVE_COMMENTS = r"""
+UPDATE {table} SET is_removed = true, changed_by_id = %s
+WHERE id = ANY(%s) AND NOT is_removed
+RETURNING id, content_type_id, object_pk, comment, user_id, path;
+"""
+
+
+def error(status, errors):
+    return {'status': status, 'errors': errors}
+
+
+def not_found():
+    return error(404, {'detail': 'Not found.'})
+
+
+def validate_items(serializer_class, items):
+    """
+    Returns the list of results with the errors of the invalid items and the validated data of the others by index
+    """
+    results = [None] * len(items)
+    valid = OrderedDict()
+    # a serializer is reused like in ListSerializer, building its fields costs more than validating an item
+    serializer = serializer_class()
+    for index, item in enumerate(items):
+        try:
+            valid[index] = serializer.run_validation(item)
+        except ValidationError as exc:
+            results[index] = error(400, exc.detail)
+    return results, valid
+
+
+def fetch_comments(cursor):
+    return [models.Comment(id=pk, content_type_id=content_type_id, object_pk=object_pk, comment=comment,
+                           user_id=user_id, path=path)
+            for pk, content_type_id, object_pk, comment, user_id, path in cursor.fetchall()]
+
+
+def create_comments(items, user):
+    """
+    Creates the comments by a single insert. The parents of the replies are checked by a single query,
+    so a reply can't be given to a comment created in the same batch.
+    """
+    using = router.db_for_write(models.Comment)
+    results, valid = validate_items(serializers.BulkCreateSerializer, items)
+    comment_type = ContentType.objects.get_for_model(models.Comment)
+    parent_ids = [int(data['object_pk']) for data in valid.values()
+                  if data['content_type'] == comment_type and data['object_pk'].isdigit()]
+    paths = dict(models.Comment.objects.using(using).filter(pk__in=parent_ids).values_list('id', 'path'))
+    # the replies to the archived comments and the comments on the entities bring the archived threads back
+    missing = set(parent_ids) - set(paths)
+    if archive.restore(missing, set((data['content_type'].pk, data['object_pk']) for data in valid.values()
+                                    if data['content_type'] != comment_type)) and missing:
+        paths.update(models.Comment.objects.using(using).filter(pk__in=missing).values_list('id', 'path'))
+
+    comments = OrderedDict()
+    for index, data in valid.items():
+        is_reply = data['content_type'] == comment_type
+        parent_path = []
+        if is_reply:
+            parent_path = data['object_pk'].isdigit() and paths.get(int(data['object_pk']))
+            if not parent_path:
+                results[index] = error(400, {'object_pk': ["The comment doesn't exist."]})
+                continue
+            if len(parent_path) >= models.MAX_THREAD_DEPTH:
+                results[index] = error(400, {'object_pk': ["The thread is too deep."]})
+                continue
+        comments[index] = models.Comment(
+            content_type=data['content_type'], object_pk=data['object_pk'], comment=data['comment'], user=user,
+            path=list(parent_path), parent=int(data['object_pk']) if is_reply else None)
+    if not comments:
+        return results
+
+    for pk, comment in zip(models.reserve_ids(models.Comment, len(comments), using), comments.values()):
+        comment.id = pk
+        comment.path.append(pk)
+    models.Comment.objects.using(using).bulk_create(comments.values())
+    notifications.dispatch_many('insert', comments.values(), using)
+    trees.invalidate([comment.path for comment in comments.values()], using=using)
+    for index, comment in comments.items():
+        results[index] = {'id': comment.id, 'status': 201}
+    return results
+
+
+def update_comments(items, user):
+    """
+    Changes the text of the comments by a single update. The last edit of a comment in the batch wins.
+    """
+    using = router.db_for_write(models.Comment)
+    results, valid = validate_items(serializers.BulkUpdateSerializer, items)
+    texts = OrderedDict((data['id'], data['comment']) for data in valid.values())
+    existing = set(models.Comment.objects.using(using).select_for_update().filter(
+        id__in=texts, is_removed=False).values_list('id', flat=True))
+    for index, data in valid.items():
+        results[index] = {'id': data['id'], 'status': 200} if data['id'] in existing else not_found()
+
+    rows = [(pk, text) for pk, text in texts.items() if pk in existing]
+    if not rows:
+        return results
+    params = [user.id]
+    for row in rows:
+        params.extend(row)
+    with connections[using].cursor() as cursor:
+        cursor.execute(SQL_UPDATE_COMMENTS.format(table=models.Comment._meta.db_table,
+                                                  values=', '.join(['(%s, %s)'] * len(rows))), params)
+        changed = fetch_comments(cursor)
+    notifications.dispatch_many('update', changed, using)
+    trees.invalidate([comment.path for comment in changed], using=using)
+    return results
+
+
+def remove_comments(ids, user):
+    """
+    Flags the comments as removed by a single update. The comments having replies are found by their counters,
+    they can't be removed like in `Comment.is_deletable`.
+    """
+    using = router.db_for_write(models.Comment)
+    reply_counts = dict(counters.annotate_comments(models.Comment.objects.using(using).select_for_update().filter(
+        id__in=ids, is_removed=False)).values_list('id', 'reply_count'))
+    deletable = [pk for pk, count in reply_counts.items() if not count]
+    if deletable:
+        with connections[using].cursor() as cursor:
+            cursor.execute(SQL_REMOVE_COMMENTS.format(table=models.Comment._meta.db_table), [user.id, deletable])
+            removed = fetch_comments(cursor)
+        notifications.dispatch_many('delete', removed, using)
+        trees.invalidate([comment.path for comment in removed], using=using)
+
+    results = []
+    for pk in ids:
+        if pk not in reply_counts:
+            results.append(not_found())
+        elif reply_counts[pk]:
+            results.append(error(403, {'detail': "The comment has replies."}))
+        else:
+            results.append({'id': pk, 'status': 204})
+    return results
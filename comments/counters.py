@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Denormalized counters of the comments. Every commented entity (an article, a comment for its replies) has the number
+of its comments, which aren't removed, and the date of the last activity on them: a comment added, removed,
+recovered or moved. The triggers of counters.sql keep them in several shards per entity (COMMENTS_COUNTER_SHARDS),
+so the writers don't queue up for a single row of a hot thread, and the shards are summed up when read.
+"""
+from __future__ import unicode_literals
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, router
+from django.db.models import DateTimeField, IntegerField, Max, Sum
+from django.db.models.expressions import RawSQL
+from django.utils.encoding import force_text
+
+import models
+
+# The subqueries of a comment queryset, the shards of a comment are found by the index of the unique key
+SQL_REPLY_COUNT = r"""
+SELECT coalesce(sum(reply_count), 0) FROM {counter_table} WHERE content_type_id = %s AND object_pk = {table}.id::text
+"""
+
+SQL_LAST_ACTIVITY = r"""
+SELECT coalesce(max(last_activity), {table}.submit_date) FROM {counter_table}
+WHERE content_type_id = %s AND object_pk = {table}.id::text
+"""
+
+# The thread of the replies to a comment is the entity commented by the root of its path
+SQL_THREAD_OF_COMMENT = r"""
+SELECT r.content_type_id, r.object_pk FROM {table} c JOIN {table} r ON r.id = c.path[1] WHERE c.id = %s
+"""
+
+SQL_THREAD_VERSION = r"""
+SELECT coalesce(sum(version), 0), max(last_modified) FROM {counter_table}
+WHERE (content_type_id, object_pk) = ({thread})
+"""
+
+
+def get_counters(content_type_id, object_pks):
+    """
+    Returns (reply_count, last_activity) of the entities by their pks, an entity without comments gets (0, None)
+    """
+    object_pks = [force_text(pk) for pk in object_pks]
+    rows = models.Counter.objects.filter(content_type_id=content_type_id, object_pk__in=object_pks).order_by(
+        ).values('object_pk').annotate(replies=Sum('reply_count'), activity=Max('last_activity'))
+    counters = dict.fromkeys(object_pks, (0, None))
+    counters.update((row['object_pk'], (row['replies'], row['activity'])) for row in rows)
+    return counters
+
+
+def annotate_comments(queryset):
+    """
+    Adds `reply_count` and `last_activity` of every comment to the queryset, a comment without replies was last
+    active when it was submitted
+    """
+    params = [ContentType.objects.get_for_model(models.Comment).pk]
+    return queryset.annotate(
+        reply_count=RawSQL(SQL_REPLY_COUNT.format(counter_table=models.Counter._meta.db_table,
+                                                  table=models.Comment._meta.db_table), params, IntegerField()),
+        last_activity=RawSQL(SQL_LAST_ACTIVITY.format(counter_table=models.Counter._meta.db_table,
+                                                      table=models.Comment._meta.db_table), params, DateTimeField()))
+
+
+def get_thread_version(content_type_id, object_pk):
+    """
+    Returns the version of the thread the comments on the entity belong to and the date it was last modified,
+    any change of a comment in the thread increases the version
+    """
+    if content_type_id == ContentType.objects.get_for_model(models.Comment).pk:
+        thread, params = SQL_THREAD_OF_COMMENT.format(table=models.Comment._meta.db_table), [int(object_pk)]
+    else:
+        thread, params = '%s, %s', [content_type_id, force_text(object_pk)]
+    with connections[router.db_for_read(models.Counter)].cursor() as cursor:
+        cursor.execute(SQL_THREAD_VERSION.format(counter_table=models.Counter._meta.db_table, thread=thread), params)
+        return cursor.fetchone()
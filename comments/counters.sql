@@ -0,0 +1,119 @@
+-- the previous signature is dropped, the functions are replaced by every migrate
+DROP FUNCTION IF EXISTS comment_counters_add(int[], text[], int[], timestamptz[]);
+
+-- The changes of an entity go to one of its shards picked at random, so concurrent replies to a hot thread
+-- seldom wait for the lock of the same row
+CREATE OR REPLACE FUNCTION comment_counters_add(content_type_ids int[], object_pks text[], replies int[],
+                                                activities timestamptz[], changes int[])
+  RETURNS void AS
+$BODY$
+  INSERT INTO {counter_table} AS c (content_type_id, object_pk, shard, reply_count, last_activity, version,
+                                    last_modified)
+  SELECT content_type_id, object_pk, floor(random() * {shards}), sum(reply), max(activity), sum(change),
+         CASE WHEN sum(change) > 0 THEN now() END
+  FROM unnest(content_type_ids, object_pks, replies, activities, changes)
+    AS v(content_type_id, object_pk, reply, activity, change)
+  GROUP BY content_type_id, object_pk
+  ON CONFLICT (content_type_id, object_pk, shard) DO UPDATE
+  SET reply_count = c.reply_count + EXCLUDED.reply_count,
+      last_activity = GREATEST(c.last_activity, EXCLUDED.last_activity),
+      version = c.version + EXCLUDED.version,
+      last_modified = GREATEST(c.last_modified, EXCLUDED.last_modified);
+$BODY$
+  LANGUAGE sql;
+
+-- Every change counts the replies of the entity commented and the version of the thread, which is the entity the
+-- root comment of the path is on
+CREATE OR REPLACE FUNCTION comment_counters()
+  RETURNS trigger AS
+$BODY$
+begin
+  IF TG_OP = 'INSERT' THEN
+    PERFORM comment_counters_add(array_agg(content_type_id), array_agg(object_pk), array_agg(reply),
+                                 array_agg(activity), array_agg(change))
+    FROM (
+      SELECT content_type_id, object_pk, 1 AS reply, submit_date AS activity, 0 AS change
+      FROM new_comments
+      WHERE NOT is_removed
+      UNION ALL
+      SELECT r.content_type_id, r.object_pk, 0, NULL, 1
+      FROM new_comments n
+      JOIN {table_name} r ON r.id = n.path[1]
+    ) changes;
+  ELSIF TG_OP = 'DELETE' THEN
+    PERFORM comment_counters_add(array_agg(content_type_id), array_agg(object_pk), array_agg(reply),
+                                 array_agg(activity), array_agg(change))
+    FROM (
+      SELECT content_type_id, object_pk, -1 AS reply, now() AS activity, 0 AS change
+      FROM old_comments
+      WHERE NOT is_removed
+      UNION ALL
+      -- the root could be deleted by the same statement
+      SELECT coalesce(ro.content_type_id, r.content_type_id), coalesce(ro.object_pk, r.object_pk), 0, NULL, 1
+      FROM old_comments o
+      LEFT JOIN old_comments ro ON ro.id = o.path[1]
+      LEFT JOIN {table_name} r ON r.id = o.path[1]
+    ) changes
+    WHERE content_type_id IS NOT NULL;
+  ELSE
+    PERFORM comment_counters_add(array_agg(content_type_id), array_agg(object_pk), array_agg(reply),
+                                 array_agg(activity), array_agg(change))
+    FROM (
+      -- a removed or moved comment leaves its parent, a recovered or moved one comes to its parent
+      SELECT o.content_type_id, o.object_pk, -1 AS reply, now() AS activity, 0 AS change
+      FROM old_comments o
+      JOIN new_comments n ON n.id = o.id
+      WHERE NOT o.is_removed
+        AND (n.is_removed OR (n.content_type_id, n.object_pk) IS DISTINCT FROM (o.content_type_id, o.object_pk))
+      UNION ALL
+      SELECT n.content_type_id, n.object_pk, 1, now(), 0
+      FROM old_comments o
+      JOIN new_comments n ON n.id = o.id
+      WHERE NOT n.is_removed
+        AND (o.is_removed OR (n.content_type_id, n.object_pk) IS DISTINCT FROM (o.content_type_id, o.object_pk))
+      UNION ALL
+      -- a change is seen by the thread the comment was in and the one it is in now
+      SELECT coalesce(ro.content_type_id, r.content_type_id), coalesce(ro.object_pk, r.object_pk), 0, NULL, 1
+      FROM old_comments o
+      JOIN new_comments n ON n.id = o.id
+      LEFT JOIN old_comments ro ON ro.id = o.path[1]
+      LEFT JOIN {table_name} r ON r.id = o.path[1]
+      WHERE (o.comment, o.is_removed, o.content_type_id, o.object_pk, o.path)
+        IS DISTINCT FROM (n.comment, n.is_removed, n.content_type_id, n.object_pk, n.path)
+      UNION ALL
+      SELECT r.content_type_id, r.object_pk, 0, NULL, 1
+      FROM old_comments o
+      JOIN new_comments n ON n.id = o.id
+      JOIN {table_name} r ON r.id = n.path[1]
+      WHERE (o.content_type_id, o.object_pk, o.path) IS DISTINCT FROM (n.content_type_id, n.object_pk, n.path)
+    ) changes
+    WHERE content_type_id IS NOT NULL;
+  END IF;
+  return NULL;
+end;$BODY$
+  LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS comment_counters_insert on {table_name};
+DROP TRIGGER IF EXISTS comment_counters_update on {table_name};
+DROP TRIGGER IF EXISTS comment_counters_delete on {table_name};
+
+CREATE TRIGGER comment_counters_insert
+  AFTER INSERT
+  ON {table_name}
+  REFERENCING NEW TABLE AS new_comments
+  FOR EACH STATEMENT
+  EXECUTE PROCEDURE comment_counters();
+
+CREATE TRIGGER comment_counters_update
+  AFTER UPDATE
+  ON {table_name}
+  REFERENCING OLD TABLE AS old_comments NEW TABLE AS new_comments
+  FOR EACH STATEMENT
+  EXECUTE PROCEDURE comment_counters();
+
+CREATE TRIGGER comment_counters_delete
+  AFTER DELETE
+  ON {table_name}
+  REFERENCING OLD TABLE AS old_comments
+  FOR EACH STATEMENT
+  EXECUTE PROCEDURE comment_counters();
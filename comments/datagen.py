@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic datasets for the load tests. The rows are written by COPY in chunks of CHUNK_SIZE rows, with the ids taken
+from the sequences beforehand, so the paths of the comments are known before they are written. The statement
+triggers (the counters) run once per chunk.
+
+A dataset is made of:
+- the users, who write the comments;
+- the articles with comments and replies at random depths, the newer comments reply to the recent ones;
+- a deep thread (a chain of replies) and a wide thread (a comment with many replies);
+- the subscribers of the hot article, each with a push device;
+- the comments with long history chains.
+
+The articles are marked by their text (GENERATED_PREFIX + kind), so the load tests find them.
+"""
+from __future__ import unicode_literals
+
+import bisect
+from collections import deque
+from datetime import timedelta
+import io
+import itertools
+from random import Random
+
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.utils import timezone
+from django.utils.encoding import force_text
+from push_notifications.models import GCMDevice
+
+import models
+
+CHUNK_SIZE = 50000
+GENERATED_PREFIX = 'generated:'
+# a new comment replies to one of this many recent comments of the article
+RECENT_COMMENTS = 1000
+
+
+class Words(object):
+    """
+    Words made of syllables used with the frequencies of a natural language (Zipf's law): the word of rank n is used
+    1 / n as often as the first one, so some words are in most of the texts and most of the words are rare
+    """
+
+    def __init__(self, random):
+        syllables = [consonant + vowel for consonant in 'bdfgklmnprstvz' for vowel in 'aeiou']
+        self.words = [''.join(word) for word in itertools.product(syllables, repeat=3)][::37]
+        self.random = random
+        self.cumulative = []
+        total = 0.0
+        for rank in range(1, len(self.words) + 1):
+            total += 1.0 / rank
+            self.cumulative.append(total)
+
+    def text(self, low=5, high=40):
+        random, cumulative, total = self.random, self.cumulative, self.cumulative[-1]
+        return ' '.join(self.words[bisect.bisect(cumulative, random.random() * total)]
+                        for i in range(random.randint(low, high)))
+
+
+def format_value(value):
+    """
+    Returns the value in the text format of COPY
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (list, tuple)):
+        return '{%s}' % ','.join(force_text(item) for item in value)
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return force_text(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_rows(table, columns, rows):
+    """
+    Writes the rows into the table by COPY in chunks, returns the number of the rows
+    """
+    count = 0
+    rows = iter(rows)
+    with connection.cursor() as cursor:
+        while True:
+            chunk = list(itertools.islice(rows, CHUNK_SIZE))
+            if not chunk:
+                return count
+            data = '\n'.join('\t'.join(format_value(value) for value in row) for row in chunk) + '\n'
+            cursor.copy_expert('COPY %s (%s) FROM STDIN' % (table, ', '.join(columns)),
+                               io.BytesIO(data.encode('utf-8')))
+            count += len(chunk)
+
+
+def reserve_ids(model, count):
+    """
+    Yields `count` ids of the model taken from its sequence by chunks
+    """
+    for start in range(0, count, CHUNK_SIZE):
+        for pk in models.reserve_ids(model, min(CHUNK_SIZE, count - start)):
+            yield pk
+
+
+class Generator(object):
+    """
+    Writes a dataset, every method returns the number of the rows written
+    """
+    comment_columns = ('id', 'content_type_id', 'object_pk', 'user_id', 'comment', 'submit_date', 'is_removed',
+                       'path', 'parent')
+
+    def __init__(self, seed=0, days=365):
+        self.random = Random(seed)
+        self.words = Words(self.random)
+        self.now = timezone.now()
+        self.start = self.now - timedelta(days=days)
+        self.article_type = ContentType.objects.get_for_model(models.Article).pk
+        self.comment_type = ContentType.objects.get_for_model(models.Comment).pk
+        self.user_ids = []
+
+    def create_article(self, kind):
+        return models.Article.objects.create(text=GENERATED_PREFIX + kind).pk
+
+    def get_dates(self, count):
+        """
+        Returns `count` increasing dates between the start and now
+        """
+        step = (self.now - self.start) / max(count, 1)
+        return (self.start + step * i for i in range(count))
+
+    def users(self, count):
+        user_model = get_user_model()
+        ids = list(reserve_ids(user_model, count))
+        self.user_ids.extend(ids)
+        return copy_rows(user_model._meta.db_table,
+                         ('id', 'password', 'is_superuser', 'username', 'first_name', 'last_name', 'email',
+                          'is_staff', 'is_active', 'date_joined'),
+                         ((pk, '!', False, 'generated-%s' % pk, 'First%s' % pk, 'Last%s' % pk, '', False, True,
+                           self.now) for pk in ids))
+
+    def get_user(self):
+        return self.random.choice(self.user_ids)
+
+    def comment_row(self, pk, parent, submit_date, text=None):
+        """
+        Returns the row of a comment replying to the parent (id, path), or on the article if the parent is its id
+        """
+        if isinstance(parent, tuple):
+            parent_id, parent_path = parent
+            return (pk, self.comment_type, parent_id, self.get_user(), text or self.words.text(), submit_date, False,
+                    parent_path + [pk], parent_id)
+        return (pk, self.article_type, parent, self.get_user(), text or self.words.text(), submit_date, False, [pk],
+                None)
+
+    def comments(self, articles, count, reply_ratio=0.7, max_depth=20):
+        """
+        Spreads the comments over new articles, a comment replies to a recent comment of its article with the ratio
+        """
+        article_ids = [self.create_article('articles') for i in range(articles)]
+        recent = dict((article_id, deque(maxlen=RECENT_COMMENTS)) for article_id in article_ids)
+
+        def rows():
+            for pk, submit_date in itertools.izip(reserve_ids(models.Comment, count), self.get_dates(count)):
+                article_id = self.random.choice(article_ids)
+                comments = recent[article_id]
+                parent = article_id
+                if comments and self.random.random() < reply_ratio:
+                    parent = self.random.choice(comments)
+                    if len(parent[1]) >= max_depth:
+                        parent = article_id
+                row = self.comment_row(pk, parent, submit_date)
+                comments.append((pk, row[7]))
+                yield row
+        return copy_rows(models.Comment._meta.db_table, self.comment_columns, rows())
+
+    def thread(self, kind, depth, width):
+        """
+        Makes a thread of `depth` levels of `width` replies each, spread evenly over the comments of the level above
+        """
+        article_id = self.create_article(kind)
+        dates = self.get_dates(depth * width + 1)
+        ids = reserve_ids(models.Comment, depth * width + 1)
+        rows = [self.comment_row(next(ids), article_id, next(dates))]
+        level = rows
+        for i in range(depth):
+            level = [self.comment_row(next(ids), (parent[0], parent[7]), next(dates))
+                     for parent in itertools.islice(itertools.cycle(level), width)]
+            rows.extend(level)
+        # the parents come first, the triggers run once per chunk instead of once per level
+        return copy_rows(models.Comment._meta.db_table, self.comment_columns, rows)
+
+    def subscribers(self, count, kind='articles'):
+        """
+        Subscribes `count` new users to the first article of the kind, every subscriber has a push device
+        """
+        article_id = models.Article.objects.filter(text=GENERATED_PREFIX + kind).order_by('id').values_list(
+            'id', flat=True)[0]
+        first = len(self.user_ids)
+        self.users(count)
+        subscriber_ids = self.user_ids[first:]
+        del self.user_ids[first:]
+        copy_rows(models.Subscription._meta.db_table, ('content_type_id', 'object_pk', 'subscriber_id'),
+                  ((self.article_type, article_id, pk) for pk in subscriber_ids))
+        return count + copy_rows(GCMDevice._meta.db_table,
+                                 ('name', 'active', 'date_created', 'registration_id', 'user_id',
+                                  'cloud_message_type'),
+                                 (('generated', True, self.now, 'generated-%s' % pk, pk, 'FCM')
+                                  for pk in subscriber_ids))
+
+    def history(self, comments, length):
+        """
+        Makes the comments with `length` changes each, the history rows are spread over the dates
+        """
+        article_id = self.create_article('history')
+        history_rows = []
+        comment_rows = []
+        for pk in reserve_ids(models.Comment, comments):
+            texts = [self.words.text(20, 80)]
+            for i in range(length):
+                # a small edit at a random place
+                words = texts[-1].split(' ')
+                words[self.random.randrange(len(words))] = self.words.text(1, 3)
+                texts.append(' '.join(words))
+            dates = list(self.get_dates(length + 1))
+            comment_rows.append(self.comment_row(pk, article_id, dates[0], texts[-1]))
+            history_rows.extend((pk, dates[i + 1], self.get_user(), texts[i], texts[i + 1], False, False)
+                                for i in range(length))
+        count = copy_rows(models.Comment._meta.db_table, self.comment_columns, comment_rows)
+        return count + copy_rows(models.History._meta.db_table,
+                                 ('comment_id', 'event_date', 'user_id', 'old_comment', 'new_comment',
+                                  'old_is_removed', 'new_is_removed'), history_rows)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Serializers of the export formats. They write the objects one by one into a stream, the document is opened by
+`write_header` and closed by `write_footer`, so the objects can be written by parts.
+"""
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import csv
+import json
+
+from django.core.serializers import base, python, xml_serializer
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.encoding import force_bytes
+from django.utils.xmlutils import SimplerXMLGenerator
+
+
+class XmlSerializer(xml_serializer.Serializer):
+    extension = 'xml'
+
+    def write_header(self, stream, model):
+        xml = SimplerXMLGenerator(stream, 'utf-8')
+        xml.startDocument()
+        xml.startElement('django-objects', {'version': '1.0'})
+
+    def write_footer(self, stream):
+        stream.write(b'</django-objects>')
+
+    def start_serialization(self):
+        self.xml = SimplerXMLGenerator(self.stream, 'utf-8')
+
+    def end_serialization(self):
+        pass
+
+
+class NdjsonSerializer(python.Serializer):
+    """
+    Writes an object per line in the format of the Django JSON serializer
+    """
+    extension = 'ndjson'
+    internal_use_only = False
+
+    def write_header(self, stream, model):
+        pass
+
+    def write_footer(self, stream):
+        pass
+
+    def end_object(self, obj):
+        data = json.dumps(self.get_dump_object(obj), cls=DjangoJSONEncoder, ensure_ascii=False)
+        self.stream.write(force_bytes(data) + b'\n')
+        self._current = None
+
+
+class CsvSerializer(base.Serializer):
+    """
+    Writes a row per object, the header row holds the field names
+    """
+    extension = 'csv'
+
+    def write_header(self, stream, model):
+        csv.writer(stream).writerow([b'pk'] + [force_bytes(field.name)
+                                               for field in model._meta.concrete_model._meta.local_fields
+                                               if field.serialize])
+
+    def write_footer(self, stream):
+        pass
+
+    def start_serialization(self):
+        self.writer = csv.writer(self.stream)
+
+    def end_serialization(self):
+        pass
+
+    def start_object(self, obj):
+        self._current = [force_bytes(obj.pk)]
+
+    def end_object(self, obj):
+        self.writer.writerow(self._current)
+
+    def handle_field(self, obj, field):
+        value = field.value_from_object(obj)
+        self._current.append(b'' if value is None else force_bytes(field.value_to_string(obj)))
+
+    def handle_fk_field(self, obj, field):
+        value = getattr(obj, field.get_attname())
+        self._current.append(b'' if value is None else force_bytes(value))
+
+    def handle_m2m_field(self, obj, field):
+        pass
+
+
+SERIALIZERS = OrderedDict((serializer.extension, serializer)
+                          for serializer in [XmlSerializer, NdjsonSerializer, CsvSerializer])
@@ -12,4 +12,20 @@ class CommentFilter(django_filters.FilterSet):
 
     class Meta:
         model = models.Comment
-        fields = ['content_type', 'object_pk', 'user', 'date_from', 'date_to']
\ No newline at end of file
+        fields = ['content_type', 'object_pk', 'parent', 'user', 'date_from', 'date_to']
+
+
+class ArchivedCommentFilter(CommentFilter):
+
+    class Meta(CommentFilter.Meta):
+        model = models.ArchivedComment
+
+
+class HistoryFilter(django_filters.FilterSet):
+    # the history is partitioned by months, a date range reads only the partitions of its months
+    date_from = django_filters.DateTimeFilter(name="event_date", lookup_expr='gte')
+    date_to = django_filters.DateTimeFilter(name="event_date", lookup_expr='lt')
+
+    class Meta:
+        model = models.History
+        fields = ['user', 'date_from', 'date_to']
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Compact storage of the comment history. The trigger records the full old and new text of every change, the
+compaction replaces the texts of most of the rows by a diff from the previous version of the comment (the `delta`
+field), and keeps a full row every COMMENTS_HISTORY_SNAPSHOT_INTERVAL rows and at the start of every month, so that
+a history partition never depends on an older one. The texts of the compact rows are rebuilt by `reconstruct`.
+"""
+from __future__ import unicode_literals
+
+from collections import defaultdict
+import difflib
+import json
+import re
+
+from django.conf import settings
+from django.db import connection, transaction
+
+import models
+
+# a word with the following spaces, the spaces alone would be matched everywhere
+WORDS = re.compile(r'\w+\s*|\W\s*', re.UNICODE)
+
+CHAIN_FIELDS = ('id', 'comment_id', 'event_date', 'old_comment', 'new_comment', 'delta')
+
+SQL_COMPACT_ROWS = r"""
+UPDATE {table} h SET old_comment = '', new_comment = '', delta = v.delta
+FROM (VALUES {values}) AS v(id, delta)
+WHERE h.id = v.id AND h.comment_id = %s AND h.delta IS NULL;
+"""
+
+
+def get_snapshot_interval():
+    return getattr(settings, 'COMMENTS_HISTORY_SNAPSHOT_INTERVAL', 20)
+
+
+def get_offsets(words, start):
+    """
+    Returns the positions of the words in the text and the position of its end
+    """
+    offsets = [start]
+    for word in words:
+        offsets.append(offsets[-1] + len(word))
+    return offsets
+
+
+def get_delta(old, new):
+    """
+    Returns the changes turning the old text into the new one as a JSON list of [start, end, replacement]
+    """
+    # an edit usually touches a single place, so the common start and end are cut off before the matching
+    limit = min(len(old), len(new))
+    prefix = 0
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[-suffix - 1] == new[-suffix - 1]:
+        suffix += 1
+    # the rest is matched by words, the matching by characters is too slow on long texts
+    old_words = WORDS.findall(old[prefix:len(old) - suffix])
+    new_words = WORDS.findall(new[prefix:len(new) - suffix])
+    old_offsets = get_offsets(old_words, prefix)
+    new_offsets = get_offsets(new_words, prefix)
+    matcher = difflib.SequenceMatcher(None, old_words, new_words, autojunk=False)
+    changes = [[old_offsets[i1], old_offsets[i2], new[new_offsets[j1]:new_offsets[j2]]]
+               for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+    return json.dumps(changes, ensure_ascii=False, separators=(',', ':'))
+
+
+def apply_delta(text, delta):
+    parts = []
+    position = 0
+    for start, end, replacement in json.loads(delta):
+        parts.append(text[position:start])
+        parts.append(replacement)
+        position = end
+    parts.append(text[position:])
+    return ''.join(parts)
+
+
+def get_chains(comment_ids):
+    """
+    Returns the history rows of the comments by the comment ids in the order of the changes
+    """
+    chains = defaultdict(list)
+    rows = models.History.objects.filter(comment_id__in=comment_ids).order_by(
+        'comment_id', 'event_date', 'id').values(*CHAIN_FIELDS)
+    for row in rows:
+        chains[row['comment_id']].append(row)
+    return chains
+
+
+def get_texts(chain):
+    """
+    Returns the full (old, new) texts of the rows of a chain
+    """
+    texts = []
+    previous = None
+    for row in chain:
+        if row['delta'] is None:
+            old, new = row['old_comment'], row['new_comment']
+        else:
+            old, new = previous, apply_delta(previous, row['delta'])
+        texts.append((old, new))
+        previous = new
+    return texts
+
+
+def reconstruct(histories):
+    """
+    Puts the full texts into the compact History instances, the chains of all of them are read by a single query
+    """
+    compact = [history for history in histories if history.delta is not None]
+    if not compact:
+        return histories
+    texts = {}
+    for chain in get_chains(set(history.comment_id for history in compact)).values():
+        texts.update(zip([row['id'] for row in chain], get_texts(chain)))
+    for history in compact:
+        history.old_comment, history.new_comment = texts[history.id]
+    return histories
+
+
+def get_versions(comment_id):
+    """
+    Returns all the texts the comment has had, from the first one to the current one
+    """
+    texts = get_texts(get_chains([comment_id])[comment_id])
+    return [texts[0][0]] + [new for old, new in texts] if texts else []
+
+
+def compact_comment(comment_id, interval=None):
+    """
+    Replaces the texts of the history rows of the comment by the diffs, returns the number of the compacted rows
+    """
+    interval = interval or get_snapshot_interval()
+    chain = get_chains([comment_id])[comment_id]
+    texts = get_texts(chain)
+    updates = []
+    position, previous_month = 0, None
+    for index, row in enumerate(chain):
+        month = (row['event_date'].year, row['event_date'].month)
+        position = position + 1 if month == previous_month else 0
+        previous_month = month
+        if not position % interval or row['delta'] is not None:
+            continue
+        old, new = texts[index]
+        # the previous change could be lost, then the row stays full
+        if old != texts[index - 1][1]:
+            continue
+        delta = get_delta(old, new)
+        if len(delta) < len(old) + len(new):
+            updates.append((row['id'], delta))
+    if updates:
+        params = []
+        for update in updates:
+            params.extend(update)
+        with connection.cursor() as cursor:
+            cursor.execute(SQL_COMPACT_ROWS.format(table=models.History._meta.db_table,
+                                                   values=', '.join(['(%s, %s)'] * len(updates))),
+                           params + [comment_id])
+    return len(updates)
+
+
+def compact_history(since=None, interval=None):
+    """
+    Compacts the history of the comments changed since the date, returns the number of the compacted rows
+    """
+    histories = models.History.objects.filter(delta__isnull=True)
+    if since is not None:
+        histories = histories.filter(event_date__gte=since)
+    count = 0
+    for comment_id in histories.order_by().values_list('comment_id', flat=True).distinct():
+        with transaction.atomic():
+            count += compact_comment(comment_id, interval)
+    return count
@@ -14,4 +14,7 @@ CREATE TRIGGER comment_history
   AFTER UPDATE
   ON {table_name}
   FOR EACH ROW
+  -- path maintenance updates aren't the comment changes, a move to another parent is
+  WHEN ((OLD.comment, OLD.is_removed, OLD.content_type_id, OLD.object_pk)
+        IS DISTINCT FROM (NEW.comment, NEW.is_removed, NEW.content_type_id, NEW.object_pk))
   EXECUTE PROCEDURE comment_history();
@@ -0,0 +1,23 @@
+CREATE OR REPLACE FUNCTION comment_history_statement()
+  RETURNS trigger AS
+$BODY$
+begin
+  INSERT INTO comments_history(comment_id, event_date, user_id, old_comment, new_comment, old_is_removed, new_is_removed)
+  SELECT n.id, now(), n.changed_by_id, o.comment, n.comment, o.is_removed, n.is_removed
+  FROM old_comments o
+  JOIN new_comments n ON n.id = o.id
+  -- path maintenance updates aren't the comment changes, a move to another parent is
+  WHERE (o.comment, o.is_removed, o.content_type_id, o.object_pk)
+    IS DISTINCT FROM (n.comment, n.is_removed, n.content_type_id, n.object_pk);
+  return NULL;
+end;$BODY$
+  LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS comment_history on {table_name};
+
+CREATE TRIGGER comment_history
+  AFTER UPDATE
+  ON {table_name}
+  REFERENCING OLD TABLE AS old_comments NEW TABLE AS new_comments
+  FOR EACH STATEMENT
+  EXECUTE PROCEDURE comment_history_statement();
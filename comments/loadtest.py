@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+The load tests of the API on a dataset written by the `generate_comments` command. Every scenario drives a view or a
+task in-process the way a client or a worker does, out of a transaction, and is measured by its latency percentiles,
+its queries and its throughput. The results are plain data, so they are written as JSON and compared between runs.
+"""
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import math
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.shortcuts import reverse
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils.http import urlencode
+from mock import patch
+from rest_framework.test import APIClient
+
+from datagen import GENERATED_PREFIX
+import models
+import tasks
+import trees
+
+SCENARIOS = OrderedDict()
+PERCENTILES = (50, 95, 99)
+
+
+def scenario(name):
+    """
+    Registers a function, which takes the targets of the dataset and returns the measured operation, or the operation
+    and the setup run before every call out of the measure
+    """
+    def decorator(func):
+        SCENARIOS[name] = func
+        return func
+    return decorator
+
+
+def percentile(timings, percent):
+    """
+    Returns the value, which `percent` of the sorted timings don't exceed (the nearest rank)
+    """
+    return timings[max(int(math.ceil(percent / 100.0 * len(timings))) - 1, 0)]
+
+
+class Targets(object):
+    """
+    The objects of the generated dataset the scenarios run on
+    """
+
+    def __init__(self):
+        articles = models.Article.objects.filter(text__startswith=GENERATED_PREFIX).order_by('id')
+        kinds = dict((text[len(GENERATED_PREFIX):], pk) for pk, text in articles.values_list('id', 'text').reverse())
+        missing = set(['articles', 'deep', 'wide', 'history']) - set(kinds)
+        if missing:
+            raise ValueError('No generated %s, run the generate_comments command first' % ', '.join(sorted(missing)))
+        self.article_type = ContentType.objects.get_for_model(models.Article).pk
+        self.comment_type = ContentType.objects.get_for_model(models.Comment).pk
+        # the first generated article is the hot one, it has the subscribers
+        self.hot_article = kinds['articles']
+        self.deep_root, self.wide_root = [
+            models.Comment.objects.filter(content_type=self.article_type, object_pk=kinds[kind]).values_list(
+                'id', flat=True)[0] for kind in ('deep', 'wide')]
+        self.user = get_user_model().objects.filter(username__startswith='generated-').order_by('id')[0]
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def get(self, url, params=None):
+        def request():
+            response = self.client.get(url + ('?' + urlencode(params) if params else ''))
+            if response.status_code != 200:
+                raise AssertionError('%s %s' % (response.status_code, url))
+            # a streaming response is read by the client
+            return b''.join(response.streaming_content) if response.streaming else response.content
+        return request
+
+
+@scenario('comments_list')
+def comments_list(targets):
+    return targets.get(reverse('comments:comment-list'), {
+        'content_type': targets.article_type, 'object_pk': targets.hot_article, 'cursor': '', 'limit': 100})
+
+
+@scenario('comments_by_user')
+def comments_by_user(targets):
+    return targets.get(reverse('comments:comment-list'), {'user': targets.user.pk, 'cursor': '', 'limit': 100})
+
+
+@scenario('comments_search')
+def comments_search(targets):
+    text = models.Comment.objects.filter(object_pk=str(targets.hot_article)).values_list('comment', flat=True)[0]
+    return targets.get(reverse('comments:comment-search'), {'q': text.split()[0], 'limit': 20})
+
+
+def child_tree(targets, root_id, **params):
+    url = reverse('comments:child-comments', kwargs={'content_type_id': targets.comment_type, 'object_id': root_id})
+    return targets.get(url, params), trees.get_cache().clear
+
+
+@scenario('tree_deep')
+def tree_deep(targets):
+    # the cache is cleared before every call, so the query is measured
+    return child_tree(targets, targets.deep_root)
+
+
+@scenario('tree_wide')
+def tree_wide(targets):
+    return child_tree(targets, targets.wide_root)
+
+
+@scenario('tree_wide_stream')
+def tree_wide_stream(targets):
+    return child_tree(targets, targets.wide_root, stream=1)
+
+
+@scenario('tree_wide_nested')
+def tree_wide_nested(targets):
+    return child_tree(targets, targets.wide_root, nested=1)
+
+
+@scenario('history')
+def history(targets):
+    return targets.get(reverse('comments:history-list'), {'cursor': '', 'limit': 100})
+
+
+@scenario('export')
+def export(targets):
+    def run():
+        file_id = tasks.export('csv', {'content_type': targets.article_type, 'object_pk': targets.hot_article})
+        export_file = models.File.objects.get(id=file_id)
+        export_file.file.delete(save=False)
+        export_file.delete()
+    return run
+
+
+@scenario('notify')
+def notify(targets):
+    events = [tasks.get_message('insert', 1, targets.article_type, str(targets.hot_article), 'Hi', targets.user.pk,
+                                str(time.time()))] * 10
+
+    def run():
+        # the messages are built and the devices are read, nothing is sent
+        with patch('push_notifications.gcm.send_message'):
+            tasks.notify(events)
+    return run
+
+
+def run_scenario(operation, setup, repeat, warmup):
+    for i in range(warmup):
+        setup()
+        operation()
+    timings, queries, query_times = [], [], []
+    for i in range(repeat):
+        setup()
+        with CaptureQueriesContext(connection) as captured:
+            started = time.time()
+            operation()
+            timings.append(time.time() - started)
+        queries.append(len(captured.captured_queries))
+        query_times.append(sum(float(query['time']) for query in captured.captured_queries))
+    timings.sort()
+    result = OrderedDict(('p%s_ms' % percent, percentile(timings, percent) * 1000) for percent in PERCENTILES)
+    result['mean_ms'] = sum(timings) * 1000 / repeat
+    result['max_ms'] = timings[-1] * 1000
+    result['ops_per_s'] = repeat / sum(timings)
+    result['queries'] = float(sum(queries)) / repeat
+    result['query_ms'] = sum(query_times) * 1000 / repeat
+    return result
+
+
+def run(names=None, repeat=50, warmup=3):
+    """
+    Runs the scenarios, returns their results by name
+    """
+    targets = Targets()
+    results = OrderedDict()
+    # the requests come from the test client
+    with override_settings(ALLOWED_HOSTS=list(settings.ALLOWED_HOSTS) + ['testserver']):
+        for name in names or SCENARIOS:
+            operation = SCENARIOS[name](targets)
+            setup = lambda: None
+            if isinstance(operation, tuple):
+                operation, setup = operation
+            results[name] = run_scenario(operation, setup, repeat, warmup)
+    return results
+
+
+def compare(results, baseline):
+    """
+    Returns the change of every measure of the scenarios run in both, in percent of the baseline
+    """
+    changes = OrderedDict()
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        changes[name] = OrderedDict(
+            (measure, (value - baseline[name][measure]) * 100.0 / baseline[name][measure]
+             if baseline[name].get(measure) else None)
+            for measure, value in result.items())
+    return changes
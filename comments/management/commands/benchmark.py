@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from comments.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = 'Runs the benchmarks and prints their timings. Data created by a benchmark is rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help='Benchmarks to run, all by default: %s' % ', '.join(BENCHMARKS))
+        parser.add_argument('--repeat', type=int, default=20, help='How many times to run each measured operation')
+
+    def handle(self, *args, **options):
+        unknown = set(options['names']) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError('Unknown benchmarks: %s' % ', '.join(sorted(unknown)))
+        for name in options['names'] or BENCHMARKS:
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            with transaction.atomic():
+                results = BENCHMARKS[name](options['repeat'])
+                transaction.set_rollback(True)
+            self.write_table(results)
+
+    def write_table(self, results):
+        if not results:
+            return
+        rows = [list(results[0])]
+        for result in results:
+            rows.append(['%.2f' % value if isinstance(value, float) else '%s' % value for value in result.values()])
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        for row in rows:
+            self.stdout.write('  '.join(cell.rjust(width) for cell, width in zip(row, widths)))
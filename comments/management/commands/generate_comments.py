@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from comments.datagen import Generator
+
+
+class Command(BaseCommand):
+    help = 'Writes a synthetic dataset for the load tests by COPY, see comments/datagen.py. The rows are kept.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000, help='Users writing the comments')
+        parser.add_argument('--articles', type=int, default=1000, help='Articles the comments are spread over')
+        parser.add_argument('--comments', type=int, default=1000000, help='Comments on the articles')
+        parser.add_argument('--depth', type=int, default=499, help='Levels of the deep thread')
+        parser.add_argument('--width', type=int, default=50000, help='Replies of the wide thread')
+        parser.add_argument('--subscribers', type=int, default=10000, help='Subscribers of the hot article')
+        parser.add_argument('--history-chains', type=int, default=1000, help='Comments with a long history')
+        parser.add_argument('--chain-length', type=int, default=200, help='Changes of such a comment')
+        parser.add_argument('--days', type=int, default=365, help='Days the dates are spread over')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the random numbers, same seed, same texts')
+
+    def handle(self, *args, **options):
+        generator = Generator(options['seed'], options['days'])
+        steps = [
+            ('users', lambda: generator.users(options['users'])),
+            ('comments', lambda: generator.comments(options['articles'], options['comments'])),
+            ('deep thread', lambda: generator.thread('deep', options['depth'], 1)),
+            ('wide thread', lambda: generator.thread('wide', 1, options['width'])),
+            ('subscribers', lambda: generator.subscribers(options['subscribers'])),
+            ('history', lambda: generator.history(options['history_chains'], options['chain_length'])),
+        ]
+        for name, step in steps:
+            started = time.time()
+            with transaction.atomic():
+                rows = step()
+            self.stdout.write('%s: %s rows in %.1fs' % (name, rows, time.time() - started))
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
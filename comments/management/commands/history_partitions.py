@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from comments.partitions import maintain_partitions
+
+
+class Command(BaseCommand):
+    help = 'Creates the coming monthly partitions of the comment history and expires the old ones.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, help='Months to create the partitions for in advance')
+        parser.add_argument('--retention', type=int, help='Months to keep, the older partitions are detached')
+        parser.add_argument('--drop', action='store_true', default=None, help='Drop the expired partitions')
+
+    def handle(self, *args, **options):
+        created, expired = maintain_partitions(ahead=options['ahead'], retention=options['retention'],
+                                               drop=options['drop'])
+        for name in created:
+            self.stdout.write('Created %s' % name)
+        for name in expired:
+            self.stdout.write('Expired %s' % name)
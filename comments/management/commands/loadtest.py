@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import json
+import platform
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from comments import loadtest, models
+
+
+class Command(BaseCommand):
+    help = ('Runs the load test scenarios on the dataset of generate_comments and prints the latency percentiles, '
+            'the queries and the throughput. The results can be written as JSON and compared with a previous run.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*',
+                            help='Scenarios to run, all by default: %s' % ', '.join(loadtest.SCENARIOS))
+        parser.add_argument('--repeat', type=int, default=50, help='Measured calls of every scenario')
+        parser.add_argument('--warmup', type=int, default=3, help='Calls before the measured ones')
+        parser.add_argument('--output', help='The JSON file to write the results to')
+        parser.add_argument('--baseline', help='The JSON file of a previous run to compare the results with')
+        parser.add_argument('--max-regression', type=float,
+                            help='Fail if p95 of a scenario grows by more than this percent of the baseline')
+
+    def handle(self, *args, **options):
+        unknown = set(options['names']) - set(loadtest.SCENARIOS)
+        if unknown:
+            raise CommandError('Unknown scenarios: %s' % ', '.join(sorted(unknown)))
+        try:
+            results = loadtest.run(options['names'], options['repeat'], options['warmup'])
+        except ValueError as e:
+            raise CommandError(e)
+        self.write_table([OrderedDict([('scenario', name)] + list(result.items())) for name, result in results.items()])
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(OrderedDict([
+                    ('date', timezone.now().isoformat()),
+                    ('python', platform.python_version()),
+                    ('postgresql', connection.pg_version),
+                    ('comments', models.Comment.objects.count()),
+                    ('repeat', options['repeat']),
+                    ('results', results),
+                ]), output, indent=2)
+
+        if options['baseline']:
+            with open(options['baseline']) as baseline:
+                changes = loadtest.compare(results, json.load(baseline)['results'])
+            self.stdout.write(self.style.MIGRATE_HEADING('change from the baseline, %'))
+            self.write_table([OrderedDict([('scenario', name)] + list(change.items()))
+                              for name, change in changes.items()])
+            limit = options['max_regression']
+            regressed = [name for name, change in changes.items()
+                         if limit is not None and change['p95_ms'] is not None and change['p95_ms'] > limit]
+            if regressed:
+                raise CommandError('p95 regressed by more than %s%%: %s' % (limit, ', '.join(regressed)))
+
+    def write_table(self, results):
+        if not results:
+            return
+        rows = [list(results[0])]
+        for result in results:
+            rows.append(['%.2f' % value if isinstance(value, float) else '%s' % value for value in result.values()])
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        for row in rows:
+            self.stdout.write('  '.join(cell.rjust(width) for cell, width in zip(row, widths)))
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand, CommandError
+
+from comments import metrics
+
+
+class Command(BaseCommand):
+    help = ('Prints the latency, query and task metrics of the servers and the workers in the Prometheus text format. '
+            'The processes add their measures every COMMENTS_METRICS_FLUSH_INTERVAL seconds to '
+            'COMMENTS_METRICS_CACHE, which must be shared by them (not locmem).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Start counting from zero')
+
+    def handle(self, *args, **options):
+        # a locmem cache of the command is never seen by the servers, their metrics are in `comments/metrics/`
+        if isinstance(metrics.get_cache(), LocMemCache):
+            raise CommandError('COMMENTS_METRICS_CACHE is local to every process (locmem), point it to a shared cache '
+                               'or read comments/metrics/ of a server.')
+        self.stdout.write(metrics.render(), ending='')
+        if options['reset']:
+            metrics.reset()
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand
+
+from comments import trees
+
+
+class Command(BaseCommand):
+    help = ('Shows the hit and miss statistics of the child comment tree cache. The statistics are counted in the '
+            'cache, so the servers are seen only when it is shared by the processes (not locmem).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Start counting from zero')
+
+    def handle(self, *args, **options):
+        if isinstance(trees.get_cache(), LocMemCache):
+            self.stderr.write('The tree cache is local to every process (locmem), the reads of the servers '
+                              'aren\'t counted here. Point COMMENTS_TREE_CACHE to a shared cache.')
+        stats = trees.get_stats()
+        reads = stats['hits'] + stats['stale'] + stats['misses']
+        for stat in trees.STATS:
+            self.stdout.write('%-8s %s' % (stat, stats[stat]))
+        self.stdout.write('hit rate %.1f%%' % (100.0 * stats['hits'] / reads if reads else 0))
+        if options['reset']:
+            trees.reset_stats()
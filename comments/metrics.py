@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+The metrics of the requests and the tasks: the latency, the SQL queries and their time of every view and action,
+the queue wait and the runtime of every task. A process adds up its measures in memory and adds them to the
+counters of the cache once per COMMENTS_METRICS_FLUSH_INTERVAL seconds, so a request costs no cache round trip and
+the web servers and the workers sharing the cache are shown together. The times are kept in microseconds, the cache
+adds only integers.
+
+The cache keeps the series known by a slot number each, `render` reads them all and writes them in the Prometheus
+text format.
+"""
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import hashlib
+import itertools
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.backends.utils import CursorDebugWrapper, CursorWrapper
+
+# the upper bounds (seconds) of the buckets of the histograms, the Prometheus client's default
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1, 2.5, 5, 7.5, 10)
+
+# name: type, help, label names
+METRICS = OrderedDict([
+    ('comments_http_request_duration_seconds', ('histogram', 'Time to make the response', ('view', 'action', 'status'))),
+    ('comments_http_queries_total', ('counter', 'SQL queries of the requests', ('view', 'action'))),
+    ('comments_http_query_seconds_total', ('counter', 'Time of the SQL queries of the requests', ('view', 'action'))),
+    ('comments_task_queue_wait_seconds', ('histogram', 'Time from sending a task to its start', ('task',))),
+    ('comments_task_duration_seconds', ('histogram', 'Time to run a task', ('task', 'state'))),
+    ('comments_task_queries_total', ('counter', 'SQL queries of the tasks', ('task',))),
+    ('comments_task_query_seconds_total', ('counter', 'Time of the SQL queries of the tasks', ('task',))),
+])
+
+# the header of a task message with the time it was sent
+SENT_AT_HEADER = 'comments_sent_at'
+
+_lock = threading.Lock()
+# (name, labels): [sum, count, bucket counts...] for a histogram, [sum] for a counter
+_pending = {}
+_registered = set()
+_flushed_at = [0.0]
+_local = threading.local()
+
+
+def get_cache():
+    return caches[getattr(settings, 'COMMENTS_METRICS_CACHE', 'default')]
+
+
+def get_flush_interval():
+    return getattr(settings, 'COMMENTS_METRICS_FLUSH_INTERVAL', 10)
+
+
+def get_buckets():
+    return tuple(getattr(settings, 'COMMENTS_METRICS_BUCKETS', DEFAULT_BUCKETS))
+
+
+def get_allowed_ips():
+    return getattr(settings, 'COMMENTS_METRICS_ALLOWED_IPS', ('127.0.0.1', '::1'))
+
+
+def observe(name, labels, value):
+    """
+    Adds the value (seconds for a histogram) to the metric of the labels
+    """
+    kind = METRICS[name][0]
+    with _lock:
+        key = (name, labels)
+        if kind == 'histogram':
+            buckets = get_buckets()
+            values = _pending.get(key)
+            if values is None:
+                values = _pending[key] = [0] * (len(buckets) + 3)
+            values[0] += value
+            values[1] += 1
+            # the values above the last bound are counted by the +Inf bucket, the last one
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    break
+            else:
+                i = len(buckets)
+            values[i + 2] += 1
+        else:
+            _pending[key] = [_pending.get(key, [0])[0] + value]
+    if time.time() - _flushed_at[0] >= get_flush_interval():
+        flush()
+
+
+def get_key(series, field):
+    return 'comments:metrics:%s:%s' % (hashlib.md5(series.encode('utf-8')).hexdigest(), field)
+
+
+def get_fields(name):
+    if METRICS[name][0] == 'histogram':
+        return ['sum', 'count'] + ['bucket%s' % i for i in range(len(get_buckets()) + 1)]
+    return ['sum']
+
+
+def get_scale(name, field):
+    """
+    Returns the factor of a value in the cache, the times are kept in microseconds
+    """
+    return 1000000 if (field == 'sum' and name.endswith('_seconds')) or name.endswith('_seconds_total') else 1
+
+
+def add(cache, key, delta):
+    cache.add(key, 0, None)
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        # evicted in between
+        cache.add(key, delta, None)
+        return delta
+
+
+def register(cache, series):
+    """
+    Gives the series a slot in the cache unless it has one
+    """
+    if series in _registered:
+        return
+    if cache.add(get_key(series, 'registered'), True, None):
+        slot = add(cache, 'comments:metrics:slots', 1)
+        cache.set('comments:metrics:slot:%s' % slot, series, None)
+    _registered.add(series)
+
+
+def flush():
+    """
+    Adds the measures of the process to the counters of the cache
+    """
+    with _lock:
+        pending = _pending.copy()
+        _pending.clear()
+        _flushed_at[0] = time.time()
+    cache = get_cache()
+    for (name, labels), values in pending.items():
+        series = json.dumps([name, labels])
+        register(cache, series)
+        for field, value in zip(get_fields(name), values):
+            value = int(round(value * get_scale(name, field)))
+            if value:
+                add(cache, get_key(series, field), value)
+
+
+def get_series():
+    """
+    Returns the series in the cache with their values: ((name, labels), {field: value})
+    """
+    cache = get_cache()
+    slots = cache.get('comments:metrics:slots') or 0
+    names = cache.get_many(['comments:metrics:slot:%s' % slot for slot in range(1, slots + 1)])
+    order = list(METRICS)
+    series = sorted(set(names.values()), key=lambda item: (order.index(json.loads(item)[0]), item))
+    keys = [get_key(item, field) for item in series for field in get_fields(json.loads(item)[0])]
+    values = cache.get_many(keys)
+    result = []
+    for item in series:
+        name, labels = json.loads(item)
+        result.append(((name, tuple(labels)), dict(
+            (field, float(values.get(get_key(item, field), 0)) / get_scale(name, field) if get_scale(name, field) > 1
+             else values.get(get_key(item, field), 0)) for field in get_fields(name))))
+    return result
+
+
+def format_labels(names, values, extra=()):
+    labels = list(zip(names, values)) + list(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for name, value in labels)
+
+
+def render():
+    """
+    Returns the metrics in the Prometheus text format
+    """
+    lines = []
+    buckets = get_buckets()
+    for name, series in itertools.groupby(get_series(), lambda item: item[0][0]):
+        kind, description, label_names = METRICS[name]
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for (name, labels), values in series:
+            if kind == 'histogram':
+                # the buckets of the format are cumulative
+                total = 0
+                for i, bound in enumerate(buckets + ('+Inf',)):
+                    total += values['bucket%s' % i]
+                    lines.append('%s_bucket%s %s' % (name, format_labels(label_names, labels, [('le', '%s' % bound)]),
+                                                     total))
+                lines.append('%s_sum%s %s' % (name, format_labels(label_names, labels), values['sum']))
+                lines.append('%s_count%s %s' % (name, format_labels(label_names, labels), values['count']))
+            else:
+                lines.append('%s%s %s' % (name, format_labels(label_names, labels), values['sum']))
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """
+    Removes the metrics from the cache and from the process
+    """
+    cache = get_cache()
+    slots = cache.get('comments:metrics:slots') or 0
+    slot_keys = ['comments:metrics:slot:%s' % slot for slot in range(1, slots + 1)]
+    keys = ['comments:metrics:slots'] + slot_keys
+    for series in cache.get_many(slot_keys).values():
+        keys.extend(get_key(series, field) for field in get_fields(json.loads(series)[0]) + ['registered'])
+    cache.delete_many(keys)
+    with _lock:
+        _pending.clear()
+        _registered.clear()
+
+
+def get_counters():
+    if not hasattr(_local, 'counters'):
+        _local.counters = []
+    return _local.counters
+
+
+class CountingMixin(object):
+    """
+    Adds the queries run by the cursor to the counters started in the thread. Without a counter a query costs a
+    check of the list, the SQL isn't formatted unless a counter keeps the statements.
+    """
+
+    def execute(self, sql, params=None):
+        return self.measure(super(CountingMixin, self).execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self.measure(super(CountingMixin, self).executemany, sql, param_list)
+
+    def measure(self, method, sql, params):
+        counters = get_counters()
+        if not counters:
+            return method(sql, params)
+        started = time.time()
+        try:
+            return method(sql, params)
+        finally:
+            seconds = time.time() - started
+            statement = None
+            for counter in counters:
+                counter.count += 1
+                counter.seconds += seconds
+                if counter.keep_queries:
+                    if statement is None:
+                        statement = self.db.ops.last_executed_query(self.cursor, sql, params)
+                    counter.queries.append((self.db.alias, {'sql': statement, 'time': seconds}))
+
+
+class CountingCursorWrapper(CountingMixin, CursorWrapper):
+    pass
+
+
+class CountingDebugCursorWrapper(CountingMixin, CursorDebugWrapper):
+    pass
+
+
+def connection_created(sender, connection, **kwargs):
+    """
+    Makes the cursors of the connection count the queries, the connection object is kept for the reconnects
+    """
+    if getattr(connection, 'comments_counted', False):
+        return
+    connection.comments_counted = True
+    connection.make_cursor = lambda cursor: CountingCursorWrapper(cursor, connection)
+    connection.make_debug_cursor = lambda cursor: CountingDebugCursorWrapper(cursor, connection)
+
+
+class QueryCounter(object):
+    """
+    Counts the queries of all the databases run by the thread between `start` and `stop` by the cursors of
+    `connection_created`. The statements are kept in `queries` as (database alias, {sql, time}) when `keep_queries`
+    is set, the counting alone doesn't format them.
+    """
+
+    def __init__(self, keep_queries=False):
+        self.keep_queries = keep_queries
+        self.count, self.seconds, self.queries = 0, 0.0, []
+
+    def start(self):
+        get_counters().append(self)
+
+    def stop(self):
+        """
+        Returns the number of the queries and their time
+        """
+        counters = get_counters()
+        if self in counters:
+            counters.remove(self)
+        return self.count, self.seconds
+
+
+def task_published(headers=None, **kwargs):
+    if headers is not None:
+        headers[SENT_AT_HEADER] = time.time()
+
+
+def task_started(task_id=None, task=None, **kwargs):
+    # the headers of a message are the attributes of the request, the ones of the protocol 1 and of `apply` are apart
+    sent_at = getattr(task.request, SENT_AT_HEADER, None) or (task.request.headers or {}).get(SENT_AT_HEADER)
+    # the tasks run eagerly aren't sent
+    if sent_at is not None:
+        observe('comments_task_queue_wait_seconds', (task.name,), max(time.time() - sent_at, 0))
+    if not hasattr(_local, 'tasks'):
+        _local.tasks = {}
+    counter = QueryCounter()
+    counter.start()
+    _local.tasks[task_id] = (time.time(), counter)
+
+
+def task_finished(task_id=None, task=None, state=None, **kwargs):
+    started = getattr(_local, 'tasks', {}).pop(task_id, None)
+    if started is None:
+        return
+    started, counter = started
+    duration = time.time() - started
+    queries, query_seconds = counter.stop()
+    observe('comments_task_duration_seconds', (task.name, state or 'UNKNOWN'), duration)
+    observe('comments_task_queries_total', (task.name,), queries)
+    observe('comments_task_query_seconds_total', (task.name,), query_seconds)
+
+
+def worker_stopping(**kwargs):
+    flush()
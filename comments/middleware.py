@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+
+from rest_framework.permissions import SAFE_METHODS
+
+from comments import metrics, notifications, profiling, routers
+
+
+class NotificationMiddleware(object):
+    """
+    Publishes the comment events committed during a request in a single message after the response is made
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with notifications.batch():
+            return self.get_response(request)
+
+
+class ReplicaMiddleware(object):
+    """
+    Routes the reads of a request to the read replicas, see routers.py. A request of an unsafe method reads
+    the default database and makes the next requests of the user read their own writes.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not routers.get_replicas():
+            return self.get_response(request)
+        writes = request.method not in SAFE_METHODS
+        with routers.reading(request, primary=writes):
+            response = self.get_response(request)
+        if writes:
+            routers.pin(request)
+        return response
+
+
+class MetricsMiddleware(object):
+    """
+    Records the latency and the SQL queries of a request by its view and action, see metrics.py. A streamed
+    response is measured when it's read to the end.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.time()
+        counter = metrics.QueryCounter()
+        counter.start()
+        try:
+            response = self.get_response(request)
+        except Exception:
+            counter.stop()
+            raise
+        if response.streaming:
+            response.streaming_content = self.stream(response.streaming_content, request, response, started, counter)
+        else:
+            self.record(request, response, started, counter)
+        return response
+
+    def stream(self, content, request, response, started, counter):
+        try:
+            for chunk in content:
+                yield chunk
+        finally:
+            self.record(request, response, started, counter)
+
+    def record(self, request, response, started, counter):
+        duration = time.time() - started
+        queries, query_seconds = counter.stop()
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        # a viewset maps the methods to its actions
+        actions = getattr(match.func, 'actions', None) if match else None
+        action = (actions or {}).get(request.method.lower(), request.method.lower())
+        metrics.observe('comments_http_request_duration_seconds', (view, action, '%sxx' % (response.status_code // 100)),
+                        duration)
+        metrics.observe('comments_http_queries_total', (view, action), queries)
+        metrics.observe('comments_http_query_seconds_total', (view, action), query_seconds)
+
+
+class ProfilingMiddleware(object):
+    """
+    Saves the profile of a request asked for by the header or sampled, see profiling.py. The id of the profile is
+    in the X-Comments-Profile-Id header of the response. A streamed response is profiled when it's read to the end.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not profiling.is_requested(request):
+            return self.get_response(request)
+        profiler = profiling.Profiler()
+        profiler.start()
+        try:
+            response = self.get_response(request)
+        except Exception:
+            profiler.stop()
+            raise
+        if response.streaming:
+            response.streaming_content = self.stream(response.streaming_content, request, response, profiler)
+        else:
+            response['X-Comments-Profile-Id'] = profiling.save(request, response, profiler.stop()).pk
+        return response
+
+    def stream(self, content, request, response, profiler):
+        try:
+            for chunk in content:
+                yield chunk
+        finally:
+            profiling.save(request, response, profiler.stop())
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2026-10-18 15:48
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+# The paths are built top down from the comments on other entities. A reply whose parent doesn't exist becomes
+# a root of its own thread.
+SQL_BACKFILL_PATH = r"""
+WITH RECURSIVE comment_type AS (
+  SELECT id FROM django_content_type WHERE app_label = 'comments' AND model = 'comment'
+), tree AS (
+  SELECT c.id, ARRAY[c.id] AS path
+  FROM comments_comment c
+  WHERE c.content_type_id NOT IN (SELECT id FROM comment_type)
+
+  UNION ALL
+
+  SELECT c.id, tree.path || c.id
+  FROM tree
+  JOIN comments_comment c ON c.content_type_id IN (SELECT id FROM comment_type) AND c.object_pk = tree.id::text
+)
+UPDATE comments_comment SET path = tree.path FROM tree WHERE comments_comment.id = tree.id;
+
+UPDATE comments_comment SET path = ARRAY[id] WHERE path IS NULL;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0003_auto_20180425_0002'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='path',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), editable=False, null=True, size=None, verbose_name='path'),
+        ),
+        # the history trigger is recreated by the post migrate signal, the backfill mustn't be recorded as edits
+        migrations.RunSQL('DROP TRIGGER IF EXISTS comment_history ON comments_comment;', migrations.RunSQL.noop),
+        migrations.RunSQL(SQL_BACKFILL_PATH, migrations.RunSQL.noop),
+        migrations.AlterField(
+            model_name='comment',
+            name='path',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), db_index=True, editable=False, size=None, verbose_name='path'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2026-10-18 16:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+SQL_BACKFILL_PARENT = r"""
+UPDATE comments_comment SET parent = path[array_length(path, 1) - 1] WHERE array_length(path, 1) > 1;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0004_comment_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='parent',
+            field=models.IntegerField(blank=True, editable=False, null=True, verbose_name='parent comment'),
+        ),
+        # the history trigger is recreated by the post migrate signal, the backfill mustn't be recorded as edits
+        migrations.RunSQL('DROP TRIGGER IF EXISTS comment_history ON comments_comment;', migrations.RunSQL.noop),
+        migrations.RunSQL(SQL_BACKFILL_PARENT, migrations.RunSQL.noop),
+    ]
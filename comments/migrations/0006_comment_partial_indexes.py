@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2026-10-18 16:05
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def create_index(name, definition):
+    return migrations.RunSQL(
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS %s ON comments_comment %s;' % (name, definition),
+        'DROP INDEX CONCURRENTLY IF EXISTS %s;' % name)
+
+
+class Migration(migrations.Migration):
+    # the indexes are built without locking the table for writes, which can't be done in a transaction
+    atomic = False
+
+    dependencies = [
+        ('comments', '0005_comment_parent'),
+    ]
+
+    operations = [
+        # comments of an entity
+        create_index('comments_comment_thread_idx', '(content_type_id, object_pk, submit_date) WHERE NOT is_removed'),
+        # comments of a user
+        create_index('comments_comment_user_idx', '(user_id, submit_date) WHERE NOT is_removed'),
+        # replies of a comment, removed ones as well since they keep the comment from removal
+        create_index('comments_comment_parent_idx', '(parent, submit_date) WHERE parent IS NOT NULL'),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2026-10-18 16:30
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # the indexes are built without locking the tables for writes, which can't be done in a transaction
+    atomic = False
+
+    dependencies = [
+        ('comments', '0006_comment_partial_indexes'),
+    ]
+
+    operations = [
+        # keyset pagination of the comments and the history
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS comments_comment_keyset_idx ON comments_comment '
+            '(submit_date, id) WHERE NOT is_removed;',
+            'DROP INDEX CONCURRENTLY IF EXISTS comments_comment_keyset_idx;'),
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS comments_history_keyset_idx ON comments_history (event_date, id);',
+            'DROP INDEX CONCURRENTLY IF EXISTS comments_history_keyset_idx;'),
+    ]
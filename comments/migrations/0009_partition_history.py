@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# The rows of every month get into their own partition, a row out of the created partitions gets into the default one.
+# The primary key of a partitioned table has to include the partition key.
+SQL_PARTITION_HISTORY = r"""
+ALTER TABLE comments_history RENAME TO comments_history_unpartitioned;
+CREATE TABLE comments_history (LIKE comments_history_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (event_date);
+ALTER SEQUENCE comments_history_id_seq OWNED BY comments_history.id;
+CREATE TABLE comments_history_default PARTITION OF comments_history DEFAULT;
+
+DO $$
+DECLARE
+  month timestamptz := date_trunc('month', coalesce((SELECT min(event_date) FROM comments_history_unpartitioned),
+                                                    now()));
+BEGIN
+  WHILE month < date_trunc('month', now()) + interval '3 months' LOOP
+    EXECUTE format('CREATE TABLE %I PARTITION OF comments_history FOR VALUES FROM (%L) TO (%L)',
+                   'comments_history_' || to_char(month, '"y"YYYY"m"MM'), month, month + interval '1 month');
+    month := month + interval '1 month';
+  END LOOP;
+END$$;
+
+INSERT INTO comments_history SELECT * FROM comments_history_unpartitioned;
+DROP TABLE comments_history_unpartitioned;
+ALTER TABLE comments_history ADD PRIMARY KEY (id, event_date);
+"""
+
+
+def partition_history(apps, schema_editor):
+    """
+    Replaces the history table by a partitioned one keeping the names of the indexes
+    """
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = 'comments_history'::regclass")
+        if cursor.fetchone()[0] == 'p':
+            # the migration was unapplied, the table stays partitioned
+            return
+        cursor.execute("SELECT indexdef FROM pg_indexes "
+                       "WHERE schemaname = current_schema() AND tablename = 'comments_history' AND indexname NOT IN ("
+                       "  SELECT conname FROM pg_constraint "
+                       "  WHERE conrelid = 'comments_history'::regclass AND contype = 'p')")
+        indexes = [row[0] for row in cursor.fetchall()]
+
+        cursor.execute(SQL_PARTITION_HISTORY)
+        for definition in indexes:
+            cursor.execute(definition)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('comments', '0008_pendingnotification'),
+    ]
+
+    operations = [
+        # Django 1.11 doesn't see a partitioned table, so flushing couldn't truncate the tables it references
+        migrations.AlterField(
+            model_name='history',
+            name='comment',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='history', to='comments.Comment'),
+        ),
+        migrations.AlterField(
+            model_name='history',
+            name='user',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='comment_history', to=settings.AUTH_USER_MODEL, verbose_name='user'),
+        ),
+        # the partitioned table works with the previous migrations as well
+        migrations.RunPython(partition_history, migrations.RunPython.noop),
+    ]
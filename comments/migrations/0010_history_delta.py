@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2026-10-18 16:06
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0009_partition_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='history',
+            name='delta',
+            field=models.TextField(blank=True, editable=False, null=True, verbose_name='delta'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2026-10-18 16:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# The counters of the existing comments, the triggers keep them up to date from then on (see counters.sql)
+SQL_FILL_COUNTERS = r"""
+INSERT INTO comments_counter (content_type_id, object_pk, shard, reply_count, last_activity)
+SELECT content_type_id, object_pk, 0, count(*) FILTER (WHERE NOT is_removed), max(submit_date)
+FROM comments_comment
+GROUP BY content_type_id, object_pk;
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('comments', '0010_history_delta'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Counter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_pk', models.TextField(verbose_name='object ID')),
+                ('shard', models.SmallIntegerField(verbose_name='shard')),
+                ('reply_count', models.IntegerField(default=0, verbose_name='reply count')),
+                ('last_activity', models.DateTimeField(blank=True, null=True, verbose_name='last activity')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType', verbose_name='content type')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='counter',
+            unique_together=set([('content_type', 'object_pk', 'shard')]),
+        ),
+        migrations.RunSQL(SQL_FILL_COUNTERS, migrations.RunSQL.noop),
+    ]
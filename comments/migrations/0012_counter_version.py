@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2026-10-18 16:25
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0011_counter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='counter',
+            name='last_modified',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='last modified'),
+        ),
+        migrations.AddField(
+            model_name='counter',
+            name='version',
+            field=models.BigIntegerField(default=0, verbose_name='version'),
+        ),
+    ]
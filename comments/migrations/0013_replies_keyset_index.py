@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # the index is built without locking the table for writes, which can't be done in a transaction
+    atomic = False
+
+    dependencies = [
+        ('comments', '0012_counter_version'),
+    ]
+
+    operations = [
+        # the first replies of a comment in the keyset order, the nested tree reads a few of them for every node
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS comments_comment_replies_keyset_idx ON comments_comment '
+            '(parent, submit_date, id) WHERE parent IS NOT NULL AND NOT is_removed;',
+            'DROP INDEX CONCURRENTLY IF EXISTS comments_comment_replies_keyset_idx;'),
+    ]
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# The search vector of a comment is kept by the trigger, it isn't a field of the model, so the ORM never reads it
+SQL_ADD_SEARCH_VECTOR = r"""
+ALTER TABLE comments_comment ADD COLUMN IF NOT EXISTS search_vector tsvector;
+
+DROP TRIGGER IF EXISTS comment_search_vector ON comments_comment;
+CREATE TRIGGER comment_search_vector
+  BEFORE INSERT OR UPDATE OF comment
+  ON comments_comment
+  FOR EACH ROW
+  EXECUTE PROCEDURE tsvector_update_trigger(search_vector, 'pg_catalog.english', comment);
+"""
+
+SQL_DROP_SEARCH_VECTOR = r"""
+DROP TRIGGER IF EXISTS comment_search_vector ON comments_comment;
+ALTER TABLE comments_comment DROP COLUMN IF EXISTS search_vector;
+"""
+
+# a batch of the comments written before the trigger, every batch is committed on its own
+SQL_BATCH_END = 'SELECT max(id) FROM (SELECT id FROM comments_comment WHERE id > %s ORDER BY id LIMIT 10000) batch'
+
+SQL_FILL_SEARCH_VECTOR = r"""
+UPDATE comments_comment SET search_vector = to_tsvector('pg_catalog.english', comment)
+WHERE id > %s AND id <= %s AND search_vector IS NULL
+"""
+
+
+def fill_search_vector(apps, schema_editor):
+    last_id = 0
+    with schema_editor.connection.cursor() as cursor:
+        while True:
+            cursor.execute(SQL_BATCH_END, [last_id])
+            batch_end = cursor.fetchone()[0]
+            if batch_end is None:
+                break
+            cursor.execute(SQL_FILL_SEARCH_VECTOR, [last_id, batch_end])
+            last_id = batch_end
+
+
+class Migration(migrations.Migration):
+    # the comments are filled and indexed without locking the table for long, which can't be done in a transaction
+    atomic = False
+
+    dependencies = [
+        ('comments', '0013_replies_keyset_index'),
+    ]
+
+    operations = [
+        migrations.RunSQL(SQL_ADD_SEARCH_VECTOR, SQL_DROP_SEARCH_VECTOR),
+        migrations.RunPython(fill_search_vector, migrations.RunPython.noop),
+        # full-text search of the comments, see search.py
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS comments_comment_search_idx ON comments_comment '
+            'USING gin (search_vector) WHERE NOT is_removed;',
+            'DROP INDEX CONCURRENTLY IF EXISTS comments_comment_search_idx;'),
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2026-10-18 16:55
+from __future__ import unicode_literals
+
+from django.conf import settings
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('comments', '0014_comment_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Profile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='date/time profiled')),
+                ('method', models.CharField(max_length=10, verbose_name='method')),
+                ('path', models.TextField(verbose_name='path')),
+                ('view', models.CharField(blank=True, max_length=200, verbose_name='view')),
+                ('status', models.PositiveSmallIntegerField(verbose_name='status')),
+                ('duration', models.FloatField(verbose_name='duration, s')),
+                ('query_count', models.IntegerField(verbose_name='queries')),
+                ('query_time', models.FloatField(verbose_name='query time, s')),
+                ('serializer_time', models.FloatField(verbose_name='serializer time, s')),
+                ('queries', django.contrib.postgres.fields.jsonb.JSONField(default=list, verbose_name='statements')),
+                ('python_profile', models.TextField(blank=True, verbose_name='python profile')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='user')),
+            ],
+            options={
+                'ordering': ('-date',),
+                'verbose_name': 'profile',
+                'verbose_name_plural': 'profiles',
+            },
+        ),
+    ]
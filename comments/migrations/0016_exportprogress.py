@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2026-10-18 16:57
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0015_profile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportProgress',
+            fields=[
+                ('task_id', models.CharField(max_length=255, primary_key=True, serialize=False, verbose_name='task id')),
+                ('state', models.CharField(max_length=20, verbose_name='state')),
+                ('rows', models.BigIntegerField(default=0, verbose_name='rows exported')),
+                ('error', models.TextField(blank=True, verbose_name='error')),
+                ('updated', models.DateTimeField(db_index=True, verbose_name='date/time updated')),
+                ('file', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='comments.File', verbose_name='file')),
+            ],
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2026-10-18 17:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0016_exportprogress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportprogress',
+            name='key',
+            field=models.CharField(blank=True, db_index=True, max_length=64, verbose_name='key'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2026-10-18 17:03
+from __future__ import unicode_literals
+
+from django.conf import settings
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('comments', '0017_exportprogress_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedComment',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False, verbose_name='id')),
+                ('object_pk', models.TextField(verbose_name='object ID')),
+                ('comment', models.TextField(max_length=3000, verbose_name='comment')),
+                ('submit_date', models.DateTimeField(verbose_name='date/time submitted')),
+                ('is_removed', models.BooleanField(default=False, verbose_name='is removed')),
+                ('path', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), db_index=True, editable=False, size=None, verbose_name='path')),
+                ('parent', models.IntegerField(blank=True, db_index=True, editable=False, null=True, verbose_name='parent comment')),
+                ('archived_at', models.DateTimeField(db_index=True, verbose_name='date/time archived')),
+                ('reason', models.CharField(max_length=10, verbose_name='reason')),
+                ('changed_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='user changed by')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='contenttypes.ContentType', verbose_name='content type')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='user added by')),
+            ],
+            options={
+                'ordering': ('submit_date',),
+                'verbose_name': 'archived comment',
+                'verbose_name_plural': 'archived comments',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='archivedcomment',
+            index_together=set([('content_type', 'object_pk', 'submit_date')]),
+        ),
+    ]
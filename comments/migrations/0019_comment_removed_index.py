@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # the index is built without locking the table for writes, which can't be done in a transaction
+    atomic = False
+
+    dependencies = [
+        ('comments', '0018_archivedcomment'),
+    ]
+
+    operations = [
+        # the removed comments in the order they're archived, a small part of the table
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS comments_comment_removed_idx ON comments_comment (id) '
+            'WHERE is_removed;',
+            'DROP INDEX CONCURRENTLY IF EXISTS comments_comment_removed_idx;'),
+    ]
@@ -3,18 +3,41 @@ from __future__ import unicode_literals
 
 import uuid
 
-from django.db import models
+from django.db import models, connections, router
 from django.conf import settings
+from django.contrib.postgres.fields import ArrayField, JSONField
 from django.core.exceptions import ValidationError
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext_lazy as _
-from django.utils import timezone
+from django.utils.encoding import force_text
 
-from comments import tasks
+from comments import archive, counters, notifications, trees
 
 
 MAX_COMMENT_SIZE = 3000
+# a path is stored in a btree index, whose entries are limited by a third of a page
+MAX_THREAD_DEPTH = 500
+# the number of items of a kind in a bulk request
+MAX_BULK_SIZE = 1000
+
+
+def reserve_ids(model, count, using=None):
+    """
+    Takes `count` values from the primary key sequence of the model, so ids of rows are known before they get inserted
+    """
+    using = using or router.db_for_write(model)
+    with connections[using].cursor() as cursor:
+        cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)",
+                       [model._meta.db_table, model._meta.pk.column, count])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def path_end(path):
+    """
+    Returns the exclusive upper bound of the subtree starting at `path`
+    """
+    return path[:-1] + [path[-1] + 1]
 
 
 class Article(models.Model):
@@ -44,6 +67,11 @@ class Comment(models.Model):
                                      help_text=_('Check this box if the comment is inappropriate. '
                                                  'A "This comment has been removed" message will '
                                                  'be displayed instead.'))
+    # the materialized path: ids of the ancestor comments followed by the comment id. A thread is sorted by the path
+    # so that a whole subtree is a single range scan over the index, see `path_end`
+    path = ArrayField(models.IntegerField(), verbose_name=_('path'), editable=False, db_index=True)
+    # the comment replied to, a typed copy of object_pk for the replies
+    parent = models.IntegerField(_('parent comment'), blank=True, null=True, editable=False)
 
     class Meta:
         ordering = ('submit_date',)
@@ -57,6 +85,7 @@ class Comment(models.Model):
         super(Comment, self).__init__(*args, **kwargs)
         self._old_is_removed = self.is_removed
         self._old_comment = self.comment
+        self._old_parent = (self.content_type_id, force_text(self.object_pk))
 
     def clean(self):
         if self.pk is None and self.is_removed:
@@ -65,32 +94,111 @@ class Comment(models.Model):
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None):
         is_new = self.pk is None
+        using = using or router.db_for_write(self.__class__, instance=self)
+        old_path, old_parent = self.path, self._old_parent
+        if is_new:
+            self.restore_threads(using)
+            # the id is a part of the path, so it is taken before the insert
+            self.id = reserve_ids(Comment, 1, using)[0]
+            self.path = self.get_parent_path() + [self.id]
+            self.parent = int(self.object_pk) if self.is_reply() else None
+            force_insert = True
+        elif self._old_parent != (self.content_type_id, force_text(self.object_pk)):
+            self.move()
+            self.parent = int(self.object_pk) if self.is_reply() else None
+            if update_fields is not None:
+                update_fields = list(update_fields) + ['path', 'parent']
         super(Comment, self).save(force_insert, force_update, using, update_fields)
-        if self._old_is_removed != self.is_removed or self._old_comment != self.comment:
+        self._old_parent = (self.content_type_id, force_text(self.object_pk))
+        changed = is_new or self._old_is_removed != self.is_removed or self._old_comment != self.comment
+        if old_parent != self._old_parent and not is_new:
+            # the trees of the old place of the comment are changed as well
+            trees.invalidate([old_path, self.path], [old_parent], using)
+        elif changed:
+            trees.invalidate([self.path], using=using)
+        if changed:
             if is_new:
                 action = 'insert'
             elif self._old_is_removed != self.is_removed:
                 action = 'delete' if self.is_removed else 'recover'
             else:
                 action = 'update'
-            tasks.notify.delay(action, self.id, self.content_type.pk, self.object_pk, self.comment, self.user_id,
-                               timezone.now())
+            notifications.dispatch(action, self, using)
+            self._old_is_removed = self.is_removed
+            self._old_comment = self.comment
+
+    def is_reply(self):
+        return self.content_type_id == ContentType.objects.get_for_model(Comment).pk
+
+    def restore_threads(self, using):
+        """
+        Brings the dormant threads of the entity commented back from the archive. An entity without them costs a
+        lookup of the archive index.
+        """
+        if self.is_reply() or not ArchivedComment.objects.using(using).filter(
+                content_type_id=self.content_type_id, object_pk=force_text(self.object_pk)).exists():
+            return
+        archive.restore(entities=[(self.content_type_id, self.object_pk)])
+
+    def get_parent_path(self):
+        if not self.is_reply():
+            return []
+        try:
+            path = list(Comment.objects.values_list('path', flat=True).get(pk=self.object_pk))
+        except Comment.DoesNotExist:
+            # a reply to an archived comment brings its thread back
+            if not archive.restore([int(self.object_pk)]):
+                raise
+            path = list(Comment.objects.values_list('path', flat=True).get(pk=self.object_pk))
+        if len(path) >= MAX_THREAD_DEPTH:
+            raise ValidationError("The thread is too deep.")
+        return path
+
+    def move(self):
+        """
+        Rebuilds the path of the comment and its replies after the comment got a new parent
+        """
+        using = router.db_for_write(Comment, instance=self)
+        # the comment joins the thread of its new entity, archived or not
+        self.restore_threads(using)
+        parent_path = self.get_parent_path()
+        if self.id in parent_path:
+            raise ValidationError("A comment can't become a reply to its own reply.")
+        old_path = self.path
+        self.path = parent_path + [self.id]
+        with connections[using].cursor() as cursor:
+            cursor.execute("UPDATE {table} SET path = %s || path[%s:] "
+                           "WHERE path > %s AND path < %s".format(table=Comment._meta.db_table),
+                           [self.path, len(old_path) + 1, old_path, path_end(old_path)])
+
+    def get_counters(self):
+        """
+        Returns the number of the replies, which aren't removed, and the date of the last activity on the comment.
+        A comment of `counters.annotate_comments` has them already.
+        """
+        if not hasattr(self, 'reply_count'):
+            reply_count, last_activity = counters.get_counters(
+                ContentType.objects.get_for_model(Comment).pk, [self.id])[force_text(self.id)]
+            self.reply_count, self.last_activity = reply_count, last_activity or self.submit_date
+        return self.reply_count, self.last_activity
 
     def is_deletable(self):
-        return not Comment.objects.filter(
-            object_pk=self.id, content_type=ContentType.objects.get_for_model(Comment)).exists()
+        return not self.get_counters()[0]
 
 
 class History(models.Model):
-    comment = models.ForeignKey(Comment, models.CASCADE, 'history')
+    # the table is partitioned (see partitions.py), the references are kept by the ORM, see migration 0009
+    comment = models.ForeignKey(Comment, models.CASCADE, 'history', db_constraint=False)
     event_date = models.DateTimeField(_('date/time happened'), db_index=True)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_('user'),
                              related_name="comment_history", blank=True, null=True,
-                             on_delete=models.CASCADE)
+                             on_delete=models.CASCADE, db_constraint=False)
     old_comment = models.TextField(_('old comment'), max_length=MAX_COMMENT_SIZE, blank=True)
     new_comment = models.TextField(_('comment'), max_length=MAX_COMMENT_SIZE, blank=True)
     old_is_removed = models.BooleanField(db_index=True)
     new_is_removed = models.BooleanField(db_index=True)
+    # the diff from the previous version, which replaces the texts of a compacted row, see history.py
+    delta = models.TextField(_('delta'), blank=True, null=True, editable=False)
 
     class Meta:
         ordering = ('event_date',)
@@ -115,8 +223,110 @@ class Subscription(models.Model):
         verbose_name_plural = _('subscriptions')
 
 
+class PendingNotification(models.Model):
+    """
+    An event waiting to be sent together with the other events of the commented entity, see `notifications`
+    """
+    content_type = models.ForeignKey(ContentType, verbose_name=_('content type'), on_delete=models.CASCADE)
+    object_pk = models.TextField(_('object ID'))
+    event = models.TextField(_('event'))
+
+    class Meta:
+        index_together = [('content_type', 'object_pk')]
+
+
+class Counter(models.Model):
+    """
+    A shard of the counters of the comments on an entity, which is a comment itself for the replies.
+    The counters are maintained by the triggers of counters.sql, the shards are summed up when read.
+    """
+    content_type = models.ForeignKey(ContentType, verbose_name=_('content type'), on_delete=models.CASCADE)
+    object_pk = models.TextField(_('object ID'))
+    shard = models.SmallIntegerField(_('shard'))
+    reply_count = models.IntegerField(_('reply count'), default=0)
+    last_activity = models.DateTimeField(_('last activity'), blank=True, null=True)
+    # the changes of all the comments of the thread starting at the entity, they make the ETag of the thread
+    version = models.BigIntegerField(_('version'), default=0)
+    last_modified = models.DateTimeField(_('last modified'), blank=True, null=True)
+
+    class Meta:
+        unique_together = [('content_type', 'object_pk', 'shard')]
+
+
 class File(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     file = models.FileField(null=True, blank=True)
     # The field is to collect and remove old files by celery task, for example
     add_date = models.DateTimeField(_('date/time added'), auto_now_add=True, db_index=True)
+
+
+class ExportProgress(models.Model):
+    """
+    The state of an export task and the rows it has exported, reported by the task, see `progress`
+    """
+    task_id = models.CharField(_('task id'), max_length=255, primary_key=True)
+    state = models.CharField(_('state'), max_length=20)
+    rows = models.BigIntegerField(_('rows exported'), default=0)
+    file = models.ForeignKey(File, verbose_name=_('file'), blank=True, null=True, on_delete=models.SET_NULL)
+    error = models.TextField(_('error'), blank=True)
+    updated = models.DateTimeField(_('date/time updated'), db_index=True)
+    # the format, the filter params and the data watermark, an export of the same key is reused
+    key = models.CharField(_('key'), max_length=64, blank=True, db_index=True)
+
+
+class Profile(models.Model):
+    """
+    The SQL statements and the Python profile of a request, see `profiling`
+    """
+    date = models.DateTimeField(_('date/time profiled'), auto_now_add=True, db_index=True)
+    method = models.CharField(_('method'), max_length=10)
+    path = models.TextField(_('path'))
+    view = models.CharField(_('view'), max_length=200, blank=True)
+    status = models.PositiveSmallIntegerField(_('status'))
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_('user'), related_name='+', blank=True,
+                             null=True, on_delete=models.SET_NULL)
+    duration = models.FloatField(_('duration, s'))
+    query_count = models.IntegerField(_('queries'))
+    query_time = models.FloatField(_('query time, s'))
+    serializer_time = models.FloatField(_('serializer time, s'))
+    # [{database, sql, time, explain}], the slowest statements are explained
+    queries = JSONField(_('statements'), default=list)
+    python_profile = models.TextField(_('python profile'), blank=True)
+
+    class Meta:
+        ordering = ('-date',)
+        verbose_name = _('profile')
+        verbose_name_plural = _('profiles')
+
+
+class ArchivedComment(models.Model):
+    """
+    A removed comment or a comment of a dormant thread moved out of the comments table, see `archive`.
+    The id is the one the comment had, so its history and its replies still refer to it.
+    """
+    id = models.IntegerField(_('id'), primary_key=True)
+    content_type = models.ForeignKey(ContentType, verbose_name=_('content type'), related_name='+',
+                                     on_delete=models.CASCADE)
+    object_pk = models.TextField(_('object ID'))
+    content_object = GenericForeignKey(ct_field="content_type", fk_field="object_pk")
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_('user added by'), related_name='+',
+                             on_delete=models.CASCADE)
+    changed_by = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_('user changed by'), related_name='+',
+                                   blank=True, null=True, on_delete=models.SET_NULL)
+    comment = models.TextField(_('comment'), max_length=MAX_COMMENT_SIZE)
+    submit_date = models.DateTimeField(_('date/time submitted'))
+    is_removed = models.BooleanField(_('is removed'), default=False)
+    path = ArrayField(models.IntegerField(), verbose_name=_('path'), editable=False, db_index=True)
+    parent = models.IntegerField(_('parent comment'), blank=True, null=True, editable=False, db_index=True)
+    archived_at = models.DateTimeField(_('date/time archived'), db_index=True)
+    # why the comment was archived: 'removed' or 'dormant'
+    reason = models.CharField(_('reason'), max_length=10)
+
+    class Meta:
+        ordering = ('submit_date',)
+        index_together = [('content_type', 'object_pk', 'submit_date')]
+        verbose_name = _('archived comment')
+        verbose_name_plural = _('archived comments')
+
+    def __unicode__(self):
+        return self.comment[:50]
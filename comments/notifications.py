@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Dispatching of the comment events to the subscribers.
+
+An event is published when the transaction which made it gets committed, the events of a rolled back transaction
+are dropped. The events committed inside a `batch` (the NotificationMiddleware opens one per request) are published
+together in a single message when the batch ends.
+
+When COMMENTS_NOTIFY_COALESCE_WINDOW is set, the events are collected per commented entity in the
+PendingNotification table instead, and the first event of an entity schedules a task, which sends all the events
+collected during the window in a single message. The window is opened in the default cache, so the cache should be
+shared by all the processes, a per process one (locmem) makes every process send its own message.
+"""
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+import json
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from django.utils.encoding import force_text
+
+from comments import tasks
+
+_local = threading.local()
+
+
+def get_window():
+    return getattr(settings, 'COMMENTS_NOTIFY_COALESCE_WINDOW', 0)
+
+
+def get_window_key(content_type_id, object_pk):
+    return 'comments:notify-window:%s:%s' % (content_type_id, object_pk)
+
+
+def get_batches():
+    if not hasattr(_local, 'batches'):
+        _local.batches = []
+    return _local.batches
+
+
+@contextmanager
+def batch():
+    """
+    Collects the events committed inside the block and publishes them in a single message at its end.
+    A nested batch is a part of the outer one.
+    """
+    batches = get_batches()
+    events = []
+    batches.append(events)
+    try:
+        yield events
+    finally:
+        batches.pop()
+        collect(events)
+
+
+def publish(events):
+    if events:
+        tasks.notify.delay(events)
+
+
+def collect(events):
+    batches = get_batches()
+    if batches:
+        batches[-1].extend(events)
+    else:
+        publish(events)
+
+
+def open_windows(entities, window):
+    for content_type_id, object_pk in entities:
+        # the first event of the window schedules the sending
+        if cache.add(get_window_key(content_type_id, object_pk), True, window):
+            tasks.flush_notifications.apply_async((content_type_id, object_pk), countdown=window)
+
+
+def dispatch(action, comment, using=None):
+    dispatch_many(action, [comment], using)
+
+
+def dispatch_many(action, comments, using=None):
+    """
+    Dispatches the same action made on several comments, the bulk operations use it
+    """
+    event_date = str(timezone.now())
+    events = [tasks.get_message(action, comment.id, comment.content_type_id, force_text(comment.object_pk),
+                                comment.comment, comment.user_id, event_date) for comment in comments]
+    if not events:
+        return
+    window = get_window()
+    if not window:
+        transaction.on_commit(lambda: collect(events), using)
+        return
+
+    from models import PendingNotification
+    PendingNotification.objects.using(using).bulk_create([
+        PendingNotification(content_type_id=event['content_type'], object_pk=event['object_pk'],
+                            event=json.dumps(event))
+        for event in events])
+    entities = set((event['content_type'], event['object_pk']) for event in events)
+    transaction.on_commit(lambda: open_windows(entities, window), using)
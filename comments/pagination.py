@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+import json
+
+from django.db.models import Q
+from django.utils.encoding import force_text
+from django.utils.translation import ugettext_lazy as _
+from rest_framework.compat import coreapi, coreschema
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+def keyset_filter(ordering, values):
+    """
+    Returns a condition selecting rows which follow the key `values` in the `ordering`,
+    i.e. (a, b) > (1, 2) is a > 1 OR a = 1 AND b > 2
+    """
+    condition = Q()
+    for i, (field, value) in enumerate(zip(ordering, values)):
+        lookup = '%s__lt' if field.startswith('-') else '%s__gt'
+        preceding = dict((name.lstrip('-'), preceding_value) for name, preceding_value in zip(ordering, values[:i]))
+        condition |= Q(**dict(preceding, **{lookup % field.lstrip('-'): value}))
+    # the redundant bound on the first field lets the database use an index range scan
+    first = ordering[0]
+    lookup = '%s__lte' if first.startswith('-') else '%s__gte'
+    return Q(**{lookup % first.lstrip('-'): values[0]}) & condition
+
+
+def get_key(instance, ordering):
+    fields = [field.lstrip('-') for field in ordering]
+    if isinstance(instance, dict):
+        return [instance[field] for field in fields]
+    return [getattr(instance, field) for field in fields]
+
+
+def encode_key(key):
+    values = [value.isoformat() if hasattr(value, 'isoformat') else value for value in key]
+    return urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def get_key_field(model, name, annotations):
+    if name in annotations:
+        return annotations[name].output_field
+    return model._meta.get_field(name)
+
+
+def decode_key(encoded, model, ordering, annotations=None):
+    """
+    Returns the key encoded by `encode_key`, raises an exception if it isn't a key of the ordering.
+    The ordering can include the annotations of the queryset.
+    """
+    values = json.loads(urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+    if len(values) != len(ordering):
+        raise ValueError
+    return [get_key_field(model, field.lstrip('-'), annotations or {}).to_python(value)
+            for field, value in zip(ordering, values)]
+
+
+def merge_pages(pages, ordering):
+    """
+    Returns the rows of the pages sorted by the ordering as a single list
+    """
+    rows = [row for page in pages for row in page]
+    # the sort is stable, so the rows sorted by every field from the last one are sorted by all of them
+    for field in reversed(ordering):
+        rows.sort(key=lambda row: get_key(row, [field])[0], reverse=field.startswith('-'))
+    return rows
+
+
+class KeysetPagination(LimitOffsetPagination):
+    """
+    Limit/offset pagination, which switches to keyset pagination when the `cursor` query param is given
+    (an empty value means the first page). For example:
+
+    http://api.example.org/comments/?cursor=
+    http://api.example.org/comments/?cursor=WyIyMDE4LTA0LTI1VDAwOjAyOjAwWiIsIDEwMF0=&limit=100
+
+    A keyset page is selected by the key of the last row of the previous page using the view's `keyset_ordering`,
+    so the database doesn't scan the skipped rows, the pages don't count the rows, and new rows don't shift them.
+    """
+    cursor_query_param = 'cursor'
+    cursor_query_description = _('The pagination cursor value, empty for the first page.')
+    invalid_cursor_message = _('Invalid cursor')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param not in request.query_params:
+            self.keyset = False
+            return super(KeysetPagination, self).paginate_queryset(queryset, request, view)
+
+        self.keyset = True
+        self.request = request
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+        ordering = view.keyset_ordering
+        key = self.decode_cursor(request, queryset, ordering)
+        if key is not None:
+            queryset = queryset.filter(keyset_filter(ordering, key))
+        page = list(queryset.order_by(*ordering)[:self.limit + 1])
+        self.next_key = get_key(page[self.limit - 1], ordering) if len(page) > self.limit else None
+        return page[:self.limit]
+
+    def paginate_querysets(self, querysets, request, view=None):
+        """
+        Paginates the rows of the querysets, e.g. of the comments and of the archived ones, as a single list sorted by
+        the view's `keyset_ordering`. A page reads a page of every queryset at most, the offset ones read the rows
+        skipped as well.
+        """
+        ordering = view.keyset_ordering
+        self.request = request
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+        if self.cursor_query_param not in request.query_params:
+            self.keyset = False
+            self.count = sum(self.get_count(queryset) for queryset in querysets)
+            self.offset = self.get_offset(request)
+            if self.count > self.limit and self.template is not None:
+                self.display_page_controls = True
+            end = self.offset + self.limit
+            return merge_pages([queryset.order_by(*ordering)[:end] for queryset in querysets],
+                               ordering)[self.offset:end]
+
+        self.keyset = True
+        key = self.decode_cursor(request, querysets[0], ordering)
+        if key is not None:
+            querysets = [queryset.filter(keyset_filter(ordering, key)) for queryset in querysets]
+        page = merge_pages([queryset.order_by(*ordering)[:self.limit + 1] for queryset in querysets], ordering)
+        self.next_key = get_key(page[self.limit - 1], ordering) if len(page) > self.limit else None
+        return page[:self.limit]
+
+    def decode_cursor(self, request, queryset, ordering):
+        encoded = request.query_params[self.cursor_query_param]
+        if not encoded:
+            return None
+        try:
+            return decode_key(encoded, queryset.model, ordering, queryset.query.annotations)
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, key):
+        return encode_key(key)
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super(KeysetPagination, self).get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super(KeysetPagination, self).get_next_link()
+        if self.next_key is None:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), self.offset_query_param)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_key))
+
+    def get_previous_link(self):
+        if not self.keyset:
+            return super(KeysetPagination, self).get_previous_link()
+        return None
+
+    def get_html_context(self):
+        if not self.keyset:
+            return super(KeysetPagination, self).get_html_context()
+        return {'previous_url': None, 'next_url': self.get_next_link()}
+
+    def get_schema_fields(self, view):
+        fields = super(KeysetPagination, self).get_schema_fields(view)
+        return fields + [
+            coreapi.Field(
+                name=self.cursor_query_param,
+                required=False,
+                location='query',
+                schema=coreschema.String(
+                    title='Cursor',
+                    description=force_text(self.cursor_query_description)
+                )
+            )
+        ]
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Maintenance of the monthly partitions of the history table (see migration 0009). The partitions of the coming months
+are created in advance, the ones older than the retention period are detached (kept as plain tables to be archived)
+or dropped.
+"""
+from __future__ import unicode_literals
+
+from datetime import datetime
+import re
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+import models
+
+PARTITION_NAME = re.compile(r'_y(\d{4})m(\d{2})$')
+
+
+def get_table():
+    return models.History._meta.db_table
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def get_month(date):
+    return datetime(date.year, date.month, 1, tzinfo=timezone.utc)
+
+
+def get_partition_name(month):
+    return '%s_y%04dm%02d' % (get_table(), month.year, month.month)
+
+
+def get_partitions():
+    """
+    Returns the months of the monthly partitions by their names
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                       "WHERE i.inhparent = %s::regclass", [get_table()])
+        names = [row[0] for row in cursor.fetchall()]
+    partitions = {}
+    for name in names:
+        match = PARTITION_NAME.search(name)
+        if match:
+            partitions[name] = datetime(int(match.group(1)), int(match.group(2)), 1, tzinfo=timezone.utc)
+    return partitions
+
+
+def create_partition(month):
+    """
+    Creates the partition of the month. The rows of the month, which got into the default partition, are moved to it.
+    """
+    name = get_partition_name(month)
+    table = get_table()
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS)'.format(name=name, table=table))
+        cursor.execute('WITH moved AS (DELETE FROM {table}_default WHERE event_date >= %s AND event_date < %s '
+                       'RETURNING *) INSERT INTO {name} SELECT * FROM moved'.format(name=name, table=table),
+                       [month, add_months(month, 1)])
+        cursor.execute('ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)'.format(
+            name=name, table=table), [month, add_months(month, 1)])
+    return name
+
+
+def expire_partition(name, drop):
+    with connection.cursor() as cursor:
+        cursor.execute('ALTER TABLE {table} DETACH PARTITION {name}'.format(name=name, table=get_table()))
+        if drop:
+            cursor.execute('DROP TABLE {name}'.format(name=name))
+
+
+def maintain_partitions(now=None, ahead=None, retention=None, drop=None):
+    """
+    Creates the partitions of the current month and `ahead` next ones, expires the partitions of the months before
+    the last `retention` ones. The settings are used by default, no retention keeps all the partitions.
+    Returns the names of the created and the expired partitions.
+    """
+    month = get_month(now or timezone.now())
+    ahead = getattr(settings, 'COMMENTS_HISTORY_PARTITIONS_AHEAD', 3) if ahead is None else ahead
+    retention = getattr(settings, 'COMMENTS_HISTORY_RETENTION_MONTHS', None) if retention is None else retention
+    drop = getattr(settings, 'COMMENTS_HISTORY_RETENTION_DROP', False) if drop is None else drop
+
+    partitions = get_partitions()
+    existing = set(partitions.values())
+    created = [create_partition(add_months(month, i)) for i in range(ahead + 1)
+               if add_months(month, i) not in existing]
+    expired = []
+    if retention:
+        oldest = add_months(month, -retention)
+        for name, partition_month in sorted(partitions.items(), key=lambda item: item[1]):
+            if partition_month < oldest:
+                expire_partition(name, drop)
+                expired.append(name)
+    return created, expired
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+The profiles of single requests. A profile keeps every SQL statement of the request with its database and time,
+EXPLAIN (ANALYZE, BUFFERS) of the slowest ones and the Python profile of the request with the time spent in the
+serializers. A request is profiled when its X-Comments-Profile header is COMMENTS_PROFILE_TOKEN, or by chance with
+COMMENTS_PROFILE_SAMPLE_RATE. The profiles are kept in the Profile model and shown in the admin.
+
+The statements are explained after the response is made, in a transaction rolled back afterwards, so a statement
+isn't applied twice. Only the SELECT and WITH statements are explained. The ones with effects, which the rollback
+doesn't undo or which lock rows (a sequence, a notification, FOR UPDATE, a data-modifying WITH), aren't run: they get
+the plan without ANALYZE.
+"""
+from __future__ import unicode_literals
+
+from datetime import timedelta
+import cProfile
+import hmac
+import pstats
+import random
+import re
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+from django.utils import six, timezone
+from django.utils.encoding import force_bytes
+
+import metrics
+import models
+
+HEADER = 'HTTP_X_COMMENTS_PROFILE'
+# the files of the functions counted as the serializer time
+SERIALIZER_FILES = ('rest_framework/serializers.py', 'rest_framework/fields.py', 'rest_framework/relations.py',
+                    'comments/serializers.py')
+# a streamed tree is read by a server side cursor, the query is explained without its declaration
+DECLARE_CURSOR = re.compile(r'^\s*DECLARE\s.+?\sCURSOR\s(?:WITH(?:OUT)?\s+HOLD\s+)?FOR\s', re.I | re.S)
+READ_ONLY = re.compile(r'^\s*(?:SELECT|WITH)\b', re.I)
+# a word of a literal matches as well, such a statement only loses the actual times
+SIDE_EFFECTS = re.compile(r'\b(?:nextval|setval|pg_notify|pg_advisory_\w+)\s*\('
+                          r'|\bFOR\s+(?:NO\s+KEY\s+)?(?:UPDATE|SHARE)\b|\b(?:INSERT|UPDATE|DELETE)\b', re.I)
+
+
+def get_token():
+    return getattr(settings, 'COMMENTS_PROFILE_TOKEN', None)
+
+
+def get_sample_rate():
+    return getattr(settings, 'COMMENTS_PROFILE_SAMPLE_RATE', 0)
+
+
+def get_explain_count():
+    return getattr(settings, 'COMMENTS_PROFILE_EXPLAIN_SLOWEST', 3)
+
+
+def get_explain_timeout():
+    return getattr(settings, 'COMMENTS_PROFILE_EXPLAIN_TIMEOUT', 5000)
+
+
+def get_stats_lines():
+    return getattr(settings, 'COMMENTS_PROFILE_STATS_LINES', 50)
+
+
+def get_retention_days():
+    return getattr(settings, 'COMMENTS_PROFILE_RETENTION_DAYS', 7)
+
+
+def is_requested(request):
+    token, header = get_token(), request.META.get(HEADER)
+    if token and header and hmac.compare_digest(force_bytes(header), force_bytes(token)):
+        return True
+    rate = get_sample_rate()
+    return rate > 0 and random.random() < rate
+
+
+class Profiler(object):
+    """
+    Profiles the code and counts the queries between `start` and `stop`
+    """
+
+    def start(self):
+        self.started = time.time()
+        self.counter = metrics.QueryCounter(keep_queries=True)
+        self.counter.start()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.duration = time.time() - self.started
+        self.counter.stop()
+        return self
+
+
+def explain(alias, sql):
+    """
+    Returns the plan of the statement run on the database with the actual times and buffers, or None for a statement,
+    which isn't read only. A statement with side effects isn't run, its plan has no actual times.
+    """
+    match = DECLARE_CURSOR.match(sql)
+    if match:
+        sql = sql[match.end():]
+    if not READ_ONLY.match(sql):
+        return None
+    try:
+        with transaction.atomic(using=alias), connections[alias].cursor() as cursor:
+            cursor.execute('SET LOCAL statement_timeout = %s', [get_explain_timeout()])
+            # the statement has its parameters already
+            cursor.execute(('EXPLAIN ' if SIDE_EFFECTS.search(sql) else 'EXPLAIN (ANALYZE, BUFFERS) ') + sql)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+            transaction.set_rollback(True, using=alias)
+        return plan
+    except DatabaseError as e:
+        return 'EXPLAIN failed: %s' % e
+
+
+def get_serializer_time(stats):
+    """
+    Returns the time spent in the functions of the serializers, the queries run by them aren't counted
+    """
+    return sum(own_time for (filename, line, name), (calls, primitive_calls, own_time, total_time, callers)
+               in stats.stats.items() if filename.replace('\\', '/').endswith(SERIALIZER_FILES))
+
+
+def save(request, response, profiler):
+    """
+    Explains the slowest statements of the profiled request and saves its profile
+    """
+    queries = [{'database': alias, 'sql': query['sql'] or '', 'time': float(query['time'])}
+               for alias, query in profiler.counter.queries]
+    for query in sorted(queries, key=lambda query: -query['time'])[:get_explain_count()]:
+        query['explain'] = explain(query['database'], query['sql'])
+    output = six.StringIO()
+    stats = pstats.Stats(profiler.profile, stream=output)
+    stats.sort_stats('cumulative').print_stats(get_stats_lines())
+    match = request.resolver_match
+    user = getattr(request, 'user', None)
+    return models.Profile.objects.create(
+        method=request.method,
+        path=request.get_full_path(),
+        view=match.view_name if match else '',
+        status=response.status_code,
+        user=user if user is not None and user.is_authenticated else None,
+        duration=profiler.duration,
+        query_count=len(queries),
+        query_time=sum(query['time'] for query in queries),
+        serializer_time=get_serializer_time(stats),
+        queries=queries,
+        python_profile=output.getvalue(),
+    )
+
+
+def delete_old():
+    """
+    Deletes the profiles older than the retention period
+    """
+    return models.Profile.objects.filter(date__lt=timezone.now() - timedelta(days=get_retention_days())).delete()[0]
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+The progress of the exports. A task reports its state and the rows it has exported into its ExportProgress row, the
+statement notifies the channel of the task (LISTEN/NOTIFY), so a client waiting for a change of the export is woken
+up by the database instead of polling it. The parts of a sharded export add their rows to the row of the merging
+task.
+
+An export is addressed by its key: the hash of the format, the filter params cleaned by CommentFilter and the
+watermark of the data, the last submit date of the comments selected and the last event date of the history, read by
+a single query. The same export requested again while the data haven't changed gets the running or finished export of
+the key, if it was updated within COMMENTS_EXPORT_REUSE_TIMEOUT. The moves of the archive aren't in the history, they
+forget the keys of the exports made before them. The files older than COMMENTS_EXPORT_FILE_MAX_AGE are deleted with
+their storage objects by a periodic task.
+"""
+from __future__ import unicode_literals
+
+from datetime import timedelta
+import hashlib
+import json
+import select
+import time
+
+from django.conf import settings
+from django.db import connection, connections
+from django.db.models import Model
+from django.utils import timezone
+from django.utils.encoding import force_text
+
+import models
+
+CHANNEL = 'comments_export:%s'
+FINISHED = ('SUCCESS', 'FAILURE')
+
+SQL_REPORT = """
+WITH progress AS (
+  INSERT INTO {table} AS p (task_id, state, rows, file_id, error, updated, key)
+  VALUES (%(task_id)s, %(state)s, %(rows)s, %(file_id)s, %(error)s, now(), %(key)s)
+  ON CONFLICT (task_id) DO UPDATE SET
+    -- a part exporting after another one has failed doesn't hide the failure
+    state = CASE WHEN p.state = 'FAILURE' THEN p.state ELSE EXCLUDED.state END,
+    rows = p.rows + EXCLUDED.rows,
+    file_id = coalesce(EXCLUDED.file_id, p.file_id),
+    error = coalesce(nullif(EXCLUDED.error, ''), p.error),
+    updated = EXCLUDED.updated,
+    key = coalesce(nullif(EXCLUDED.key, ''), p.key)
+  RETURNING task_id
+)
+SELECT pg_notify('comments_export:' || task_id, '') FROM progress
+"""
+
+# a change of a comment is in the history, a new comment has the last submit date
+SQL_WATERMARK = """
+SELECT (SELECT max(c.submit_date) FROM ({selected}) c), (SELECT max(event_date) FROM {history_table})
+"""
+
+
+def get_report_rows():
+    return getattr(settings, 'COMMENTS_EXPORT_PROGRESS_ROWS', 10000)
+
+
+def get_max_wait():
+    return getattr(settings, 'COMMENTS_EXPORT_MAX_WAIT', 30)
+
+
+def get_reuse_timeout():
+    return getattr(settings, 'COMMENTS_EXPORT_REUSE_TIMEOUT', 60 * 60)
+
+
+def get_file_max_age():
+    return getattr(settings, 'COMMENTS_EXPORT_FILE_MAX_AGE', 24 * 60 * 60)
+
+
+def get_progress_max_age():
+    return getattr(settings, 'COMMENTS_EXPORT_PROGRESS_MAX_AGE', 7 * 24 * 60 * 60)
+
+
+def report(task_id, state, rows=0, file_id=None, error='', key=''):
+    """
+    Sets the state of the task and adds the rows to the ones exported. Does nothing for a task called directly.
+    """
+    if task_id is None:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(SQL_REPORT.format(table=models.ExportProgress._meta.db_table), {
+            'task_id': task_id, 'state': state, 'rows': rows, 'file_id': file_id, 'error': error, 'key': key})
+
+
+def normalize(value):
+    if isinstance(value, Model):
+        return value.pk
+    if hasattr(value, 'astimezone'):
+        return value.astimezone(timezone.utc).isoformat()
+    return force_text(value)
+
+
+def get_key(export_format, compress, filter_set):
+    """
+    Returns the key of the export of the comments selected by the filter set, or None if its params are invalid
+    """
+    if not filter_set.form.is_valid():
+        return None
+    params = sorted((name, normalize(value)) for name, value in filter_set.form.cleaned_data.items()
+                    if value not in (None, ''))
+    queryset = filter_set.qs.order_by().values('submit_date')
+    selected, selected_params = queryset.query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(SQL_WATERMARK.format(selected=selected, history_table=models.History._meta.db_table),
+                       selected_params)
+        watermark = cursor.fetchone()
+    data = [export_format, compress, params, [normalize(date) if date else None for date in watermark]]
+    return hashlib.sha256(json.dumps(data).encode('utf-8')).hexdigest()
+
+
+def forget_keys():
+    """
+    Makes the exports made so far not reused, the data have changed without the history
+    """
+    models.ExportProgress.objects.exclude(key='').update(key='')
+
+
+def find(key):
+    """
+    Returns the id of the task of the key updated within the reuse timeout, which is running or has made the file
+    """
+    timeout = get_reuse_timeout()
+    if not key or not timeout:
+        return None
+    return models.ExportProgress.objects.filter(
+        key=key, updated__gte=timezone.now() - timedelta(seconds=timeout)).exclude(state='FAILURE').exclude(
+        state='SUCCESS', file=None).order_by('-updated').values_list('task_id', flat=True).first()
+
+
+def expire_files(batch_size=1000):
+    """
+    Deletes the files older than the max age with their storage objects, and the progress of the exports older than
+    its own max age. The progress of an expired file is kept, so its export is gone (410) rather than unknown.
+    Returns the number of the files deleted.
+    """
+    expired = timezone.now() - timedelta(seconds=get_file_max_age())
+    count = 0
+    while True:
+        files = list(models.File.objects.filter(add_date__lt=expired).order_by('add_date')[:batch_size])
+        if not files:
+            break
+        for export_file in files:
+            if export_file.file:
+                export_file.file.delete(save=False)
+        models.File.objects.filter(pk__in=[export_file.pk for export_file in files]).delete()
+        count += len(files)
+    models.ExportProgress.objects.filter(
+        updated__lt=timezone.now() - timedelta(seconds=get_progress_max_age())).delete()
+    return count
+
+
+def count_rows(rows, task_id):
+    """
+    Yields the rows, reports every COMMENTS_EXPORT_PROGRESS_ROWS of them
+    """
+    step = get_report_rows()
+    count = 0
+    for row in rows:
+        yield row
+        count += 1
+        if count == step:
+            report(task_id, 'PROGRESS', count)
+            count = 0
+    if count:
+        report(task_id, 'PROGRESS', count)
+
+
+def get(task_id):
+    return models.ExportProgress.objects.select_related('file').filter(task_id=task_id).first()
+
+
+def wait(task_id, timeout):
+    """
+    Returns the progress of the task, or None for an unknown task. An export, which isn't finished, is waited for
+    up to `timeout` seconds until it reports.
+    """
+    # the notifications are delivered out of a transaction only
+    if timeout <= 0 or connection.in_atomic_block:
+        return get(task_id)
+    channel = connection.ops.quote_name(CHANNEL % task_id)
+    with connection.cursor() as cursor:
+        # the state is read after listening, so a change in between isn't missed
+        cursor.execute('LISTEN %s' % channel)
+    try:
+        progress = get(task_id)
+        if progress is None or progress.state in FINISHED:
+            return progress
+        pg_connection = connection.connection
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([pg_connection], [], [], remaining)[0]:
+                return progress
+            pg_connection.poll()
+            if any(notify.channel == CHANNEL % task_id for notify in pg_connection.notifies):
+                return get(task_id)
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute('UNLISTEN %s' % channel)
+        del connection.connection.notifies[:]
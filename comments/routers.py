@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Routing of the reads of the comments to the read replicas of the default database (COMMENTS_READ_REPLICAS).
+
+The writes go to the default database. So do the reads of a request which writes (a request of an unsafe method), the
+reads inside a transaction on the default database and the reads of the models out of COMMENTS_REPLICA_MODELS.
+A replica lagging behind by more than COMMENTS_REPLICA_MAX_LAG seconds is skipped. Its state is checked once every
+COMMENTS_REPLICA_CHECK_INTERVAL seconds per process.
+
+A user reads their own writes: the ReplicaMiddleware keeps the WAL position (LSN) of the default database after the
+last write of the user, or of the session, for COMMENTS_READ_YOUR_WRITES_TIMEOUT seconds. The user's next requests
+read only the replicas which have replayed it, or the default database.
+"""
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+_local = threading.local()
+# alias: (checked at, lag, lsn), shared by the threads of the process
+_states = {}
+
+SQL_REPLICA_STATE = r"""
+SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0
+            -- nothing to replay, the primary just hasn't written anything lately
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0) END,
+       CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END::text
+"""
+
+
+def get_replicas():
+    return getattr(settings, 'COMMENTS_READ_REPLICAS', [])
+
+
+def get_replica_models():
+    return getattr(settings, 'COMMENTS_REPLICA_MODELS', ('comments.comment', 'comments.history', 'comments.counter'))
+
+
+def get_max_lag():
+    return getattr(settings, 'COMMENTS_REPLICA_MAX_LAG', 5)
+
+
+def get_check_interval():
+    return getattr(settings, 'COMMENTS_REPLICA_CHECK_INTERVAL', 1)
+
+
+def get_pin_timeout():
+    return getattr(settings, 'COMMENTS_READ_YOUR_WRITES_TIMEOUT', 60)
+
+
+def parse_lsn(lsn):
+    """
+    Turns the text of an LSN ('16/B374D848') into a number
+    """
+    high, low = lsn.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def get_replica_state(alias):
+    """
+    Returns the lag of the database in seconds and the LSN it has replayed, (None, None) when it can't be reached
+    """
+    try:
+        with connections[alias].cursor() as cursor:
+            cursor.execute(SQL_REPLICA_STATE)
+            lag, lsn = cursor.fetchone()
+    except DatabaseError:
+        return None, None
+    return float(lag), parse_lsn(lsn)
+
+
+def get_state(alias):
+    checked_at, lag, lsn = _states.get(alias, (None, None, None))
+    if checked_at is None or checked_at + get_check_interval() < time.time():
+        lag, lsn = get_replica_state(alias)
+        _states[alias] = (time.time(), lag, lsn)
+    return lag, lsn
+
+
+def get_primary_lsn():
+    with connections[DEFAULT_DB_ALIAS].cursor() as cursor:
+        cursor.execute('SELECT pg_current_wal_lsn()::text')
+        return parse_lsn(cursor.fetchone()[0])
+
+
+def get_writer_key(request):
+    """
+    Returns the cache key of the LSN of the last write of the user or the session making the request, or None
+    """
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return 'comments:written-lsn:user:%s' % user.pk
+    session = getattr(request, 'session', None)
+    if session is not None and session.session_key:
+        return 'comments:written-lsn:session:%s' % session.session_key
+
+
+def get_required_lsn(request):
+    """
+    Returns the LSN the replica has to have replayed for the request, None when any replica will do
+    """
+    key = get_writer_key(request)
+    return cache.get(key) if key is not None else None
+
+
+def pin(request):
+    """
+    Makes the next requests of the writer read their own writes
+    """
+    key = get_writer_key(request)
+    if key is not None:
+        cache.set(key, get_primary_lsn(), get_pin_timeout())
+
+
+@contextmanager
+def reading(request, primary=False):
+    """
+    Routes the reads made inside the block for the request, all of them to the default database if `primary`
+    """
+    previous = getattr(_local, 'request', None), getattr(_local, 'replica', None), getattr(_local, 'primary', False)
+    _local.request, _local.replica, _local.primary = request, None, primary
+    try:
+        yield
+    finally:
+        _local.request, _local.replica, _local.primary = previous
+
+
+def choose_replica(required_lsn=None):
+    """
+    Returns a random replica lagging behind by no more than the allowed lag and having replayed the required LSN
+    """
+    replicas = []
+    for alias in get_replicas():
+        lag, lsn = get_state(alias)
+        if lag is not None and lag <= get_max_lag() and (required_lsn is None or lsn >= required_lsn):
+            replicas.append(alias)
+    return random.choice(replicas) if replicas else None
+
+
+class ReplicaRouter(object):
+    """
+    Reads the comments from the replicas, see the module docs
+    """
+
+    def db_for_read(self, model, **hints):
+        if not get_replicas() or model._meta.label_lower not in get_replica_models():
+            return None
+        # the writes of the request or the transaction have to be seen
+        if getattr(_local, 'primary', False) or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        request = getattr(_local, 'request', None)
+        if request is None:
+            return choose_replica() or DEFAULT_DB_ALIAS
+        # the reads of a request see the same state, DRF has authenticated the user by the first of them
+        if _local.replica is None:
+            _local.replica = choose_replica(get_required_lsn(request)) or DEFAULT_DB_ALIAS
+        return _local.replica
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas have the same rows
+        databases = set([DEFAULT_DB_ALIAS] + list(get_replicas()))
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # the replicas get the changes of the schema from the default database
+        if db in get_replicas():
+            return False
+        return None
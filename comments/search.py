@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Full-text search of the comments. The `search_vector` column of a comment is kept by a trigger (migration 0014) out
+of the model, the comments, which aren't removed, are found by its GIN index. The query is written in the web search
+syntax: words, "phrases", `or` and `-excluded` words. The comments found are ranked by ts_rank_cd of the stored
+vectors, so the texts aren't parsed again.
+"""
+from __future__ import unicode_literals
+
+from django.db.models import BooleanField, FloatField
+from django.db.models.expressions import RawSQL
+
+import models
+
+# the text search configuration of the trigger
+SEARCH_CONFIG = 'pg_catalog.english'
+
+SQL_MATCH = "{table}.search_vector @@ websearch_to_tsquery('{config}', %s)"
+
+# the rank is a float4, as float8 it is read and written back by the keyset cursors without rounding
+SQL_RANK = "ts_rank_cd({table}.search_vector, websearch_to_tsquery('{config}', %s))::float8"
+
+# the best comments first, the newer ones of the same rank first
+SEARCH_ORDERING = ('-rank', '-id')
+
+
+def search_comments(queryset, query):
+    """
+    Returns the comments of the queryset matching the query annotated by their `rank`
+    """
+    table = models.Comment._meta.db_table
+    return queryset.annotate(
+        matches=RawSQL(SQL_MATCH.format(config=SEARCH_CONFIG, table=table), [query], BooleanField()),
+        rank=RawSQL(SQL_RANK.format(config=SEARCH_CONFIG, table=table), [query], FloatField()),
+    ).filter(matches=True)
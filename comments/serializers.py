@@ -1,22 +1,60 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from rest_framework import serializers
+from collections import OrderedDict
+import operator
 
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import F, Func, Value
+from django.db.models.functions import Concat
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
+
+import archive
+import history
 import models
 
 
 class CommentSerializer(serializers.ModelSerializer):
     user_name = serializers.SerializerMethodField()
+    reply_count = serializers.SerializerMethodField()
+    last_activity = serializers.SerializerMethodField()
 
     class Meta:
         model = models.Comment
-        exclude = ['changed_by', 'is_removed']
+        exclude = ['changed_by', 'is_removed', 'path']
         read_only_fields = ['user']
 
     def get_user_name(self, instance):
         return instance.user.get_full_name()
 
+    def get_reply_count(self, instance):
+        return instance.get_counters()[0]
+
+    def get_last_activity(self, instance):
+        return serializers.DateTimeField().to_representation(instance.get_counters()[1])
+
+    def validate(self, attrs):
+        if 'content_type' not in attrs and 'object_pk' not in attrs:
+            return attrs
+        content_type = attrs.get('content_type', self.instance and self.instance.content_type)
+        object_pk = attrs.get('object_pk', self.instance and self.instance.object_pk)
+        if content_type.model_class() is not models.Comment:
+            return attrs
+        path = object_pk.isdigit() and models.Comment.objects.filter(pk=object_pk).values_list(
+            'path', flat=True).first()
+        if object_pk.isdigit() and not path and archive.restore([int(object_pk)]):
+            # a reply to an archived comment brings its thread back
+            path = models.Comment.objects.filter(pk=object_pk).values_list('path', flat=True).first()
+        if not path:
+            raise serializers.ValidationError({'object_pk': "The comment doesn't exist."})
+        if len(path) >= models.MAX_THREAD_DEPTH:
+            raise serializers.ValidationError({'object_pk': "The thread is too deep."})
+        if self.instance and self.instance.id in path:
+            raise serializers.ValidationError({'object_pk': "A comment can't become a reply to its own reply."})
+        return attrs
+
     def create(self, validated_data):
         validated_data['user'] = self.context['request'].user
         return super(CommentSerializer, self).create(validated_data)
@@ -26,10 +64,109 @@ class CommentSerializer(serializers.ModelSerializer):
         return super(CommentSerializer, self).update(instance, validated_data)
 
 
+class CommentRowSerializer(object):
+    """
+    The read-only fast path of CommentSerializer. The comments are read by `values()` with the method fields computed
+    in SQL, and the rows are turned into the same representation by the getter and the converters made once, without
+    the model instances and the fields run for every row. The queryset should be annotated by
+    `counters.annotate_comments`.
+    """
+    # the values of the method fields, `User.get_full_name` strips the name
+    method_sources = {
+        'user_name': Func(Concat(F('user__first_name'), Value(' '), F('user__last_name')), function='BTRIM'),
+        'reply_count': 'reply_count',
+        'last_activity': 'last_activity',
+    }
+    method_fields = {
+        'last_activity': serializers.DateTimeField(),
+    }
+    # the fields whose representation of a value read from the database is the value itself
+    plain_fields = (serializers.CharField, serializers.IntegerField, serializers.BooleanField,
+                    serializers.PrimaryKeyRelatedField)
+
+    def __init__(self, serializer_class=CommentSerializer):
+        self.annotations = {}
+        self.sources = []
+        self.names = []
+        self.converted = []
+        for name, field in serializer_class().fields.items():
+            if field.write_only:
+                continue
+            if isinstance(field, serializers.SerializerMethodField):
+                source = self.method_sources[name]
+                if not isinstance(source, basestring):
+                    self.annotations[name], source = source, name
+                field = self.method_fields.get(name)
+            else:
+                source = field.source
+            self.names.append(name)
+            self.sources.append(source)
+            if field is not None and not isinstance(field, self.plain_fields):
+                self.converted.append((name, field))
+        self.getter = operator.itemgetter(*self.sources)
+
+    @staticmethod
+    def compile(field):
+        """
+        Returns the function representing the values of the field. The ISO datetimes are made without the checks,
+        which DateTimeField runs for every value, in the timezone of the request.
+        """
+        if isinstance(field, serializers.DateTimeField):
+            output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+            field_timezone = getattr(field, 'timezone', field.default_timezone())
+            if output_format and output_format.lower() == ISO_8601 and field_timezone is not None:
+                def convert(value):
+                    value = value.astimezone(field_timezone).isoformat()
+                    return value[:-6] + 'Z' if value.endswith('+00:00') else value
+                return convert
+        return field.to_representation
+
+    def get_rows(self, queryset, *extra):
+        """
+        Returns the rows of the comments, with the `extra` values which aren't shown
+        """
+        return queryset.annotate(**self.annotations).values(*(self.sources + list(extra)))
+
+    def serialize(self, rows):
+        names, getter = self.names, self.getter
+        converters = [(name, self.compile(field)) for name, field in self.converted]
+        data = []
+        for row in rows:
+            item = OrderedDict(zip(names, getter(row)))
+            for name, convert in converters:
+                # like in Serializer.to_representation, None isn't converted
+                if item[name] is not None:
+                    item[name] = convert(item[name])
+            data.append(item)
+        return data
+
+    def to_representation(self, row):
+        return self.serialize([row])[0]
+
+
+_row_serializer = None
+
+
+def get_row_serializer():
+    global _row_serializer
+    if _row_serializer is None:
+        _row_serializer = CommentRowSerializer()
+    return _row_serializer
+
+
+class HistoryListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        histories = list(data.all() if hasattr(data, 'all') else data)
+        return super(HistoryListSerializer, self).to_representation(history.reconstruct(histories))
+
+
 class HistorySerializer(serializers.ModelSerializer):
     class Meta:
         model = models.History
-        fields = '__all__'
+        exclude = ['delta']
+        # the compact rows get their texts back
+        list_serializer_class = HistoryListSerializer
 
 
 class SubscriptionSerializer(serializers.ModelSerializer):
@@ -45,3 +182,59 @@ class SubscriptionSerializer(serializers.ModelSerializer):
 class ExportSerializer(serializers.Serializer):
     date_from = serializers.DateTimeField(required=False)
     date_to = serializers.DateTimeField(required=False)
+    compress = serializers.BooleanField(required=False, default=False)
+    # the number of parallel tasks exporting the date range by parts
+    shards = serializers.IntegerField(required=False, default=1, min_value=1, max_value=64)
+
+
+class ExportResultSerializer(serializers.Serializer):
+    # seconds to wait for a change of the export, COMMENTS_EXPORT_MAX_WAIT at most
+    wait = serializers.FloatField(required=False, default=0, min_value=0)
+
+
+class NestedTreeSerializer(serializers.Serializer):
+    # the query reads at most (max_children_per_node + 1) ** max_depth comments
+    max_depth = serializers.IntegerField(required=False, min_value=1, max_value=10,
+                                         default=lambda: getattr(settings, 'COMMENTS_TREE_MAX_DEPTH', 3))
+    max_children_per_node = serializers.IntegerField(
+        required=False, min_value=1, max_value=100,
+        default=lambda: getattr(settings, 'COMMENTS_TREE_MAX_CHILDREN_PER_NODE', 10))
+    cursor = serializers.CharField(required=False)
+
+    def validate(self, attrs):
+        max_nodes = getattr(settings, 'COMMENTS_TREE_MAX_NODES', 2000)
+        if (attrs['max_children_per_node'] + 1) ** attrs['max_depth'] > max_nodes:
+            raise serializers.ValidationError(
+                'A tree of max_depth levels of max_children_per_node replies can have more than %s comments.'
+                % max_nodes)
+        return attrs
+
+
+class SearchSerializer(serializers.Serializer):
+    q = serializers.CharField(max_length=1000)
+
+
+class BulkCreateSerializer(serializers.Serializer):
+    # the content types are taken from the cache of ContentType, not by a query per item
+    content_type = serializers.IntegerField()
+    object_pk = serializers.CharField()
+    comment = serializers.CharField(max_length=models.MAX_COMMENT_SIZE)
+
+    def validate_content_type(self, value):
+        try:
+            return ContentType.objects.get_for_id(value)
+        except ContentType.DoesNotExist:
+            raise serializers.ValidationError('Invalid pk "%s" - object does not exist.' % value)
+
+
+class BulkUpdateSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    comment = serializers.CharField(max_length=models.MAX_COMMENT_SIZE)
+
+
+class BulkSerializer(serializers.Serializer):
+    # the items are validated one by one by the bulk functions, so that every item gets its own result
+    create = serializers.ListField(child=serializers.DictField(), required=False, max_length=models.MAX_BULK_SIZE)
+    update = serializers.ListField(child=serializers.DictField(), required=False, max_length=models.MAX_BULK_SIZE)
+    remove = serializers.ListField(child=serializers.IntegerField(), required=False,
+                                   max_length=models.MAX_BULK_SIZE)
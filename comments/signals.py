@@ -1,20 +1,60 @@
 import os
 import sys
 
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.core.management.color import color_style
 from django.core.management.base import OutputWrapper
 from django.db import connection
 
+# The row trigger runs its function for every updated row, the statement one inserts the history of a whole update
+# by a single query from the transition tables (PostgreSQL 10+)
+HISTORY_TRIGGERS = {
+    'row': 'history.sql',
+    'statement': 'history_statement.sql',
+}
 
-def create_history_trigger(sender, **kwargs):
+
+def read_sql(name):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name)) as f:
+        return f.read()
+
+
+def get_history_trigger_sql(variant):
     from models import Comment
+    if variant not in HISTORY_TRIGGERS:
+        raise ImproperlyConfigured('COMMENTS_HISTORY_TRIGGER must be one of: %s' % ', '.join(sorted(HISTORY_TRIGGERS)))
+    return read_sql(HISTORY_TRIGGERS[variant]).format(table_name=Comment._meta.db_table)
+
+
+def get_counter_triggers_sql(shards):
+    from models import Comment, Counter
+    return read_sql('counters.sql').format(table_name=Comment._meta.db_table, counter_table=Counter._meta.db_table,
+                                           shards=int(shards))
+
+
+def install_history_trigger(variant):
+    with connection.cursor() as cursor:
+        cursor.execute(get_history_trigger_sql(variant))
+
+
+def create_history_trigger(sender, **kwargs):
+    stdout = OutputWrapper(sys.stdout)
+    style = color_style()
+
+    variant = getattr(settings, 'COMMENTS_HISTORY_TRIGGER', 'row')
+    stdout.write("  Creating the Comment History trigger (%s)..." % variant, ending=' ')
+    install_history_trigger(variant)
+    stdout.write(style.SUCCESS("OK"))
+
+
+def create_counter_triggers(sender, **kwargs):
     stdout = OutputWrapper(sys.stdout)
     style = color_style()
 
-    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history.sql')) as f:
-        sql = f.read()
-    sql = sql.format(table_name=Comment._meta.db_table)
-    stdout.write("  Creating the Comment History trigger...", ending=' ')
-    cursor = connection.cursor()
-    cursor.execute(sql)
+    # more shards let more replies to the same thread be written at once, but make the counters slower to read
+    shards = getattr(settings, 'COMMENTS_COUNTER_SHARDS', 8)
+    stdout.write("  Creating the Comment Counter triggers (%s shards)..." % shards, ending=' ')
+    with connection.cursor() as cursor:
+        cursor.execute(get_counter_triggers_sql(shards))
     stdout.write(style.SUCCESS("OK"))
@@ -1,15 +1,30 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from datetime import datetime
+from collections import defaultdict
+from datetime import datetime, timedelta
+import gzip
 import json
+import tempfile
+import uuid
 
 import celery
+from celery.result import AsyncResult
+from django.core.cache import cache
 from django.core.files import File as DjangoFile
-from django.core.serializers.xml_serializer import Serializer
+from django.db import connection
+from django.db.models import Max, Min, Q
+from django.utils import timezone
 from push_notifications.models import GCMDevice
 
+from exporters import SERIALIZERS
+import archive
+import history
 import models
+import partitions
+import profiling
+import progress
+import trees
 
 
 def json_encoder(obj):
@@ -19,13 +34,8 @@ def json_encoder(obj):
     raise TypeError("Type %s not serializable" % type(obj))
 
 
-@celery.task()
-def notify(action, comment_id, content_type, object_pk, text, user_id, event_date):
-    from models import Subscription
-    devices = GCMDevice.objects.filter(
-        user_id__in=Subscription.objects.filter(content_type=content_type, object_pk=object_pk).values_list(
-            'subscriber', flat=True))
-    message = {
+def get_message(action, comment_id, content_type, object_pk, text, user_id, event_date):
+    return {
         'action': action,
         'id': comment_id,
         'user': user_id,
@@ -34,17 +44,228 @@ def notify(action, comment_id, content_type, object_pk, text, user_id, event_dat
         'object_pk': object_pk,
         'comment': text
     }
-    devices.send_message(json.dumps(message, default=json_encoder))
+
+
+def send_events(events):
+    """
+    Sends the events to the devices of the subscribers of the commented entities. The subscribers of all the
+    entities are looked up by a single query, a device gets the events it's subscribed to in one message.
+    """
+    condition = Q()
+    for content_type, object_pk in set((event['content_type'], event['object_pk']) for event in events):
+        condition |= Q(user__comment_subscriptions__content_type=content_type,
+                       user__comment_subscriptions__object_pk=object_pk)
+    subscriptions = GCMDevice.objects.filter(condition).values_list(
+        'id', 'user__comment_subscriptions__content_type', 'user__comment_subscriptions__object_pk')
+    device_entities = defaultdict(set)
+    for device_id, content_type, object_pk in subscriptions:
+        device_entities[device_id].add((content_type, object_pk))
+
+    devices_by_entities = defaultdict(list)
+    for device_id, entities in device_entities.items():
+        devices_by_entities[frozenset(entities)].append(device_id)
+    for entities, device_ids in devices_by_entities.items():
+        message = {
+            'events': [event for event in events if (event['content_type'], event['object_pk']) in entities]
+        }
+        GCMDevice.objects.filter(id__in=device_ids).send_message(json.dumps(message, default=json_encoder))
 
 
 @celery.task()
-def export(export_format, data):
-    from models import File
+def notify(events, *args):
+    # a message queued by the previous release has the fields of a single event as the arguments, it is kept for a
+    # release
+    if args:
+        events = [get_message(events, *args)]
+    send_events(events)
+
+
+@celery.task()
+def flush_notifications(content_type, object_pk):
+    """
+    Sends the events of the entity collected by `notifications.dispatch` in a single message
+    """
+    from models import PendingNotification
+    from notifications import get_window_key
+    # the events coming from now on open a new window
+    cache.delete(get_window_key(content_type, object_pk))
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM {table} WHERE content_type_id = %s AND object_pk = %s '
+                       'RETURNING id, event'.format(table=PendingNotification._meta.db_table),
+                       [content_type, object_pk])
+        events = [json.loads(event) for pk, event in sorted(cursor.fetchall())]
+    if events:
+        send_events(events)
+
+
+@celery.task()
+def maintain_history_partitions():
+    created, expired = partitions.maintain_partitions()
+    return {'created': created, 'expired': expired}
+
+
+@celery.task()
+def compact_history():
+    # the days overlap, so a missed run is caught up by the next one
+    return history.compact_history(since=timezone.now() - timedelta(days=2))
+
+
+@celery.task()
+def delete_old_profiles():
+    return profiling.delete_old()
+
+
+@celery.task()
+def expire_files():
+    return progress.expire_files()
+
+
+@celery.task()
+def archive_comments():
+    return {'removed': archive.archive_removed(), 'dormant': archive.archive_dormant()}
+
+
+@celery.task()
+def warm_tree(content_type_id, object_id):
+    trees.warm_tree(content_type_id, object_id)
+
+
+def get_filter(data):
     from filters import CommentFilter
-    qs = models.Comment.objects.filter(is_removed=False)
-    f = CommentFilter(data, qs)
-    serializer = Serializer()
-    serializer.serialize(f.qs)
-    myfile = DjangoFile(serializer.stream, 'comments.' + export_format)
-    obj = File.objects.create(file=myfile)
-    return obj.id.hex
+    return CommentFilter(data, models.Comment.objects.filter(is_removed=False))
+
+
+def filter_comments(data):
+    return get_filter(data).qs.order_by('submit_date', 'id')
+
+
+def get_export_name(export_format, compress, task_id=None):
+    # a unique name isn't renamed by the storage, an export called directly has no task id
+    return 'comments-%s.%s%s' % (task_id or uuid.uuid4(), export_format, '.gz' if compress else '')
+
+
+def write_block(tmp, compress, write):
+    """
+    Writes a block by the `write` function into the file. The block is a separate gzip member when compressing,
+    so that the blocks written separately can be concatenated.
+    """
+    stream = gzip.GzipFile('', 'wb', fileobj=tmp) if compress else tmp
+    write(stream)
+    if compress:
+        stream.close()
+
+
+def save_file(tmp, name):
+    from models import File
+    tmp.seek(0)
+    return File.objects.create(file=DjangoFile(tmp, name)).id.hex
+
+
+@celery.task()
+def export(export_format, data, compress=False):
+    """
+    Exports the comments selected by the filter params.
+    The rows are read from a server side cursor and written into a temporary file, which is copied to the storage
+    by chunks, so the memory usage doesn't depend on the export size. The progress is reported as the rows are read.
+    """
+    task_id = export.request.id
+    serializer = SERIALIZERS[export_format]()
+
+    def write(stream):
+        serializer.write_header(stream, models.Comment)
+        serializer.serialize(progress.count_rows(filter_comments(data).iterator(), task_id), stream=stream)
+        serializer.write_footer(stream)
+
+    progress.report(task_id, 'STARTED')
+    try:
+        with tempfile.TemporaryFile() as tmp:
+            write_block(tmp, compress, write)
+            file_id = save_file(tmp, get_export_name(export_format, compress, task_id))
+    except Exception as e:
+        progress.report(task_id, 'FAILURE', error=repr(e))
+        raise
+    progress.report(task_id, 'SUCCESS', file_id=file_id)
+    return file_id
+
+
+def format_date(value):
+    # the format is parsed back by the date filters in the default time zone
+    return timezone.localtime(value, timezone.get_default_timezone()).strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+def start_export(export_format, data, compress=False, shards=1):
+    """
+    Starts an export, by `shards` parallel tasks if there are more than one, returns the result of the task, which
+    makes the file. The export is pending until the task starts. An export of the same comments, which is running or
+    done, is returned instead if the comments haven't changed since.
+    """
+    key = progress.get_key(export_format, compress, get_filter(data))
+    task_id = progress.find(key)
+    if task_id is not None:
+        return AsyncResult(task_id)
+    task_id = str(uuid.uuid4())
+    progress.report(task_id, 'PENDING', key=key or '')
+    if shards > 1:
+        return export_sharded(export_format, data, compress, shards, task_id)
+    return export.apply_async((export_format, data, compress), task_id=task_id)
+
+
+def export_sharded(export_format, data, compress, shards, task_id=None):
+    """
+    Splits the dates of the selected comments into `shards` equal ranges, which are exported by parallel tasks,
+    and merges the parts into a file. Returns the result of the merging task, the parts report their rows to it.
+    """
+    task_id = task_id or str(uuid.uuid4())
+    dates = filter_comments(data).aggregate(first=Min('submit_date'), last=Max('submit_date'))
+    if dates['first'] is None:
+        return export.apply_async((export_format, data, compress), task_id=task_id)
+    step = (dates['last'] - dates['first']) / shards
+    bounds = [dates['first'] + step * i for i in range(shards)] + [dates['last'] + timedelta(microseconds=1)]
+    parts = [export_part.s(export_format, dict(data, date_from=format_date(start), date_to=format_date(end)), compress,
+                           task_id)
+             for start, end in zip(bounds, bounds[1:]) if start < end]
+    return celery.chord(parts)(merge_export.s(export_format, compress).set(task_id=task_id))
+
+
+@celery.task()
+def export_part(export_format, data, compress=False, progress_id=None):
+    """
+    Exports the selected comments without the document header and footer, reports the rows to the merging task
+    """
+    serializer = SERIALIZERS[export_format]()
+    progress.report(progress_id, 'STARTED')
+    try:
+        with tempfile.TemporaryFile() as tmp:
+            write_block(tmp, compress, lambda stream: serializer.serialize(
+                progress.count_rows(filter_comments(data).iterator(), progress_id), stream=stream))
+            return save_file(tmp, 'part.' + get_export_name(export_format, compress, export_part.request.id))
+    except Exception as e:
+        progress.report(progress_id, 'FAILURE', error=repr(e))
+        raise
+
+
+@celery.task()
+def merge_export(part_ids, export_format, compress=False):
+    """
+    Concatenates the parts exported by `export_part` in the given order and removes them
+    """
+    from models import File
+    task_id = merge_export.request.id
+    serializer = SERIALIZERS[export_format]()
+    parts = File.objects.in_bulk(part_ids)
+    try:
+        with tempfile.TemporaryFile() as tmp:
+            write_block(tmp, compress, lambda stream: serializer.write_header(stream, models.Comment))
+            for part_id in part_ids:
+                for chunk in parts[uuid.UUID(part_id)].file.chunks():
+                    tmp.write(chunk)
+            write_block(tmp, compress, serializer.write_footer)
+            file_id = save_file(tmp, get_export_name(export_format, compress, task_id))
+    except Exception as e:
+        progress.report(task_id, 'FAILURE', error=repr(e))
+        raise
+    for part in parts.values():
+        part.file.delete(save=False)
+        part.delete()
+    progress.report(task_id, 'SUCCESS', file_id=file_id)
+    return file_id
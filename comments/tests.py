@@ -1,21 +1,37 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import csv
+from datetime import datetime, timedelta
+import gzip
 import json
+import shutil
+import tempfile
+import threading
+import time
+import uuid
 
 from django.utils import timezone
 
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
 from django.shortcuts import reverse
+from django.utils.http import urlencode
 from django.core import serializers
-from django.test import TestCase
-from rest_framework.test import APITestCase
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APITestCase
 from push_notifications.models import GCMDevice
 from mock import patch
 
-from comments import tasks
+from comments import (archive, bulk, counters, datagen, history, loadtest, metrics, notifications, partitions,
+                      profiling, progress, routers, search, signals, tasks, trees)
 from models import Article, Comment
+from serializers import CommentSerializer, HistorySerializer, get_row_serializer
 import models
 
 
@@ -24,7 +40,24 @@ def format_response_message(response):
         response.request['REQUEST_METHOD'], response.request['PATH_INFO'], response.status_code, response.content)
 
 
-class ViewTests(APITestCase):
+class TempMediaMixin(object):
+    """
+    Keeps the files saved by a test in a temporary MEDIA_ROOT removed after it
+    """
+
+    def setUp(self):
+        super(TempMediaMixin, self).setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        self.media_settings.enable()
+
+    def tearDown(self):
+        self.media_settings.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+        super(TempMediaMixin, self).tearDown()
+
+
+class ViewTests(TempMediaMixin, APITestCase):
     app = 'comments'
     base_name = 'comment'
 
@@ -34,6 +67,7 @@ class ViewTests(APITestCase):
         cls.user = user
 
     def setUp(self):
+        super(ViewTests, self).setUp()
         self.client.force_authenticate(user=self.user)
 
     def test_add_comment(self):
@@ -156,6 +190,135 @@ class ViewTests(APITestCase):
         self.assertIn(comment31.id, comment_ids)
         self.assertIn(comment32.id, comment_ids)
 
+        # the streamed tree is the same, whatever the batches are
+        for batch_size in (1, 2, 500):
+            with self.settings(COMMENTS_TREE_STREAM_BATCH=batch_size):
+                streamed = self.client.get(reverse('%s:child-comments' % self.app, kwargs={
+                    'content_type_id': comment_ct.pk, 'object_id': comment1.pk}), {'stream': 1})
+            self.assertTrue(streamed.streaming)
+            self.assertEqual(json.loads(b''.join(streamed.streaming_content)), json.loads(response.content))
+        streamed = self.client.get(reverse('%s:child-comments' % self.app, kwargs={
+            'content_type_id': comment_ct.pk, 'object_id': comment31.pk}), {'stream': 1})
+        self.assertEqual(b''.join(streamed.streaming_content), b'[]')
+
+    def test_nested_child_comments(self):
+        comment_ct = ContentType.objects.get_for_model(Comment)
+        article_ct = ContentType.objects.get_for_model(Article)
+        article = Article.objects.create(text='text')
+        tops = [Comment.objects.create(content_type=article_ct, object_pk=article.pk, comment='t%s' % i,
+                                       user=self.user) for i in range(3)]
+        replies = [Comment.objects.create(content_type=comment_ct, object_pk=tops[0].pk, comment='r%s' % i,
+                                          user=self.user) for i in range(3)]
+        deep = Comment.objects.create(content_type=comment_ct, object_pk=replies[0].pk, comment='d', user=self.user)
+        removed = Comment.objects.create(content_type=comment_ct, object_pk=tops[1].pk, comment='x', user=self.user)
+        removed.is_removed = True
+        removed.save()
+
+        params = {'nested': 1, 'max_depth': 2, 'max_children_per_node': 2}
+        response = self.client.get(reverse('%s:child-comments' % self.app, kwargs={
+            'content_type_id': article_ct.pk, 'object_id': article.pk}), params)
+        self.assertEqual(response.status_code, 200, format_response_message(response))
+        results = response.data['results']
+        self.assertEqual([node['comment'] for node in results], ['t0', 't1'])
+        self.assertEqual([node['comment'] for node in results[0]['replies']], ['r0', 'r1'])
+        self.assertEqual(results[0]['replies'][0]['replies'], [])
+        self.assertEqual(results[1]['replies'], [])
+        self.assertIsNone(results[1]['next'])
+        self.assertIsNone(results[0]['replies'][1]['next'])
+
+        # the links fetch the rest of the branches
+        for link, comments in [(response.data['next'], ['t2']), (results[0]['next'], ['r2']),
+                               (results[0]['replies'][0]['next'], ['d'])]:
+            response = self.client.get(link)
+            self.assertEqual(response.status_code, 200, format_response_message(response))
+            self.assertEqual([node['comment'] for node in response.data['results']], comments)
+            self.assertIsNone(response.data['next'])
+        self.assertEqual(response.data['results'][0]['id'], deep.pk)
+
+        response = self.client.get(reverse('%s:child-comments' % self.app, kwargs={
+            'content_type_id': article_ct.pk, 'object_id': article.pk}), dict(params, cursor='x'))
+        self.assertEqual(response.status_code, 404)
+        # the size of the tree is bounded
+        response = self.client.get(reverse('%s:child-comments' % self.app, kwargs={
+            'content_type_id': article_ct.pk, 'object_id': article.pk}), {'nested': 1, 'max_depth': 10})
+        self.assertEqual(response.status_code, 400)
+
+    def test_list_child_comments_of_removed_comment(self):
+        """
+        Tests that replies to a removed comment are hidden
+        """
+        comment_ct = ContentType.objects.get_for_model(Comment)
+        article_ct = ContentType.objects.get_for_model(Article)
+        article = Article.objects.create(text='text')
+        comment1 = models.Comment.objects.create(content_type=article_ct, object_pk=article.pk, comment='c1',
+                                                 user=self.user)
+        comment2 = models.Comment.objects.create(content_type=comment_ct, object_pk=comment1.pk, comment='c2',
+                                                 user=self.user)
+        models.Comment.objects.create(content_type=comment_ct, object_pk=comment2.pk, comment='c3', user=self.user)
+        comment2.is_removed = True
+        comment2.save()
+
+        response = self.client.get(reverse('%s:child-comments' % self.app,
+                                           kwargs={'content_type_id': article_ct.pk, 'object_id': article.pk}))
+        self.assertEqual(response.status_code, 200, format_response_message(response))
+        self.assertEqual([item['id'] for item in response.data], [comment1.id])
+
+    def test_move_comment(self):
+        """
+        Tests that replies follow a comment moved to another parent
+        """
+        comment_ct = ContentType.objects.get_for_model(Comment)
+        article_ct = ContentType.objects.get_for_model(Article)
+        article = Article.objects.create(text='text')
+        comment1 = models.Comment.objects.create(content_type=article_ct, object_pk=article.pk, comment='c1',
+                                                 user=self.user)
+        comment2 = models.Comment.objects.create(content_type=comment_ct, object_pk=comment1.pk, comment='c2',
+                                                 user=self.user)
+        comment3 = models.Comment.objects.create(content_type=comment_ct, object_pk=comment2.pk, comment='c3',
+                                                 user=self.user)
+        self.assertEqual(comment3.path, [comment1.id, comment2.id, comment3.id])
+        comment4 = models.Comment.objects.create(content_type=article_ct, object_pk=article.pk, comment='c4',
+                                                 user=self.user)
+
+        response = self.client.patch(reverse('%s:%s-detail' % (self.app, self.base_name), kwargs={'pk': comment2.pk}),
+                                     {'object_pk': comment4.pk})
+        self.assertEqual(response.status_code, 200, format_response_message(response))
+        comment3.refresh_from_db()
+        self.assertEqual(comment3.path, [comment4.id, comment2.id, comment3.id])
+        # the move is in the history, the new paths of the replies aren't
+        self.assertEqual(list(models.History.objects.values_list('comment_id', flat=True)), [comment2.id])
+        response = self.client.get(reverse('%s:child-comments' % self.app,
+                                           kwargs={'content_type_id': comment_ct.pk, 'object_id': comment4.pk}))
+        self.assertEqual([item['id'] for item in response.data], [comment2.id, comment3.id])
+
+        # a comment can't become a reply to its own reply
+        response = self.client.patch(reverse('%s:%s-detail' % (self.app, self.base_name), kwargs={'pk': comment2.pk}),
+                                     {'object_pk': comment3.pk})
+        self.assertEqual(response.status_code, 400, format_response_message(response))
+        # and the parent must exist
+        response = self.client.patch(reverse('%s:%s-detail' % (self.app, self.base_name), kwargs={'pk': comment2.pk}),
+                                     {'object_pk': 'abc'})
+        self.assertEqual(response.status_code, 400, format_response_message(response))
+
+    def test_list_replies(self):
+        """
+        Tests filtering the replies by the parent comment
+        """
+        comment_ct = ContentType.objects.get_for_model(Comment)
+        article_ct = ContentType.objects.get_for_model(Article)
+        article = Article.objects.create(text='text')
+        comment1 = models.Comment.objects.create(content_type=article_ct, object_pk=article.pk, comment='c1',
+                                                 user=self.user)
+        comment2 = models.Comment.objects.create(content_type=comment_ct, object_pk=comment1.pk, comment='c2',
+                                                 user=self.user)
+        models.Comment.objects.create(content_type=comment_ct, object_pk=comment2.pk, comment='c3', user=self.user)
+        self.assertIsNone(comment1.parent)
+        self.assertEqual(comment2.parent, comment1.id)
+
+        response = self.client.get(reverse('%s:%s-list' % (self.app, self.base_name)), {'parent': comment1.pk})
+        self.assertEqual(response.status_code, 200, format_response_message(response))
+        self.assertEqual([item['id'] for item in response.data['results']], [comment2.id])
+
     def test_list_user_comments(self):
         """
         Tests
@@ -210,6 +373,73 @@ class ViewTests(APITestCase):
         self.assertEqual(len(results), 1)
         self.assertEqual(results[0]['comment'], 'Hi, everyone')
 
+    def test_list_comments_by_cursor(self):
+        """
+        Tests scrolling the comments by keys
+        """
+        article_ct = ContentType.objects.get_for_model(Article)
+        article = Article.objects.create(text='text')
+        comments = [Comment.objects.create(content_type=article_ct, object_pk=article.pk, comment='c%s' % i,
+                                           user=self.user) for i in range(5)]
+        # the rows having the same date are ordered by id
+        Comment.objects.filter(id__in=[c.id for c in comments[1:4]]).update(submit_date=comments[1].submit_date)
+
+        url = reverse('%s:%s-list' % (self.app, self.base_name)) + '?cursor=&limit=2'
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, format_response_message(response))
+            self.assertNotIn('count', response.data)
+            ids.extend(item['id'] for item in response.data['results'])
+            url = response.data['next']
+            if len(ids) == 2:
+                # a new comment doesn't shift the pages
+                Comment.objects.create(content_type=article_ct, object_pk=article.pk, comment='c5', user=self.user)
+        self.assertEqual(ids[:5], [c.id for c in comments])
+        self.assertEqual(len(ids), 6)
+
+        response = self.client.get(reverse('%s:%s-list' % (self.app, self.base_name)) + '?cursor=abc')
+        self.assertEqual(response.status_code, 404, format_response_message(response))
+
+    def test_search(self):
+        """
+        Tests the full-text search with the filters and the keyset pagination
+        """
+        article_ct = ContentType.objects.get_for_model(Article)
+        article = Article.objects.create(text='text')
+        other = Article.objects.create(text='text')
+        texts = ['Cats are sleeping', 'A cat sleeps, the cat purrs', 'Dogs are barking', 'My cat and my dog',
+                 'The cat again']
+        comments = [Comment.objects.create(content_type=article_ct, object_pk=article.pk, comment=text,
+                                           user=self.user) for text in texts]
+        Comment.objects.create(content_type=article_ct, object_pk=other.pk, comment='cat', user=self.user)
+        comments[4].is_removed = True
+        comments[4].save()
+        url = reverse('%s:%s-search' % (self.app, self.base_name))
+
+        params = {'q': 'cats', 'content_type': article_ct.pk, 'object_pk': article.pk}
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200, format_response_message(response))
+        # the words are stemmed, the comments mentioning the cat twice come first
+        found = [(item['id'], item['rank']) for item in response.data['results']]
+        self.assertEqual([pk for pk, rank in found], [comments[1].id, comments[3].id, comments[0].id])
+        self.assertGreater(found[0][1], found[1][1])
+        self.assertEqual(response.data['results'][0]['comment'], texts[1])
+        self.assertEqual(self.client.get(url, dict(params, q='cat -dog')).data['count'], 2)
+        self.assertEqual(self.client.get(url, dict(params, q='"cat purrs"')).data['count'], 1)
+
+        ids = []
+        next_url = url + '?' + urlencode(dict(params, cursor='', limit=1))
+        while next_url:
+            response = self.client.get(next_url)
+            self.assertEqual(response.status_code, 200, format_response_message(response))
+            ids.extend(item['id'] for item in response.data['results'])
+            next_url = response.data['next']
+        self.assertEqual(ids, [pk for pk, rank in found])
+
+        response = self.client.get(url, {'content_type': article_ct.pk})
+        self.assertEqual(response.status_code, 400, format_response_message(response))
+
     def test_update_comment(self):
         article_ct = ContentType.objects.get_for_model(Article)
         article = Article.objects.create(text='text')
@@ -260,6 +490,164 @@ class ViewTests(APITestCase):
                                               kwargs={'pk': comment1.pk}))
         self.assertEqual(response.status_code, 403, format_response_message(response))
 
+    def test_counters(self):
+        comment_ct = ContentType.objects.get_for_model(Comment)
+        article_ct = ContentType.objects.get_for_model(Article)
+        article = Article.objects.create(text='text')
+        parent = Comment.objects.create(content_type=article_ct, object_pk=article.pk, comment='c1', user=self.user)
+        replies = [Comment.objects.create(content_type=comment_ct, object_pk=parent.pk, comment=text, user=self.user)
+                   for text in ['c2', 'c3']]
+        self.assertEqual(counters.get_counters(article_ct.pk, [article.pk])[str(article.pk)][0], 1)
+
+        url = reverse('%s:%s-list' % (self.app, self.base_name))
+        response = self.client.get(url, {'content_type': comment_ct.pk, 'object_pk': parent.pk})
+        self.assertEqual([(item['reply_count'], item['last_activity']) for item in response.data['results']],
+                         [(0, item['submit_date']) for item in response.data['results']])
+        response = self.client.get(url, {'content_type': article_ct.pk, 'object_pk': article.pk})
+        self.assertEqual(response.data['results'][0]['reply_count'], 2)
+
+        # a removed reply isn't counted any more, so the comment can be removed once all its replies are
+        for reply in replies:
+            reply.is_removed = True
+            reply.save()
+        self.assertEqual(Comment.objects.get(pk=parent.pk).get_counters()[0], 0)
+        replies[0].is_removed = False
+        replies[0].save()
+        self.assertFalse(Comment.objects.get(pk=parent.pk).is_deletable())
+
+        # a moved reply is counted by its new parent
+        replies[0].content_type, replies[0].object_pk = article_ct, article.pk
+        replies[0].save()
+        self.assertEqual(counters.get_counters(article_ct.pk, [article.pk])[str(article.pk)][0], 2)
+        self.assertTrue(Comment.objects.get(pk=parent.pk).is_deletable())
+
+    def test_conditional_get(self):
+        comment_ct = ContentType.objects.get_for_model(Comment)
+        article_ct = ContentType.objects.get_for_model(Article)
+        article = Article.objects.create(text='text')
+        parent = Comment.objects.create(content_type=article_ct, object_pk=article.pk, comment='c1', user=self.user)
+        reply = Comment.objects.create(content_type=comment_ct, object_pk=parent.pk, comment='c2', user=self.user)
+        urls = [
+            reverse('%s:child-comments' % self.app, kwargs={'content_type_id': article_ct.pk, 'object_id': article.pk}),
+            reverse('%s:child-comments' % self.app, kwargs={'content_type_id': comment_ct.pk, 'object_id': parent.pk}),
+            '%s?content_type=%s&object_pk=%s' % (reverse('%s:%s-list' % (self.app, self.base_name)),
+                                                  comment_ct.pk, parent.pk),
+        ]
+        etags = {}
+        for url in urls:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, format_response_message(response))
+            self.assertIn('Last-Modified', response)
+            etags[url] = response['ETag']
+            # an unchanged thread isn't queried
+            with self.assertNumQueries(1):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[url])
+            self.assertEqual(response.status_code, 304)
+
+        # an edit of a reply changes the whole thread
+        reply.comment = 'c3'
+        reply.save()
+        for url in urls:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[url])
+            self.assertEqual(response.status_code, 200, format_response_message(response))
+            self.assertNotEqual(response['ETag'], etags[url])
+        # the other lists have no version
+        response = self.client.get(reverse('%s:%s-list' % (self.app, self.base_name)), {'user': self.user.pk})
+        self.assertNotIn('ETag', response)
+
+    def test_fast_serialization(self):
+        comment_ct = ContentType.objects.get_for_model(Comment)
+        article_ct = ContentType.objects.get_for_model(Article)
+        article = Article.objects.create(text='text')
+        named = get_user_model().objects.create_user('named', first_name='Ann ', last_name='Lee')
+        parent = Comment.objects.create(content_type=article_ct, object_pk=article.pk, comment='c1', user=self.user)
+        Comment.objects.create(content_type=comment_ct, object_pk=parent.pk, comment='c2', user=named)
+        Comment.objects.create(content_type=article_ct, object_pk=article.pk, comment='Привет', user=named)
+
+        # the output of the serializer is the same to the byte
+        queryset = counters.annotate_comments(Comment.objects.all())
+        expected = JSONRenderer().render(CommentSerializer(queryset.order_by('id'), many=True).data)
+        rows = get_row_serializer()
+        self.assertEqual(JSONRenderer().render(rows.serialize(rows.get_rows(queryset.order_by('id')))), expected)
+
+        response = self.client.get(reverse('%s:%s-list' % (self.app, self.base_name)), {'user': named.pk})
+        self.assertEqual(response.data['results'][0]['user_name'], 'Ann  Lee')
+        # the trees name the users the same way
+        tree = reverse('comments:child-comments', kwargs={'content_type_id': article_ct.pk, 'object_id': article.pk})
+        for params in ({}, {'stream': 1}):
+            response = self.client.get(tree, params)
+            data = json.loads(b''.join(response.streaming_content)) if response.streaming else response.data
+            self.assertEqual([node['user_name'] for node in data], ['', 'Ann  Lee', 'Ann  Lee'])
+        response = self.client.get(tree, {'nested': 1})
+        self.assertEqual(response.data['results'][0]['replies'][0]['user_name'], 'Ann  Lee')
+        response = self.client.get(reverse('%s:%s-detail' % (self.app, self.base_name), kwargs={'pk': parent.pk}))
+        self.assertEqual(response.content, JSONRenderer().render(CommentSerializer(queryset.get(pk=parent.pk)).data))
+        response = self.client.get(reverse('%s:%s-detail' % (self.app, self.base_name), kwargs={'pk': 'x'}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_export(self):
+        article_ct = ContentType.objects.get_for_model(Article)
+        article = Article.objects.create(text='text')
+        Comment.objects.create(content_type=article_ct, object_pk=article.pk, comment='Hi, everyone', user=self.user)
+        with self.settings(CELERY_TASK_ALWAYS_EAGER=True, CELERY_TASK_EAGER_PROPAGATES=True):
+            response = self.client.post(reverse('%s:%s-export' % (self.app, self.base_name),
+                                                kwargs={'export_format': 'xml'}), {'compress': True})
+            self.assertEqual(response.status_code, 202, format_response_message(response))
+            self.assertIn('/result/', response['Location'])
+            self.assertTrue(models.File.objects.get().file.name.endswith('.xml.gz'))
+
+    def test_history_triggers(self):
+        article_ct = ContentType.objects.get_for_model(Article)
+        article = Article.objects.create(text='text')
+        for variant in sorted(signals.HISTORY_TRIGGERS):
+            signals.install_history_trigger(variant)
+            Comment.objects.bulk_create([Comment(id=pk, path=[pk], content_type=article_ct, object_pk=article.pk,
+                                                 comment='Hi', user=self.user)
+                                         for pk in models.reserve_ids(Comment, 3)])
+            comments = Comment.objects.filter(comment='Hi')
+            pks = sorted(comments.values_list('id', flat=True))
+            # a mass update, the first comment is left as it was
+            Comment.objects.filter(pk__in=pks[1:]).update(comment='Hello', changed_by=self.user)
+            Comment.objects.filter(pk__in=pks).update(is_removed=False)
+            history = models.History.objects.filter(comment__in=pks)
+            self.assertEqual(sorted(history.values_list('comment', flat=True)), pks[1:], variant)
+            self.assertEqual(set(history.values_list('old_comment', 'new_comment', 'user')),
+                             {('Hi', 'Hello', self.user.pk)}, variant)
+
+    def test_bulk(self):
+        article_ct = ContentType.objects.get_for_model(Article)
+        comment_ct = ContentType.objects.get_for_model(Comment)
+        article = Article.objects.create(text='text')
+        parent = Comment.objects.create(content_type=article_ct, object_pk=article.pk, comment='Hi', user=self.user)
+        reply = Comment.objects.create(content_type=comment_ct, object_pk=parent.pk, comment='Hey', user=self.user)
+        data = {
+            'create': [
+                {'content_type': article_ct.pk, 'object_pk': str(article.pk), 'comment': 'First'},
+                {'content_type': comment_ct.pk, 'object_pk': str(reply.pk), 'comment': 'Second'},
+                {'content_type': comment_ct.pk, 'object_pk': '0', 'comment': 'Orphan'},
+                {'content_type': article_ct.pk, 'object_pk': str(article.pk)},
+            ],
+            'update': [{'id': reply.pk, 'comment': 'Hello'}, {'id': 0, 'comment': 'Hello'}],
+            'remove': [parent.pk, 0],
+        }
+        response = self.client.post(reverse('%s:%s-bulk' % (self.app, self.base_name)), data)
+        self.assertEqual(response.status_code, 200, format_response_message(response))
+        self.assertEqual([result['status'] for result in response.data['create']], [201, 201, 400, 400])
+        self.assertEqual([result['status'] for result in response.data['update']], [200, 404])
+        self.assertEqual([result['status'] for result in response.data['remove']], [403, 404])
+
+        second = Comment.objects.get(pk=response.data['create'][1]['id'])
+        self.assertEqual(second.path, reply.path + [second.pk])
+        self.assertEqual(second.parent, reply.pk)
+        self.assertEqual(Comment.objects.get(pk=reply.pk).comment, 'Hello')
+        self.assertEqual(models.History.objects.get(comment=reply).user, self.user)
+
+        # the reply has got a reply, the first comment can be removed
+        data = {'remove': [reply.pk, response.data['create'][0]['id']]}
+        response = self.client.post(reverse('%s:%s-bulk' % (self.app, self.base_name)), data)
+        self.assertEqual([result['status'] for result in response.data['remove']], [403, 204])
+        self.assertEqual(Comment.objects.filter(is_removed=True).count(), 1)
+
     def test_history(self):
         article_ct = ContentType.objects.get_for_model(Article)
         article = Article.objects.create(text='text')
@@ -295,7 +683,7 @@ class ViewTests(APITestCase):
         self.assertEqual(len(results), 2)
 
 
-class TaskTests(TestCase):
+class TaskTests(TempMediaMixin, TestCase):
 
     @classmethod
     def setUpTestData(cls):
@@ -317,6 +705,98 @@ class TaskTests(TestCase):
             objs = serializers.deserialize("xml", f.file.read())
             self.assertEqual(next(objs).object.pk, c.pk)
 
+    def test_export_formats(self):
+        article_ct = ContentType.objects.get_for_model(Article)
+        article = Article.objects.create(text='text')
+        comments = [models.Comment.objects.create(content_type=article_ct, object_pk=article.pk,
+                                                  comment='Привет, "все"\n%s' % i, user=self.user) for i in range(3)]
+        with self.settings(CELERY_TASK_ALWAYS_EAGER=True, CELERY_TASK_EAGER_PROPAGATES=True):
+            f = models.File.objects.get(id=tasks.export.delay('ndjson', {}, compress=True).result)
+            self.assertTrue(f.file.name.endswith('.ndjson.gz'))
+            lines = gzip.GzipFile(fileobj=f.file).read().decode('utf-8').splitlines()
+            self.assertEqual([json.loads(line)['fields']['comment'] for line in lines],
+                             [c.comment for c in comments])
+
+            f = models.File.objects.get(id=tasks.export.delay('csv', {}).result)
+            rows = list(csv.reader(f.file))
+            self.assertEqual(rows[0][:3], ['pk', 'content_type', 'object_pk'])
+            self.assertEqual([row[rows[0].index('comment')].decode('utf-8') for row in rows[1:]],
+                             [c.comment for c in comments])
+
+    def test_export_sharded(self):
+        article_ct = ContentType.objects.get_for_model(Article)
+        article = Article.objects.create(text='text')
+        comments = []
+        for i in range(10):
+            comment = models.Comment.objects.create(content_type=article_ct, object_pk=article.pk, comment='c%s' % i,
+                                                    user=self.user)
+            models.Comment.objects.filter(id=comment.id).update(submit_date='2017-01-%02d 00:00:00Z' % (10 - i))
+            comments.insert(0, comment)
+        with self.settings(CELERY_TASK_ALWAYS_EAGER=True, CELERY_TASK_EAGER_PROPAGATES=True):
+            task = tasks.export_sharded('xml', {'date_to': '2017-01-10 00:00:00'}, False, 4)
+            f = models.File.objects.get(id=task.get())
+            self.assertEqual([obj.object.pk for obj in serializers.deserialize("xml", f.file.read())],
+                             [c.pk for c in comments[:-1]])
+
+            task = tasks.export_sharded('ndjson', {}, True, 3)
+            f = models.File.objects.get(id=task.get())
+            lines = gzip.GzipFile(fileobj=f.file).read().splitlines()
+            self.assertEqual([json.loads(line)['pk'] for line in lines], [c.pk for c in comments])
+            # the parts are removed
+            self.assertEqual(models.File.objects.count(), 2)
+
+    def test_history_partitions(self):
+        article_ct = ContentType.objects.get_for_model(Article)
+        article = Article.objects.create(text='text')
+        comment = Comment.objects.create(content_type=article_ct, object_pk=article.pk, comment='Hi', user=self.user)
+        # a month without a partition gets into the default one
+        event_date = datetime(2040, 5, 10, tzinfo=timezone.utc)
+        models.History.objects.create(comment=comment, event_date=event_date, old_comment='Hi', new_comment='Hello',
+                                      old_is_removed=False, new_is_removed=False)
+
+        created, expired = partitions.maintain_partitions(now=event_date, ahead=1, retention=2, drop=True)
+        self.assertEqual(created, ['comments_history_y2040m05', 'comments_history_y2040m06'])
+        self.assertIn('comments_history_y%04dm%02d' % (timezone.now().year, timezone.now().month), expired)
+        self.assertEqual(set(partitions.get_partitions()), set(created))
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT new_comment FROM comments_history_y2040m05')
+            self.assertEqual(cursor.fetchall(), [('Hello',)])
+        self.assertEqual(models.History.objects.get(event_date__gte=event_date).new_comment, 'Hello')
+
+        # nothing to do the next time
+        self.assertEqual(partitions.maintain_partitions(now=event_date, ahead=1, retention=2), ([], []))
+
+    def test_history_compaction(self):
+        article_ct = ContentType.objects.get_for_model(Article)
+        article = Article.objects.create(text='text')
+        texts = ['%s %s' % (' '.join(['word'] * 100), i) for i in range(7)]
+        comment = Comment.objects.create(content_type=article_ct, object_pk=article.pk, comment=texts[0],
+                                         user=self.user)
+        for text in texts[1:]:
+            comment.comment = text
+            comment.save()
+        comment.is_removed = True
+        comment.save()
+
+        # a full row every 3 changes
+        self.assertEqual(history.compact_history(interval=3), 4)
+        rows = models.History.objects.filter(comment=comment).order_by('event_date', 'id')
+        self.assertEqual([row.delta is None for row in rows], [True, False, False, True, False, False, True])
+        self.assertEqual(rows[1].new_comment, '')
+        self.assertEqual(history.compact_history(interval=3), 0)
+
+        self.assertEqual(history.get_versions(comment.pk), texts + [texts[-1]])
+        full = [(row.old_comment, row.new_comment, row.new_is_removed) for row in history.reconstruct(list(rows))]
+        self.assertEqual(full, list(zip(texts, texts[1:] + [texts[-1]], [False] * 6 + [True])))
+        self.assertEqual([(item['old_comment'], item['new_comment'])
+                          for item in HistorySerializer(rows, many=True).data], [f[:2] for f in full])
+
+        # the admin shows the full texts as well
+        admin = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'asdf1234')
+        self.client.force_login(admin)
+        response = self.client.get(reverse('admin:comments_comment_change', args=[comment.pk]))
+        self.assertContains(response, texts[2])
+
     @patch('push_notifications.models.GCMDeviceQuerySet.send_message')
     def test_push(self, send_message):
         # let's suppose the user got registered Google Cloud
@@ -327,26 +807,587 @@ class TaskTests(TestCase):
 
         article_ct = ContentType.objects.get_for_model(Article)
         article = Article.objects.create(text='text')
+        other_article = Article.objects.create(text='text')
 
         # the user got subscribed
         models.Subscription.objects.create(
             content_type=article_ct,
-            object_pk=article,
+            object_pk=article.pk,
             subscriber=self.user
         )
 
-        # someone has added a comment to the article
+        # someone has added comments to the articles
         user2 = get_user_model().objects.create_user('user2', 'asdf1234')
         with self.settings(CELERY_TASK_ALWAYS_EAGER=True, CELERY_TASK_EAGER_PROPAGATES=True):
             event_date = timezone.now()
-            message = {
-                'action': 'insert',
-                'id': 1,
-                'user': user2.id,
-                'event_date': str(event_date),
-                'content_type': article_ct.pk,
-                'object_pk': article.pk,
-                'comment': 'Hi'
-            }
-            task = tasks.notify.delay('insert', 1, article_ct.pk, article.pk, "Hi", user2.id, event_date)
-            send_message.assert_called_with(json.dumps(message))
+            events = [tasks.get_message('insert', 1, article_ct.pk, str(pk), 'Hi', user2.id, str(event_date))
+                      for pk in (article.pk, other_article.pk)]
+            tasks.notify.delay(events)
+            # the device gets only the event of the article it's subscribed to
+            send_message.assert_called_once_with(json.dumps({'events': events[:1]}))
+
+            # a message of the previous release
+            tasks.notify.delay('insert', 1, article_ct.pk, str(article.pk), 'Hi', user2.id, str(event_date))
+            send_message.assert_called_with(json.dumps({'events': events[:1]}))
+
+    @patch('push_notifications.models.GCMDeviceQuerySet.send_message')
+    @patch('comments.tasks.flush_notifications.apply_async')
+    def test_push_coalescing(self, apply_async, send_message):
+        GCMDevice.objects.create(user=self.user, registration_id='1234567890')
+        article_ct = ContentType.objects.get_for_model(Article)
+        article = Article.objects.create(text='text')
+        models.Subscription.objects.create(content_type=article_ct, object_pk=article.pk, subscriber=self.user)
+        cache.clear()
+
+        with self.settings(COMMENTS_NOTIFY_COALESCE_WINDOW=10), patch('django.db.transaction.on_commit',
+                                                                      lambda func, using=None: func()):
+            comment = Comment.objects.create(content_type=article_ct, object_pk=article.pk, comment='Hi',
+                                             user=self.user)
+            comment.comment = 'Hello'
+            comment.save()
+            comment.is_removed = True
+            comment.save()
+        # a single sending is scheduled for the window
+        apply_async.assert_called_once_with((article_ct.pk, str(article.pk)), countdown=10)
+
+        tasks.flush_notifications(article_ct.pk, str(article.pk))
+        self.assertEqual(send_message.call_count, 1)
+        message = json.loads(send_message.call_args[0][0])
+        self.assertEqual([event['action'] for event in message['events']], ['insert', 'update', 'delete'])
+        self.assertEqual(message['events'][1]['comment'], 'Hello')
+        self.assertFalse(models.PendingNotification.objects.exists())
+
+
+
+class LoadTestTests(TestCase):
+
+    def test_generated_dataset(self):
+        generator = datagen.Generator(seed=1, days=30)
+        self.assertEqual(generator.users(20), 20)
+        self.assertEqual(generator.comments(3, 300), 300)
+        self.assertEqual(generator.thread('deep', 30, 1), 31)
+        self.assertEqual(generator.thread('wide', 2, 50), 101)
+        self.assertEqual(generator.subscribers(5), 10)
+        self.assertEqual(generator.history(2, 10), 22)
+
+        article_ct = ContentType.objects.get_for_model(Article)
+        deep = Comment.objects.get(content_type=article_ct, object_pk=Article.objects.get(text='generated:deep').pk)
+        self.assertEqual(Comment.objects.filter(path__0=deep.pk).count(), 31)
+        self.assertEqual(max(len(path) for path in Comment.objects.values_list('path', flat=True)), 31)
+        # the counters and the search vectors are kept by the triggers for the copied rows
+        comment_ct = ContentType.objects.get_for_model(Comment)
+        self.assertEqual(counters.get_counters(comment_ct.pk, [deep.pk])[str(deep.pk)][0], 1)
+        comment = Comment.objects.filter(history__isnull=False).first()
+        self.assertEqual(history.get_versions(comment.pk)[-1], comment.comment)
+        self.assertEqual(len(history.get_versions(comment.pk)), 11)
+        self.assertIn(comment.pk, [row.pk for row in search.search_comments(Comment.objects.all(), comment.comment)])
+
+        results = loadtest.run(['comments_list', 'tree_deep', 'tree_wide_nested', 'history', 'notify'], repeat=3,
+                               warmup=0)
+        self.assertEqual(list(results['tree_deep'])[:3], ['p50_ms', 'p95_ms', 'p99_ms'])
+        self.assertEqual(results['comments_list']['queries'], 3)
+        changes = loadtest.compare(results, results)
+        self.assertEqual(changes['notify']['p95_ms'], 0)
+
+
+@override_settings(COMMENTS_NOTIFY_COALESCE_WINDOW=0)
+class NotificationTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('user', 'asdf1234')
+        self.article_ct = ContentType.objects.get_for_model(Article)
+        self.article = Article.objects.create(text='text')
+
+    def add_comment(self, text):
+        return Comment.objects.create(content_type=self.article_ct, object_pk=self.article.pk, comment=text,
+                                      user=self.user)
+
+    @patch('comments.tasks.notify.delay')
+    def test_rollback(self, delay):
+        with transaction.atomic():
+            self.add_comment('Hi')
+            delay.assert_not_called()
+            transaction.set_rollback(True)
+        delay.assert_not_called()
+
+        with transaction.atomic():
+            comment = self.add_comment('Hi')
+            with transaction.atomic():
+                comment.comment = 'Hello'
+                comment.save()
+                transaction.set_rollback(True)
+        delay.assert_called_once()
+        self.assertEqual([event['action'] for event in delay.call_args[0][0]], ['insert'])
+
+    @patch('comments.tasks.notify.delay')
+    def test_batch(self, delay):
+        with notifications.batch():
+            comment = self.add_comment('Hi')
+            with transaction.atomic():
+                comment.comment = 'Hello'
+                comment.save()
+                self.add_comment('Hey')
+            delay.assert_not_called()
+        delay.assert_called_once()
+        events = delay.call_args[0][0]
+        self.assertEqual([(event['action'], event['comment']) for event in events],
+                         [('insert', 'Hi'), ('update', 'Hello'), ('insert', 'Hey')])
+        self.assertEqual(events[0]['object_pk'], str(self.article.pk))
+
+
+@override_settings(COMMENTS_METRICS_FLUSH_INTERVAL=0, COMMENTS_METRICS_BUCKETS=(0.1, 1))
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.user = get_user_model().objects.create_user('user', password='asdf1234')
+        self.client.force_login(self.user)
+
+    def tearDown(self):
+        metrics.reset()
+
+    def test_metrics(self):
+        article_ct = ContentType.objects.get_for_model(Article)
+        article = Article.objects.create(text='text')
+        Comment.objects.create(content_type=article_ct, object_pk=article.pk, comment='c1', user=self.user)
+        params = {'content_type': article_ct.pk, 'object_pk': article.pk}
+        for i in range(2):
+            self.assertEqual(self.client.get(reverse('comments:comment-list'), params).status_code, 200)
+        # a task sent half a second ago
+        tasks.notify.apply(args=[[]], headers={metrics.SENT_AT_HEADER: time.time() - 0.5})
+
+        series = dict(metrics.get_series())
+        self.assertEqual(series[('comments_http_request_duration_seconds',
+                                 ('comments:comment-list', 'list', '2xx'))]['count'], 2)
+        queries = series[('comments_http_queries_total', ('comments:comment-list', 'list'))]['sum']
+        with self.assertNumQueries(queries // 2):
+            self.client.get(reverse('comments:comment-list'), params)
+        # the counting neither turns the debug cursor on nor formats the statements
+        with patch.object(connection.ops, 'last_executed_query') as last_executed_query:
+            self.client.get(reverse('comments:comment-list'), params)
+            self.assertFalse(connection.force_debug_cursor)
+        self.assertFalse(last_executed_query.called)
+        metrics.flush()
+        self.assertEqual(dict(metrics.get_series())[
+            ('comments_http_queries_total', ('comments:comment-list', 'list'))]['sum'], queries // 2 * 4)
+        wait = series[('comments_task_queue_wait_seconds', ('comments.tasks.notify',))]
+        self.assertEqual((wait['bucket0'], wait['bucket1'], wait['bucket2']), (0, 1, 0))
+        self.assertAlmostEqual(wait['sum'], 0.5, delta=0.1)
+        self.assertEqual(series[('comments_task_duration_seconds', ('comments.tasks.notify', 'SUCCESS'))]['count'], 1)
+
+        response = self.client.get(reverse('comments:metrics'))
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        text = response.content.decode('utf-8')
+        self.assertIn('comments_http_request_duration_seconds_bucket{view="comments:comment-list",action="list",'
+                      'status="2xx",le="+Inf"} 4', text)
+        self.assertIn('comments_task_queue_wait_seconds_bucket{task="comments.tasks.notify",le="1"} 1', text)
+        self.assertIn('# TYPE comments_task_duration_seconds histogram', text)
+        # a user, who isn't the staff, from an address, which isn't allowed
+        self.assertEqual(self.client.get(reverse('comments:metrics'), REMOTE_ADDR='10.0.0.1').status_code, 403)
+        # the command doesn't see the servers through a locmem cache
+        self.assertRaises(CommandError, call_command, 'metrics')
+
+
+@override_settings(COMMENTS_PROFILE_TOKEN='secret', COMMENTS_PROFILE_EXPLAIN_SLOWEST=10)
+class ProfilingTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'asdf1234')
+        self.client.force_login(self.user)
+        self.article_ct = ContentType.objects.get_for_model(Article)
+        self.article = Article.objects.create(text='text')
+        comment = Comment.objects.create(content_type=self.article_ct, object_pk=self.article.pk, comment='c1',
+                                         user=self.user)
+        Comment.objects.create(content_type=ContentType.objects.get_for_model(Comment), object_pk=comment.pk,
+                               comment='c2', user=self.user)
+
+    def test_profile(self):
+        url = reverse('comments:child-comments', kwargs={'content_type_id': self.article_ct.pk,
+                                                         'object_id': self.article.pk})
+        response = self.client.get(url, HTTP_X_COMMENTS_PROFILE='wrong')
+        self.assertNotIn('X-Comments-Profile-Id', response)
+        # the tree is read from the database
+        trees.get_cache().clear()
+        response = self.client.get(url, HTTP_X_COMMENTS_PROFILE='secret')
+        profile = models.Profile.objects.get(pk=response['X-Comments-Profile-Id'])
+        self.assertEqual((profile.view, profile.status, profile.user), ('comments:child-comments', 200, self.user))
+        # the recursive query of the tree is explained with its parameters
+        tree = [query for query in profile.queries if 'WITH roots' in query['sql']][0]
+        self.assertIn('Buffers', tree['explain'])
+        self.assertIn('cumulative', profile.python_profile)
+
+        # a streamed tree is saved when it's read, the query of its server side cursor is explained
+        response = self.client.get(url, {'stream': 1}, HTTP_X_COMMENTS_PROFILE='secret')
+        self.assertEqual(models.Profile.objects.count(), 1)
+        b''.join(response.streaming_content)
+        profile = models.Profile.objects.first()
+        tree = [query for query in profile.queries if 'WITH roots' in query['sql']][0]
+        self.assertIn('actual time', tree['explain'])
+        # a statement changing data isn't explained
+        self.assertIsNone(profiling.explain('default', 'UPDATE comments_comment SET comment = comment'))
+        # a statement with side effects isn't run
+        ids = models.reserve_ids(Comment, 1)
+        plan = profiling.explain('default', "SELECT nextval(pg_get_serial_sequence('comments_comment', 'id')) "
+                                            "FROM generate_series(1, 10)")
+        self.assertNotIn('actual time', plan)
+        self.assertEqual(models.reserve_ids(Comment, 1), [ids[0] + 1])
+
+        with override_settings(COMMENTS_PROFILE_TOKEN=None, COMMENTS_PROFILE_SAMPLE_RATE=1):
+            self.client.get(reverse('comments:comment-list'), {'content_type': self.article_ct.pk,
+                                                                'object_pk': self.article.pk})
+        profile = models.Profile.objects.first()
+        self.assertEqual(profile.view, 'comments:comment-list')
+        self.assertGreater(profile.serializer_time, 0)
+        response = self.client.get(reverse('admin:comments_profile_change', args=[profile.pk]))
+        self.assertContains(response, 'Buffers')
+
+
+# the export runs in the process, the committed comments send no notification to the broker
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True, CELERY_TASK_EAGER_PROPAGATES=True, COMMENTS_NOTIFY_COALESCE_WINDOW=0,
+                   COMMENTS_EXPORT_PROGRESS_ROWS=2)
+class ExportProgressTests(TempMediaMixin, TransactionTestCase):
+
+    def setUp(self):
+        super(ExportProgressTests, self).setUp()
+        self.user = get_user_model().objects.create_user('user', password='asdf1234')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        article_ct = ContentType.objects.get_for_model(Article)
+        article = Article.objects.create(text='text')
+        for i in range(5):
+            Comment.objects.create(content_type=article_ct, object_pk=article.pk, comment='c%s' % i, user=self.user)
+
+    def test_progress(self):
+        response = self.client.post(reverse('comments:comment-export', kwargs={'export_format': 'csv'}), {'shards': 2})
+        # the parts report their rows to the merging task
+        state = models.ExportProgress.objects.get()
+        self.assertEqual((state.state, state.rows), ('SUCCESS', 5))
+        response = self.client.get(response['Location'], {'wait': 10})
+        self.assertEqual((response.status_code, response['Location']), (204, state.file.file.url))
+
+    def test_reuse(self):
+        url = reverse('comments:comment-export', kwargs={'export_format': 'csv'})
+        article_ct = ContentType.objects.get_for_model(Article)
+        first = self.client.post(url, {'content_type': article_ct.pk, 'date_from': '2017-01-01 00:00'})['Location']
+        # the same params written otherwise
+        self.assertEqual(self.client.post(url, {'date_from': '2017-01-01 00:00:00', 'content_type': article_ct.pk,
+                                                'shards': 2})['Location'], first)
+        self.assertEqual(models.File.objects.count(), 1)
+        self.assertNotEqual(self.client.post(url, {'content_type': article_ct.pk, 'compress': True})['Location'],
+                            first)
+
+        # a changed comment makes a new export
+        comment = Comment.objects.first()
+        comment.comment = 'changed'
+        comment.save()
+        second = self.client.post(url, {'content_type': article_ct.pk, 'date_from': '2017-01-01 00:00'})['Location']
+        self.assertNotEqual(second, first)
+        self.assertEqual(models.File.objects.count(), 3)
+
+        # the old files are deleted with their storage objects, the progress of the export is kept
+        first_id = first.rstrip('/').split('/')[-1]
+        old = models.File.objects.get(exportprogress__task_id=first_id)
+        models.File.objects.filter(pk=old.pk).update(add_date=timezone.now() - timedelta(days=2))
+        models.ExportProgress.objects.filter(task_id=first_id).update(updated=timezone.now() - timedelta(days=2))
+        self.assertEqual(progress.expire_files(), 1)
+        self.assertFalse(old.file.storage.exists(old.file.name))
+        self.assertEqual(self.client.get(first).status_code, 410)
+        self.assertEqual(self.client.get(second).status_code, 204)
+        # the result backend outlives the progress
+        models.ExportProgress.objects.filter(task_id=first_id).update(updated=timezone.now() - timedelta(days=8))
+        self.assertEqual(progress.expire_files(), 0)
+        self.assertFalse(models.ExportProgress.objects.filter(task_id=first_id).exists())
+        with patch('comments.views.AsyncResult') as result:
+            result.return_value.state, result.return_value.result = 'SUCCESS', old.pk
+            self.assertEqual(self.client.get(first).status_code, 410)
+
+        # an archived thread, whose comments aren't the last ones, isn't in the history
+        article = Article.objects.create(text='text')
+        Comment.objects.create(content_type=article_ct, object_pk=article.pk, comment='new', user=self.user)
+        third = self.client.post(url, {'content_type': article_ct.pk})['Location']
+        self.assertEqual(self.client.post(url, {'content_type': article_ct.pk})['Location'], third)
+        old = timezone.now() - timedelta(days=2)
+        models.Counter.objects.exclude(object_pk=article.pk).update(last_modified=old, last_activity=old)
+        self.assertEqual(archive.archive_dormant(days=1), 5)
+        fourth = self.client.post(url, {'content_type': article_ct.pk})['Location']
+        self.assertNotEqual(fourth, third)
+        self.assertEqual(archive.restore(entities=[(article_ct.pk, comment.object_pk)]), 5)
+        self.assertNotIn(self.client.post(url, {'content_type': article_ct.pk})['Location'], (third, fourth))
+
+    def test_wait(self):
+        task_id = str(uuid.uuid4())
+        progress.report(task_id, 'STARTED')
+        url = reverse('comments:result', kwargs={'id': task_id})
+
+        def export():
+            time.sleep(0.3)
+            progress.report(task_id, 'PROGRESS', 10000)
+            connection.close()
+
+        thread = threading.Thread(target=export)
+        thread.start()
+        started = time.time()
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(url, {'wait': 10})
+        thread.join()
+        # woken up by the notification, the state is read once before and once after
+        self.assertLess(time.time() - started, 5)
+        self.assertEqual((response.status_code, response.data['state'], response.data['rows']),
+                         (202, 'PROGRESS', 10000))
+        self.assertEqual(len([query for query in captured.captured_queries if 'SELECT' in query['sql']]), 2)
+
+        # no change
+        started = time.time()
+        response = self.client.get(url, {'wait': 0.2})
+        self.assertGreaterEqual(time.time() - started, 0.2)
+        self.assertEqual(response.data['rows'], 10000)
+
+        # a failed part is reported at once, the result backend isn't waited for
+        progress.report(task_id, 'FAILURE', error="ValueError('part',)")
+        with patch('comments.views.AsyncResult') as result:
+            response = self.client.get(url, {'wait': 10})
+        self.assertEqual((response.status_code, response.data['detail']), (500, "ValueError('part',)"))
+        self.assertFalse(result.called)
+
+
+class ArchiveTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('user', 'asdf1234')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.article = Article.objects.create(text='text')
+        self.article_ct = ContentType.objects.get_for_model(Article)
+        self.comment_ct = ContentType.objects.get_for_model(Comment)
+
+    def add(self, text, parent=None):
+        if parent is None:
+            return Comment.objects.create(content_type=self.article_ct, object_pk=self.article.pk, comment=text,
+                                          user=self.user)
+        return Comment.objects.create(content_type=self.comment_ct, object_pk=parent.pk, comment=text,
+                                      user=self.user)
+
+    def remove(self, comment):
+        comment.is_removed = True
+        comment.save()
+
+    def test_removed(self):
+        root = self.add('c1')
+        reply = self.add('c2', root)
+        reply_to_reply = self.add('c3', reply)
+        removed = self.add('c4', root)
+        self.remove(reply)
+        self.remove(removed)
+        # a removed comment with a reply left stays
+        self.assertEqual(archive.archive_removed(days=0), 1)
+        self.assertEqual(list(models.ArchivedComment.objects.values_list('id', 'reason')), [(removed.pk, 'removed')])
+        self.assertFalse(Comment.objects.filter(pk=removed.pk).exists())
+        # the history stays
+        response = self.client.get(reverse('comments:history-list'))
+        self.assertIn(removed.pk, [item['comment'] for item in response.data['results']])
+        self.assertEqual(archive.archive_removed(days=30), 0)
+
+        # the parent is archived after its reply
+        self.remove(reply_to_reply)
+        self.assertEqual(archive.archive_removed(days=0), 2)
+        self.assertEqual(list(Comment.objects.values_list('id', flat=True)), [root.pk])
+        self.assertEqual(root.get_counters()[0], 0)
+
+        # a recovered comment comes back with its thread
+        self.assertFalse(archive.recover(reply_to_reply.pk, self.user).is_removed)
+        self.assertFalse(models.ArchivedComment.objects.exists())
+        self.assertEqual(sorted(Comment.objects.filter(is_removed=True).values_list('id', flat=True)),
+                         [reply.pk, removed.pk])
+        self.assertEqual(Comment.objects.get(pk=reply.pk).get_counters()[0], 1)
+        self.assertTrue(models.History.objects.filter(comment=reply_to_reply, new_is_removed=False).exists())
+
+    def test_dormant(self):
+        root = self.add('c1')
+        reply = self.add('c2', root)
+        old = timezone.now() - timedelta(days=400)
+        models.Counter.objects.update(last_modified=old, last_activity=old)
+        self.assertEqual(archive.archive_dormant(days=365), 2)
+        self.assertFalse(Comment.objects.exists())
+        self.assertEqual(archive.archive_dormant(days=365), 0)
+
+        url = reverse('comments:comment-list')
+        response = self.client.get(url, {'user': self.user.pk})
+        self.assertEqual(response.data['count'], 0)
+        response = self.client.get(url, {'user': self.user.pk, 'include_archived': 1})
+        self.assertEqual([item['id'] for item in response.data['results']], [root.pk, reply.pk])
+        self.assertEqual(response.data['results'][0]['reply_count'], 1)
+        response = self.client.get(url, {'user': self.user.pk, 'include_archived': 1, 'cursor': '', 'limit': 1})
+        self.assertEqual([item['id'] for item in response.data['results']], [root.pk])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([item['id'] for item in response.data['results']], [reply.pk])
+        self.assertIsNone(response.data['next'])
+
+        detail = reverse('comments:comment-detail', kwargs={'pk': reply.pk})
+        self.assertEqual(self.client.get(detail).status_code, 404)
+        self.assertEqual(self.client.get(detail, {'include_archived': 1}).data['comment'], 'c2')
+        tree = reverse('comments:child-comments', kwargs={'content_type_id': self.article_ct.pk,
+                                                          'object_id': self.article.pk})
+        self.assertEqual(self.client.get(tree).data, [])
+        self.assertEqual([node['id'] for node in self.client.get(tree, {'include_archived': 1}).data],
+                         [root.pk, reply.pk])
+
+        # a reply brings the thread back
+        response = self.client.post(url, {'content_type': self.comment_ct.pk, 'object_pk': reply.pk,
+                                          'comment': 'c3'})
+        self.assertEqual(response.status_code, 201, format_response_message(response))
+        self.assertFalse(models.ArchivedComment.objects.exists())
+        self.assertEqual(Comment.objects.get(pk=response.data['id']).path, [root.pk, reply.pk, response.data['id']])
+        self.assertEqual(root.get_counters()[0], 1)
+
+
+        # a comment moved to the entity brings the thread back as well
+        models.Counter.objects.update(last_modified=old, last_activity=old)
+        self.assertEqual(archive.archive_dormant(days=365), 3)
+        other = Article.objects.create(text='other')
+        moved = Comment.objects.create(content_type=self.article_ct, object_pk=other.pk, comment='c4', user=self.user)
+        moved.object_pk = self.article.pk
+        moved.save()
+        self.assertFalse(models.ArchivedComment.objects.exists())
+        self.assertEqual([row['id'] for row in trees.fetch_tree(self.article_ct.pk, self.article.pk)],
+                         [root.pk, reply.pk, response.data['id'], moved.pk])
+
+        # an entity without archived threads doesn't go into the archive
+        with patch('comments.archive.restore') as restore:
+            self.add('c5')
+        self.assertFalse(restore.called)
+
+
+# the hot trees are rebuilt by the task run in the process
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True, CELERY_TASK_EAGER_PROPAGATES=True, COMMENTS_NOTIFY_COALESCE_WINDOW=0,
+                   COMMENTS_TREE_CACHE_HOT_READS=3)
+class TreeCacheTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('user', 'asdf1234')
+        self.article_ct = ContentType.objects.get_for_model(Article)
+        self.comment_ct = ContentType.objects.get_for_model(Comment)
+        self.article = Article.objects.create(text='text')
+
+    def get_version(self):
+        return counters.get_thread_version(self.article_ct.pk, self.article.pk)[0]
+
+    def test_invalidation(self):
+        parent = Comment.objects.create(content_type=self.article_ct, object_pk=self.article.pk, comment='c1',
+                                        user=self.user)
+        reply = Comment.objects.create(content_type=self.comment_ct, object_pk=parent.pk, comment='c2',
+                                       user=self.user)
+        self.assertEqual(len(trees.get_tree(self.article_ct.pk, self.article.pk)), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(trees.get_tree(self.article_ct.pk, str(self.article.pk))), 2)
+        self.assertEqual(len(trees.get_tree(self.comment_ct.pk, parent.pk)), 1)
+        self.assertEqual(trees.get_stats(), {'hits': 1, 'stale': 0, 'misses': 2, 'warmed': 0})
+
+        # a reply to a reply changes the trees of all its ancestors
+        Comment.objects.create(content_type=self.comment_ct, object_pk=reply.pk, comment='c3', user=self.user)
+        self.assertEqual(len(trees.get_tree(self.article_ct.pk, self.article.pk)), 3)
+        self.assertEqual(len(trees.get_tree(self.comment_ct.pk, parent.pk)), 2)
+        with transaction.atomic():
+            bulk.update_comments([{'id': reply.pk, 'comment': 'Hello'}], self.user)
+        self.assertEqual([row['comment'] for row in trees.get_tree(self.comment_ct.pk, parent.pk)],
+                         ['Hello', 'c3'])
+
+        # an expired tree is served while another request rebuilds it
+        key, lock_key = trees.get_tree_keys(cache, self.comment_ct.pk, parent.pk, None)
+        fresh_until, tree = cache.get(key)
+        cache.set(key, (0, tree))
+        cache.add(lock_key, True)
+        with self.assertNumQueries(0):
+            self.assertEqual(trees.get_tree(self.comment_ct.pk, parent.pk), tree)
+
+    def test_warming(self):
+        comment = Comment.objects.create(content_type=self.article_ct, object_pk=self.article.pk, comment='c1',
+                                         user=self.user)
+        for i in range(3):
+            trees.get_tree(self.article_ct.pk, self.article.pk, self.get_version())
+        # the hot tree is rebuilt by the task (run eagerly) as soon as it changes
+        comment.comment = 'Hello'
+        comment.save()
+        self.assertEqual(trees.get_stats()['warmed'], 1)
+        version = self.get_version()
+        with self.assertNumQueries(0):
+            self.assertEqual(trees.get_tree(self.article_ct.pk, self.article.pk, version)[0]['comment'], 'Hello')
+
+    def test_version(self):
+        comment = Comment.objects.create(content_type=self.article_ct, object_pk=self.article.pk, comment='c1',
+                                         user=self.user)
+        version = self.get_version()
+        self.assertEqual(trees.get_tree(self.article_ct.pk, self.article.pk, version)[0]['comment'], 'c1')
+        # a change, whose invalidation hasn't reached the cache (of another process or not committed yet)
+        with patch('comments.trees.invalidate'):
+            comment.comment = 'Hello'
+            comment.save()
+        self.assertEqual(trees.get_tree(self.article_ct.pk, self.article.pk, version)[0]['comment'], 'c1')
+        self.assertEqual(trees.get_tree(self.article_ct.pk, self.article.pk, self.get_version())[0]['comment'],
+                         'Hello')
+
+
+# the notification of the committed comment is sent in the process
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True, CELERY_TASK_EAGER_PROPAGATES=True, COMMENTS_NOTIFY_COALESCE_WINDOW=0,
+                   COMMENTS_READ_REPLICAS=['replica'], COMMENTS_REPLICA_MAX_LAG=5)
+class ReplicaRouterTests(TransactionTestCase):
+    """
+    The replica is a stand-in, its state is patched and the reads routed to it aren't made
+    """
+
+    def setUp(self):
+        cache.clear()
+        routers._states.clear()
+        self.router = routers.ReplicaRouter()
+        self.user = get_user_model().objects.create_user('user', 'asdf1234')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_replica_state(self):
+        lag, lsn = routers.get_replica_state('default')
+        self.assertEqual(lag, 0)
+        self.assertLessEqual(lsn, routers.get_primary_lsn())
+        self.assertEqual(routers.parse_lsn('16/B374D848'), 0x16B374D848)
+
+    def test_lag(self):
+        with patch('comments.routers.get_replica_state', return_value=(1, 100)) as get_state:
+            self.assertEqual(self.router.db_for_read(Comment), 'replica')
+            self.assertEqual(self.router.db_for_read(models.File), None)
+            self.assertEqual(self.router.db_for_write(Comment), 'default')
+            # the writes of a transaction are seen by its reads
+            with transaction.atomic():
+                self.assertEqual(self.router.db_for_read(Comment), 'default')
+            # the state is checked once per interval
+            self.assertEqual(get_state.call_count, 1)
+        routers._states.clear()
+        with patch('comments.routers.get_replica_state', return_value=(10, 100)):
+            self.assertEqual(self.router.db_for_read(Comment), 'default')
+        routers._states.clear()
+        with patch('comments.routers.get_replica_state', return_value=(None, None)):
+            self.assertEqual(self.router.db_for_read(Comment), 'default')
+
+    def test_read_your_writes(self):
+        article = Article.objects.create(text='text')
+        data = {'content_type': ContentType.objects.get_for_model(Article).pk, 'object_pk': article.pk,
+                'comment': 'Hi'}
+        response = self.client.post(reverse('comments:comment-list'), data)
+        self.assertEqual(response.status_code, 201, format_response_message(response))
+        written = cache.get('comments:written-lsn:user:%s' % self.user.pk)
+        self.assertLessEqual(written, routers.get_primary_lsn())
+
+        request = response.wsgi_request
+        with patch('comments.routers.get_replica_state', return_value=(0, written - 1)):
+            with routers.reading(request):
+                self.assertEqual(self.router.db_for_read(Comment), 'default')
+            # a request of another user doesn't wait for the write
+            request.user = get_user_model().objects.create_user('other', 'asdf1234')
+            with routers.reading(request):
+                self.assertEqual(self.router.db_for_read(Comment), 'replica')
+        routers._states.clear()
+        request.user = self.user
+        with patch('comments.routers.get_replica_state', return_value=(0, written)):
+            with routers.reading(request):
+                self.assertEqual(self.router.db_for_read(Comment), 'replica')
+            with routers.reading(request, primary=True):
+                self.assertEqual(self.router.db_for_read(Comment), 'default')
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+The child comment trees (see ChildCommentView) and their cache.
+
+A tree is cached by (content_type_id, object_id) and the version of its thread for COMMENTS_TREE_CACHE_TIMEOUT
+seconds. The version is the one of the ETag (see `counters.get_thread_version`), read from the database before the
+tree, so a cache, which an invalidation hasn't reached, never serves a tree older than its ETag. A committed change of
+a comment invalidates the trees of all the comments of its path and of the entity its thread is on. A tree, which has
+expired, is rebuilt by a single request while the others get the old one, and a missing tree is built by a single
+request while the others wait for it a little, so the readers of a popular thread don't hit the database all at once.
+The trees read at least COMMENTS_TREE_CACHE_HOT_READS times during a timeout are rebuilt by a task as soon as they
+are invalidated. The cache counts the hits and the misses, see `get_stats`.
+"""
+from __future__ import unicode_literals
+
+from datetime import datetime
+import time
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
+from django.db import connection, connections, router, transaction
+from django.utils import timezone
+from django.utils.encoding import force_text
+from rest_framework.renderers import JSONRenderer
+
+import counters
+import models
+
+# A subtree is a range of paths, see `models.path_end`. Replies to removed comments are hidden as well.
+# The user name is the one of `User.get_full_name`, like in the comment list.
+SQL_SELECT_SUBTREE = r"""
+SELECT c.id, c.content_type_id, c.object_pk, c.user_id, c.changed_by_id, c.comment, c.submit_date, c.is_removed,
+       btrim(u.first_name || ' ' || u.last_name) AS user_name
+FROM subtree c
+JOIN auth_user u ON u.id = c.user_id
+WHERE c.is_removed = false AND NOT c.path && ARRAY(SELECT id FROM subtree WHERE is_removed)
+ORDER BY c.submit_date;
+"""
+
+# Every comment of the entity is a root of a subtree
+SQL_GET_CHILDREN = r"""
+WITH roots AS (
+  SELECT path, path[1:array_length(path, 1) - 1] || (path[array_length(path, 1)] + 1) AS path_end
+  FROM comments_comment
+  WHERE object_pk = %s AND content_type_id = %s AND is_removed = false
+), subtree AS (
+  -- the columns out of the model aren't read
+  SELECT c.id, c.content_type_id, c.object_pk, c.user_id, c.changed_by_id, c.comment, c.submit_date, c.is_removed,
+         c.path
+  FROM roots
+  JOIN comments_comment c ON c.path >= roots.path AND c.path < roots.path_end
+)
+""" + SQL_SELECT_SUBTREE
+
+# Replies of a comment are its subtree without the comment itself
+SQL_GET_REPLIES = r"""
+WITH subtree AS (
+  -- the columns out of the model aren't read
+  SELECT c.id, c.content_type_id, c.object_pk, c.user_id, c.changed_by_id, c.comment, c.submit_date, c.is_removed,
+         c.path
+  FROM comments_comment parent
+  JOIN comments_comment c ON c.path > parent.path
+    AND c.path < parent.path[1:array_length(parent.path, 1) - 1] || (parent.path[array_length(parent.path, 1)] + 1)
+  WHERE parent.id = %s
+)
+""" + SQL_SELECT_SUBTREE
+
+# The nested tree is walked from the top down, every node takes at most `max_children + 1` of its replies (the extra
+# one tells there are more) by the parent index, so the query reads at most (max_children + 1) ** max_depth rows
+# whatever the size of the thread. The nodes on the last level only check whether they have replies.
+SQL_GET_NESTED = r"""
+WITH RECURSIVE tree AS (
+  (SELECT c.id, c.content_type_id, c.object_pk, c.user_id, c.changed_by_id, c.comment, c.submit_date, c.is_removed,
+          c.parent, 1 AS depth, row_number() OVER (ORDER BY c.submit_date, c.id) AS position
+   FROM comments_comment c
+   WHERE {top} AND c.is_removed = false AND (c.submit_date, c.id) > (%(after_date)s, %(after_id)s)
+   ORDER BY c.submit_date, c.id
+   LIMIT %(limit)s)
+  UNION ALL
+  SELECT r.id, r.content_type_id, r.object_pk, r.user_id, r.changed_by_id, r.comment, r.submit_date, r.is_removed,
+         r.parent, tree.depth + 1, r.position
+  FROM tree
+  CROSS JOIN LATERAL (
+    SELECT c.*, row_number() OVER (ORDER BY c.submit_date, c.id) AS position
+    FROM comments_comment c
+    WHERE c.parent = tree.id AND c.is_removed = false
+    ORDER BY c.submit_date, c.id
+    LIMIT %(limit)s
+  ) r
+  WHERE tree.depth < %(max_depth)s AND tree.position < %(limit)s
+)
+SELECT t.id, t.content_type_id, t.object_pk, t.user_id, t.changed_by_id, t.comment, t.submit_date, t.is_removed,
+       btrim(u.first_name || ' ' || u.last_name) AS user_name, t.parent, t.depth, t.position,
+       t.depth = %(max_depth)s AND EXISTS (
+         SELECT 1 FROM comments_comment c WHERE c.parent = t.id AND c.is_removed = false) AS has_replies
+FROM tree t
+JOIN auth_user u ON u.id = t.user_id
+ORDER BY t.depth, t.position;
+"""
+
+# the replies of a comment or the comments on another entity
+SQL_NESTED_REPLIES = 'c.parent = %(object_id)s::int'
+SQL_NESTED_CHILDREN = 'c.content_type_id = %(content_type_id)s AND c.object_pk = %(object_id)s'
+
+# the fields of the node used to build the tree and not shown
+NESTED_FIELDS = ('parent', 'depth', 'position', 'has_replies')
+
+STATS = ('hits', 'stale', 'misses', 'warmed')
+# the number of the waits for a tree built by another request, and the seconds between them
+BUILD_WAITS = 20
+BUILD_WAIT = 0.05
+
+
+def dictfetchall(cursor):
+    "Returns all rows from a cursor as a dict"
+    desc = [col[0] for col in cursor.description]
+    return [dict(zip(desc, row)) for row in cursor.fetchall()]
+
+
+def execute_tree(cursor, content_type_id, object_id):
+    if int(content_type_id) == ContentType.objects.get_for_model(models.Comment).id:
+        cursor.execute(SQL_GET_REPLIES, (object_id,))
+    else:
+        cursor.execute(SQL_GET_CHILDREN, (force_text(object_id), content_type_id))
+
+
+def fetch_tree(content_type_id, object_id):
+    """
+    Reads the tree of the comments on the entity from the database. The cached trees are read from the default one,
+    a tree read from a lagging replica would be kept as the tree of the generation after the change.
+    """
+    with connection.cursor() as cursor:
+        execute_tree(cursor, content_type_id, object_id)
+        return dictfetchall(cursor)
+
+
+def stream_tree(content_type_id, object_id, batch_size=None, using=None):
+    """
+    Yields the tree of the comments on the entity as parts of a JSON array. The rows are read by a server side cursor
+    in batches of COMMENTS_TREE_STREAM_BATCH rows, so the memory used doesn't depend on the size of the tree.
+    A streaming response is read after the view returns, so the view picks the database.
+    """
+    batch_size = batch_size or getattr(settings, 'COMMENTS_TREE_STREAM_BATCH', 500)
+    renderer = JSONRenderer()
+    # out of a transaction the cursor would be WITH HOLD, which reads all the rows before the first one is fetched
+    using = using or router.db_for_read(models.Comment)
+    with transaction.atomic(using):
+        cursor = connections[using].chunked_cursor()
+        try:
+            execute_tree(cursor, content_type_id, object_id)
+            yield b'['
+            columns = None
+            separator = b''
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                # a named cursor has the description once the first rows are fetched
+                columns = columns or [col[0] for col in cursor.description]
+                yield separator + b','.join(renderer.render(dict(zip(columns, row))) for row in rows)
+                separator = b','
+            yield b']'
+        finally:
+            cursor.close()
+
+
+def get_nested_tree(content_type_id, object_id, max_depth, max_children, link, after=None):
+    """
+    Returns the tree of the comments on the entity limited to `max_depth` levels and `max_children` replies per node,
+    starting after the comment with the `after` key (submit_date, id), and the link to the rest of the top level.
+
+    Every node has its `replies` and the `next` link to the rest of them, if they aren't all shown. A link is made by
+    `link(content_type_id, object_id, key)`, where the key is the one of the last comment shown or None.
+    """
+    comment_type = ContentType.objects.get_for_model(models.Comment).id
+    top = SQL_NESTED_REPLIES if int(content_type_id) == comment_type else SQL_NESTED_CHILDREN
+    after_date, after_id = after or (datetime.min.replace(tzinfo=timezone.utc), 0)
+    with connections[router.db_for_read(models.Comment)].cursor() as cursor:
+        cursor.execute(SQL_GET_NESTED.format(top=top), {
+            'content_type_id': content_type_id, 'object_id': force_text(object_id), 'after_date': after_date,
+            'after_id': after_id, 'max_depth': max_depth, 'limit': max_children + 1})
+        rows = dictfetchall(cursor)
+
+    # a single pass, the parents come before their replies and the replies are in order
+    top_nodes, top_next = [], None
+    nodes = {}
+    for row in rows:
+        siblings = top_nodes if row['depth'] == 1 else nodes[row['parent']]['replies']
+        if row['position'] > max_children:
+            # the extra reply tells there are more of them
+            key = [siblings[-1]['submit_date'], siblings[-1]['id']]
+            if row['depth'] == 1:
+                top_next = link(content_type_id, object_id, key)
+            else:
+                nodes[row['parent']]['next'] = link(comment_type, row['parent'], key)
+            continue
+        node = dict((field, value) for field, value in row.items() if field not in NESTED_FIELDS)
+        node['replies'] = []
+        # the replies on the last level aren't read
+        node['next'] = link(comment_type, row['id'], None) if row['has_replies'] else None
+        nodes[row['id']] = node
+        siblings.append(node)
+    return top_nodes, top_next
+
+
+def get_cache():
+    return caches[getattr(settings, 'COMMENTS_TREE_CACHE', 'default')]
+
+
+def get_timeout():
+    return getattr(settings, 'COMMENTS_TREE_CACHE_TIMEOUT', 60)
+
+
+def get_hot_reads():
+    return getattr(settings, 'COMMENTS_TREE_CACHE_HOT_READS', 100)
+
+
+def get_key(kind, content_type_id, object_id):
+    return 'comments:tree-%s:%s:%s' % (kind, content_type_id, object_id)
+
+
+def get_generation(cache, content_type_id, object_id):
+    """
+    Returns the generation of the tree, which is a part of the key of the cached tree. An invalidation increments it,
+    so a tree built from the data read before the invalidation is never found.
+    """
+    key = get_key('generation', content_type_id, object_id)
+    generation = cache.get(key)
+    if generation is None:
+        # a generation evicted from the cache doesn't start again from a value used before
+        cache.add(key, int(time.time() * 1000), None)
+        generation = cache.get(key)
+    return generation
+
+
+def get_tree_keys(cache, content_type_id, object_id, version):
+    """
+    Returns the keys of the tree and of the lock of its build for the generation and the version of the thread
+    """
+    suffix = '%s:%s' % (get_generation(cache, content_type_id, object_id), version)
+    return ('%s:%s' % (get_key('rows', content_type_id, object_id), suffix),
+            '%s:%s' % (get_key('lock', content_type_id, object_id), suffix))
+
+
+def increment(cache, key, timeout=None):
+    cache.add(key, 0, timeout)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # evicted in between
+        return 0
+
+
+def count(stat):
+    increment(get_cache(), 'comments:tree-stats:%s' % stat)
+
+
+def get_stats():
+    """
+    Returns the numbers of the trees found in the cache (hits), found expired (stale), built by the readers (misses)
+    and built by the task (warmed)
+    """
+    values = get_cache().get_many(['comments:tree-stats:%s' % stat for stat in STATS])
+    return dict((stat, values.get('comments:tree-stats:%s' % stat, 0)) for stat in STATS)
+
+
+def reset_stats():
+    get_cache().delete_many(['comments:tree-stats:%s' % stat for stat in STATS])
+
+
+def store_tree(cache, key, tree):
+    # the tree is kept twice as long as it is fresh, so there is an old one to serve while it is rebuilt
+    cache.set(key, (time.time() + get_timeout(), tree), get_timeout() * 2)
+
+
+def build_tree(cache, key, lock_key, content_type_id, object_id):
+    try:
+        tree = fetch_tree(content_type_id, object_id)
+        store_tree(cache, key, tree)
+        return tree
+    finally:
+        cache.delete(lock_key)
+
+
+def get_tree(content_type_id, object_id, version=None):
+    """
+    Returns the tree of the comments on the entity from the cache, a missing or expired tree is read from the database.
+    The version is the one of the thread read before.
+    """
+    cache = get_cache()
+    key, lock_key = get_tree_keys(cache, content_type_id, object_id, version)
+    increment(cache, get_key('reads', content_type_id, object_id), get_timeout())
+
+    entry = cache.get(key)
+    if entry is not None:
+        fresh_until, tree = entry
+        # the first reader of an expired tree rebuilds it, the others get the old one meanwhile
+        if fresh_until > time.time() or not cache.add(lock_key, True, get_timeout()):
+            count('hits')
+            return tree
+        count('stale')
+        return build_tree(cache, key, lock_key, content_type_id, object_id)
+
+    count('misses')
+    if not cache.add(lock_key, True, get_timeout()):
+        for i in range(BUILD_WAITS):
+            time.sleep(BUILD_WAIT)
+            entry = cache.get(key)
+            if entry is not None:
+                return entry[1]
+        # the builder is too slow or has failed
+        return fetch_tree(content_type_id, object_id)
+    return build_tree(cache, key, lock_key, content_type_id, object_id)
+
+
+def warm_tree(content_type_id, object_id):
+    """
+    Builds the tree of the current generation and version, when no request has built it yet
+    """
+    cache = get_cache()
+    version = counters.get_thread_version(int(content_type_id), object_id)[0]
+    key, lock_key = get_tree_keys(cache, content_type_id, object_id, version)
+    if cache.add(lock_key, True, get_timeout()):
+        count('warmed')
+        build_tree(cache, key, lock_key, content_type_id, object_id)
+
+
+def get_trees(paths, entities, using=None):
+    """
+    Returns the trees a change of the comments with the paths is seen in: the replies of every comment of a path,
+    the comments on the entity of the root of a path, and the comments on the given entities
+    """
+    comment_type = ContentType.objects.get_for_model(models.Comment).pk
+    trees = set((comment_type, pk) for path in paths for pk in path)
+    roots = set(path[0] for path in paths if path)
+    trees.update(models.Comment.objects.using(using).filter(id__in=roots).values_list('content_type_id', 'object_pk'))
+    trees.update((content_type_id, force_text(object_id)) for content_type_id, object_id in entities)
+    return trees
+
+
+def invalidate(paths, entities=(), using=None):
+    """
+    Invalidates the trees of the changed comments when the transaction is committed, and has the hot ones rebuilt.
+    The entities are the ones the comments were on before they were moved.
+    """
+    def invalidate_trees():
+        from comments import tasks
+
+        cache = get_cache()
+        trees = get_trees(paths, entities, using)
+        reads = cache.get_many([get_key('reads', *tree) for tree in trees])
+        for content_type_id, object_id in trees:
+            try:
+                cache.incr(get_key('generation', content_type_id, object_id))
+            except ValueError:
+                # the tree has never been read
+                continue
+            if reads.get(get_key('reads', content_type_id, object_id), 0) >= get_hot_reads():
+                tasks.warm_tree.delay(content_type_id, object_id)
+
+    transaction.on_commit(invalidate_trees, using)
@@ -15,5 +15,6 @@ urlpatterns = [
         name='child-comments'),
     url(r'^subscribe/(?P<content_type_id>\d+)/(?P<object_id>\d+)/$', views.ChildCommentView.as_view(),
         name='subscribe'),
+    url(r'^metrics/$', views.metrics_view, name='metrics'),
     url(r'^result/(?P<id>[0-9a-fA-F-]+)/$', views.ExportResultView.as_view(), name='result'),
 ]
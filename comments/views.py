@@ -1,51 +1,72 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from collections import OrderedDict
+
 from celery.result import AsyncResult
-from django.db import connection
+from django.db import router, transaction
 from django.contrib.contenttypes.models import ContentType
+from django.http import Http404, HttpResponse, HttpResponseForbidden, StreamingHttpResponse
 from django.shortcuts import reverse
+from django.utils.http import urlencode
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from rest_framework import viewsets, generics, exceptions, views, mixins
 from rest_framework.decorators import action
 from rest_framework.response import Response
 
-from comments import tasks
-from filters import CommentFilter
+from comments import archive, bulk, counters, metrics, progress, search, tasks, trees
+from exporters import SERIALIZERS
+from filters import ArchivedCommentFilter, CommentFilter, HistoryFilter
+from pagination import KeysetPagination, decode_key, encode_key, merge_pages
 import models
 import serializers
 
 
-SUPPORTED_FORMATS = ('xml',)
+SUPPORTED_FORMATS = tuple(SERIALIZERS)
+# the query param adding the archived comments to the lists, see archive.py
+INCLUDE_ARCHIVED = 'include_archived'
+# the order of the replies of a node in a nested tree, its cursors are the keys of the comments in it
+NESTED_ORDERING = ('submit_date', 'id')
+
 
+def get_thread_version(request, content_type_id=None, object_id=None):
+    """
+    Returns the version of the thread listed and the date it was modified, or None for a list of another kind.
+    The list of the comments on an entity takes the entity from the query params.
+    """
+    # the ETag and Last-Modified functions share a single query
+    if not hasattr(request, 'thread_version'):
+        content_type_id = content_type_id or request.query_params.get('content_type', '')
+        object_id = object_id or request.query_params.get('object_pk', '')
+        request.thread_version = None
+        if content_type_id.isdigit() and object_id:
+            comment_type = ContentType.objects.get_for_model(models.Comment)
+            if int(content_type_id) != comment_type.pk or object_id.isdigit():
+                request.thread_version = counters.get_thread_version(int(content_type_id), object_id)
+    return request.thread_version
 
-SQL_GET_CHILDREN = r"""
-WITH RECURSIVE r AS (
-  SELECT c1.*, u1.first_name || u1.last_name AS user_name
-  FROM comments_comment c1
-  JOIN auth_user u1 ON u1.id = c1.user_id
-  WHERE c1.object_pk = %s AND c1.content_type_id = %s AND c1.is_removed = false
 
-  UNION
+def thread_etag(request, *args, **kwargs):
+    # the version is read before the list, so a change made in between only costs the client a needless reload
+    version = get_thread_version(request, kwargs.get('content_type_id'), kwargs.get('object_id'))
+    if version is not None:
+        suffix = '-archived' if request.query_params.get(INCLUDE_ARCHIVED) else ''
+        return '"%s-%s%s"' % (version[0], request.accepted_renderer.format, suffix)
 
-  SELECT c2.*, u2.first_name || u2.last_name AS user_name
-  FROM comments_comment c2
-  JOIN auth_user u2 ON u2.id = c2.user_id
-  JOIN r ON c2.content_type_id = %s AND c2.object_pk::bigint = r.id AND c2.is_removed = false
-)
 
-SELECT * FROM r ORDER BY submit_date;
-"""
+def thread_last_modified(request, *args, **kwargs):
+    version = get_thread_version(request, kwargs.get('content_type_id'), kwargs.get('object_id'))
+    return version and version[1]
 
 
-def dictfetchall(cursor):
-    "Returns all rows from a cursor as a dict"
-    desc = [col[0] for col in cursor.description]
-    return [dict(zip(desc, row)) for row in cursor.fetchall()]
+# A poll of an unchanged thread is answered by 304 after a single query on the counters
+thread_condition = condition(thread_etag, thread_last_modified)
 
 
 def gen_export_response(task):
     return Response(status=202, headers={
-        'Location': reverse('export:result', kwargs={'id': task.id})})
+        'Location': reverse('comments:result', kwargs={'id': task.id})})
 
 
 class CommentViewSet(viewsets.ModelViewSet):
@@ -57,11 +78,60 @@ class CommentViewSet(viewsets.ModelViewSet):
     Returns a list of comments.
 
     You can filter the list using query params.
-    To get all comments of a user, set the 'user' query param without 'content_type' and 'object_pk'
+    To get all comments of a user, set the 'user' query param without 'content_type' and 'object_pk'.
+    To scroll the list by keys instead of offsets, set the empty 'cursor' query param and follow the 'next' links.
+    The list of the comments on an entity has an ETag and Last-Modified, send them back to get 304 if nothing changed.
+    To find the comments by their text, use search/ with the 'q' query param and the same filters.
+    Set the 'include_archived' query param to list and get the archived comments as well.
     """
     queryset = models.Comment.objects.filter(is_removed=False).select_related('user')
     serializer_class = serializers.CommentSerializer
     filter_class = CommentFilter
+    pagination_class = KeysetPagination
+    keyset_ordering = ('submit_date', 'id')
+
+    def get_queryset(self):
+        # the counters come with the comments, so neither the serializer nor `is_deletable` query them
+        return counters.annotate_comments(super(CommentViewSet, self).get_queryset())
+
+    def include_archived(self):
+        return bool(self.request.query_params.get(INCLUDE_ARCHIVED))
+
+    def get_archived_rows(self, rows):
+        queryset = models.ArchivedComment.objects.filter(is_removed=False).select_related('user')
+        # the filter backend takes the querysets of the view's model only
+        queryset = ArchivedCommentFilter(self.request.query_params, archive.annotate_comments(queryset),
+                                         request=self.request).qs
+        return rows.get_rows(queryset)
+
+    @method_decorator(thread_condition)
+    def list(self, request, *args, **kwargs):
+        # the output is the one of the serializer, see `serializers.CommentRowSerializer`
+        rows = serializers.get_row_serializer()
+        queryset = rows.get_rows(self.filter_queryset(self.get_queryset()))
+        if self.include_archived():
+            querysets = [queryset, self.get_archived_rows(rows)]
+            page = self.paginator.paginate_querysets(querysets, request, self)
+            queryset = merge_pages([part.order_by(*self.keyset_ordering) for part in querysets],
+                                   self.keyset_ordering) if page is None else None
+        else:
+            page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(rows.serialize(page))
+        return Response(rows.serialize(queryset))
+
+    def retrieve(self, request, *args, **kwargs):
+        rows = serializers.get_row_serializer()
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        lookup = {self.lookup_field: kwargs[lookup_url_kwarg]}
+        try:
+            row = generics.get_object_or_404(rows.get_rows(self.filter_queryset(self.get_queryset())), **lookup)
+        except Http404:
+            if not self.include_archived():
+                raise
+            row = generics.get_object_or_404(self.get_archived_rows(rows), **lookup)
+        self.check_object_permissions(request, row)
+        return Response(rows.to_representation(row))
 
     def perform_destroy(self, instance):
         if instance.is_deletable():
@@ -71,29 +141,116 @@ class CommentViewSet(viewsets.ModelViewSet):
         else:
             raise exceptions.PermissionDenied()
 
-    @action(['POST'], False, 'export/?P<format>(%s)' % '|'.join(SUPPORTED_FORMATS))
-    def export_to_xml(self, request, *args, **kwargs):
-        task = tasks.export('xml', request.data)
-        return gen_export_response(task)
+    @action(['POST'], False)
+    def bulk(self, request, *args, **kwargs):
+        """
+        Creates, edits and removes many comments at once, the body holds the lists of the items:
+        {"create": [{"content_type": 1, "object_pk": "1", "comment": "Hi"}], "update": [{"id": 1, "comment": "Hey"}],
+        "remove": [1]}.
+        Returns the lists of the results in the order of the items, every result has its own status code.
+        """
+        serializer = serializers.BulkSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        with transaction.atomic():
+            return Response(OrderedDict([
+                ('create', bulk.create_comments(data.get('create', []), request.user)),
+                ('update', bulk.update_comments(data.get('update', []), request.user)),
+                ('remove', bulk.remove_comments(data.get('remove', []), request.user)),
+            ]))
+
+    @action(['GET'], False)
+    def search(self, request, *args, **kwargs):
+        """
+        Returns the comments matching the 'q' query param, the best ones first, with their 'rank'.
+        The query takes words, "phrases", 'or' and '-excluded' words. The filters and the pagination are the ones of
+        the list, the keyset cursor scrolls by the rank.
+        """
+        serializer = serializers.SearchSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        rows = serializers.get_row_serializer()
+        queryset = search.search_comments(self.filter_queryset(self.get_queryset()), serializer.validated_data['q'])
+        queryset = rows.get_rows(queryset, 'rank').order_by(*search.SEARCH_ORDERING)
+        self.keyset_ordering = search.SEARCH_ORDERING
+        page = self.paginate_queryset(queryset)
+        found = page if page is not None else list(queryset)
+        data = rows.serialize(found)
+        for item, row in zip(data, found):
+            item['rank'] = row['rank']
+        return self.get_paginated_response(data) if page is not None else Response(data)
+
+    @action(['POST'], False, r'export/(?P<export_format>%s)' % '|'.join(SUPPORTED_FORMATS))
+    def export(self, request, export_format, *args, **kwargs):
+        """
+        Exports the comments selected by the filter params in the background.
+        Set 'compress' to gzip the file, and 'shards' to split the dates between several parallel tasks.
+        """
+        serializer = serializers.ExportSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = request.data.dict() if hasattr(request.data, 'dict') else request.data
+        compress, shards = serializer.validated_data['compress'], serializer.validated_data['shards']
+        return gen_export_response(tasks.start_export(export_format, data, compress, shards))
 
 
 class HistoryViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
     queryset = models.History.objects.all()
     serializer_class = serializers.HistorySerializer
-    filter_fields = ['user']
+    filter_class = HistoryFilter
+    pagination_class = KeysetPagination
+    keyset_ordering = ('event_date', 'id')
 
 
 class ChildCommentView(generics.GenericAPIView):
 
+    @method_decorator(thread_condition)
     def get(self, request, *args, **kwargs):
         """
-        Returns a list of child comments for specified entity
+        Returns a list of child comments for specified entity. Send the ETag or Last-Modified back to get 304
+        if nothing changed. Set the 'stream' query param to get a huge thread in JSON parts while it's being read.
+        Set the 'nested' query param to get the tree limited by 'max_depth' and 'max_children_per_node', every
+        truncated node has the 'next' link to the rest of its replies.
+        Set the 'include_archived' query param to add the archived comments to the tree, which isn't nested or streamed.
         """
-        with connection.cursor() as cursor:
-            params = (kwargs['object_id'], kwargs['content_type_id'],
-                      ContentType.objects.get_for_model(models.Comment).id)
-            cursor.execute(SQL_GET_CHILDREN, params)
-            return Response(dictfetchall(cursor))
+        if request.query_params.get('nested'):
+            return self.get_nested(request, kwargs['content_type_id'], kwargs['object_id'])
+        if request.query_params.get('stream'):
+            tree = trees.stream_tree(kwargs['content_type_id'], kwargs['object_id'],
+                                     using=router.db_for_read(models.Comment))
+            return StreamingHttpResponse(tree, content_type='application/json')
+        # the trees are cached by the version of the ETag, see trees.py
+        version = get_thread_version(request, kwargs['content_type_id'], kwargs['object_id'])
+        tree = trees.get_tree(kwargs['content_type_id'], kwargs['object_id'], version and version[0])
+        if request.query_params.get(INCLUDE_ARCHIVED):
+            tree = sorted(tree + archive.fetch_tree(kwargs['content_type_id'], kwargs['object_id']),
+                          key=lambda node: node['submit_date'])
+        return Response(tree)
+
+    def get_nested(self, request, content_type_id, object_id):
+        """
+        Returns the first levels of the tree, every node has its replies and the link to the rest of them
+        """
+        serializer = serializers.NestedTreeSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+        after = None
+        if 'cursor' in params:
+            try:
+                after = decode_key(params['cursor'], models.Comment, NESTED_ORDERING)
+            except Exception:
+                raise exceptions.NotFound(KeysetPagination.invalid_cursor_message)
+
+        def link(content_type_id, object_id, key):
+            query = OrderedDict([('nested', 1), ('max_depth', params['max_depth']),
+                                 ('max_children_per_node', params['max_children_per_node'])])
+            if key is not None:
+                query['cursor'] = encode_key(key)
+            path = reverse('comments:child-comments',
+                           kwargs={'content_type_id': content_type_id, 'object_id': object_id})
+            return request.build_absolute_uri('%s?%s' % (path, urlencode(query)))
+
+        results, next_link = trees.get_nested_tree(content_type_id, object_id, params['max_depth'],
+                                                   params['max_children_per_node'], link, after)
+        return Response(OrderedDict([('next', next_link), ('results', results)]))
 
 
 class SubscriptionViewSet(viewsets.ModelViewSet):
@@ -104,15 +261,48 @@ class SubscriptionViewSet(viewsets.ModelViewSet):
 
 
 class ExportResultView(views.APIView):
+    """
+    Returns the state of an export and the rows exported, 204 with the link to the file when it's done.
+    Set 'wait' to wait up to this number of seconds for a change of the export instead of polling.
+    """
 
     def get(self, request, *args, **kwargs):
-        res = AsyncResult(kwargs['id'])
-        if res.state == 'SUCCESS':
-            # res.result is a file id
-            obj = models.File.objects.get(id=res.result)
-            # a client gets a link to the file to download
-            return Response(status=204, headers={'Location': obj.file.url})
-        if res.state == 'FAILURE':
-            # raise an error. A user gets 500, but we can see the traceback in the admin
-            res.get()
-        return Response(status=202)
+        serializer = serializers.ExportResultSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        state = progress.wait(kwargs['id'], min(serializer.validated_data['wait'], progress.get_max_wait()))
+        if state is None:
+            # an export started before the progress was reported
+            res = AsyncResult(kwargs['id'])
+            if res.state == 'SUCCESS':
+                # res.result is a file id
+                try:
+                    obj = models.File.objects.get(id=res.result)
+                except models.File.DoesNotExist:
+                    # the file has expired
+                    return Response(status=410)
+                # a client gets a link to the file to download
+                return Response(status=204, headers={'Location': obj.file.url})
+            if res.state == 'FAILURE':
+                # raise an error. A user gets 500, but we can see the traceback in the admin
+                res.get()
+            return Response(status=202)
+        if state.state == 'SUCCESS':
+            if state.file is None:
+                # the file has expired
+                return Response(status=410)
+            return Response(status=204, headers={'Location': state.file.file.url})
+        if state.state == 'FAILURE':
+            # the error is reported by the failed task or part, the traceback is in the result backend
+            raise exceptions.APIException(state.error)
+        return Response({'state': state.state, 'rows': state.rows, 'updated': state.updated}, status=202)
+
+
+def metrics_view(request):
+    """
+    The metrics in the Prometheus text format for the staff and the scrapers from the allowed addresses
+    """
+    if not request.user.is_staff and request.META.get('REMOTE_ADDR') not in metrics.get_allowed_ips():
+        return HttpResponseForbidden()
+    # the measures of this process are shown at once
+    metrics.flush()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
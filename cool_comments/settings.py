@@ -46,6 +46,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'comments.middleware.ProfilingMiddleware',
+    'comments.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -53,6 +55,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'comments.middleware.NotificationMiddleware',
+    'comments.middleware.ReplicaMiddleware',
 ]
 
 ROOT_URLCONF = 'cool_comments.urls'
@@ -157,12 +161,105 @@ CELERY_QUEUES = {
 CELERY_ROUTES = {
     # -- HIGH PRIORITY QUEUE -- #
     'comments.tasks.notify': {'queue': 'high'},
+    'comments.tasks.flush_notifications': {'queue': 'high'},
+    'comments.tasks.warm_tree': {'queue': 'high'},
     # -- LOW PRIORITY QUEUE -- #
     'comments.tasks.export': {'queue': 'default'},
+    'comments.tasks.export_part': {'queue': 'default'},
+    'comments.tasks.merge_export': {'queue': 'default'},
+    'comments.tasks.maintain_history_partitions': {'queue': 'default'},
+    'comments.tasks.compact_history': {'queue': 'default'},
+    'comments.tasks.delete_old_profiles': {'queue': 'default'},
+    'comments.tasks.expire_files': {'queue': 'default'},
+    'comments.tasks.archive_comments': {'queue': 'default'},
+}
+CELERY_BEAT_SCHEDULE = {
+    'maintain-history-partitions': {
+        'task': 'comments.tasks.maintain_history_partitions',
+        'schedule': 24 * 60 * 60,
+    },
+    'compact-history': {
+        'task': 'comments.tasks.compact_history',
+        'schedule': 24 * 60 * 60,
+    },
+    'delete-old-profiles': {
+        'task': 'comments.tasks.delete_old_profiles',
+        'schedule': 24 * 60 * 60,
+    },
+    'expire-export-files': {
+        'task': 'comments.tasks.expire_files',
+        'schedule': 60 * 60,
+    },
+    'archive-comments': {
+        'task': 'comments.tasks.archive_comments',
+        'schedule': 24 * 60 * 60,
+    },
 }
 CELERY_RESULT_BACKEND = 'django-db'
 CELERY_BROKER_URL = 'amqp://127.0.0.1'
 
+# The history trigger: 'row' runs for every updated row, 'statement' once per update (needs PostgreSQL 10+)
+COMMENTS_HISTORY_TRIGGER = 'statement'
+# Seconds to collect the events of a commented entity into a single push notification, 0 sends an event at once.
+# The windows are kept in the default cache, which must be shared by the processes (not locmem) to turn it on.
+COMMENTS_NOTIFY_COALESCE_WINDOW = 0
+# The history is partitioned by months: the partitions created in advance, the months kept (None keeps all of them)
+# and whether the expired partitions are dropped or only detached
+COMMENTS_HISTORY_PARTITIONS_AHEAD = 3
+COMMENTS_HISTORY_RETENTION_MONTHS = None
+COMMENTS_HISTORY_RETENTION_DROP = False
+# The compacted history keeps the full texts every this number of changes of a comment, the rest are diffs
+COMMENTS_HISTORY_SNAPSHOT_INTERVAL = 20
+# The rows the reply counters of a commented entity are spread over, the triggers need `migrate` to apply a change
+COMMENTS_COUNTER_SHARDS = 8
+# The child comment trees are cached for the timeout (seconds), the ones read this many times during it are rebuilt
+# in the background when they change. The cache alias can point to any backend, the trees are kept by the version of
+# their threads. A locmem cache isn't invalidated or warmed by the other processes, so its trees are rebuilt more
+# often, and `manage.py tree_cache` sees no stats in it.
+COMMENTS_TREE_CACHE = 'default'
+COMMENTS_TREE_CACHE_TIMEOUT = 60
+COMMENTS_TREE_CACHE_HOT_READS = 100
+# The rows fetched at once by a streamed child comment tree
+COMMENTS_TREE_STREAM_BATCH = 500
+# The default limits of a nested child comment tree, the limits of a request can't make a tree of more than the max
+# nodes: (max_children_per_node + 1) ** max_depth
+COMMENTS_TREE_MAX_DEPTH = 3
+COMMENTS_TREE_MAX_CHILDREN_PER_NODE = 10
+COMMENTS_TREE_MAX_NODES = 2000
+# The metrics of the requests and the tasks are added to the cache once per interval (seconds) by every process.
+# They're shown by `comments/metrics/` to the staff and the addresses allowed, and by `manage.py metrics`. With a
+# locmem cache the view shows the measures of its own process only and the command refuses to run, a shared cache
+# (memcached, redis) shows all the servers and the workers.
+# The buckets are the upper bounds (seconds) of the latency histograms.
+COMMENTS_METRICS_CACHE = 'default'
+COMMENTS_METRICS_FLUSH_INTERVAL = 10
+COMMENTS_METRICS_ALLOWED_IPS = ('127.0.0.1', '::1')
+COMMENTS_METRICS_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1, 2.5, 5, 7.5, 10)
+# An export reports its progress every this number of rows, a client waits for a change of an export up to the max
+# wait (seconds) holding a database connection
+COMMENTS_EXPORT_PROGRESS_ROWS = 10000
+COMMENTS_EXPORT_MAX_WAIT = 30
+# An export of the same comments, unchanged since, is reused when it was updated within the timeout (seconds, 0 turns
+# the reuse off). The files are deleted from the storage after the max age (seconds), the progress of the exports
+# after its own max age, which is longer, so an expired export is told from an unknown one.
+COMMENTS_EXPORT_REUSE_TIMEOUT = 60 * 60
+COMMENTS_EXPORT_FILE_MAX_AGE = 24 * 60 * 60
+COMMENTS_EXPORT_PROGRESS_MAX_AGE = 7 * 24 * 60 * 60
+# A request is profiled when its X-Comments-Profile header is the token (None turns the header off), or by chance
+# with the sample rate (0..1). The slowest statements of a profile are explained with the timeout (ms), the Python
+# profile keeps this many lines. The profiles older than the retention (days) are deleted daily.
+COMMENTS_PROFILE_TOKEN = None
+COMMENTS_PROFILE_SAMPLE_RATE = 0
+COMMENTS_PROFILE_EXPLAIN_SLOWEST = 3
+COMMENTS_PROFILE_EXPLAIN_TIMEOUT = 5000
+COMMENTS_PROFILE_STATS_LINES = 50
+COMMENTS_PROFILE_RETENTION_DAYS = 7
+# The removed comments unchanged for this number of days and the threads of the entities unchanged for this number
+# of days are moved into the archive daily by batches (None turns a kind off), see comments/archive.py
+COMMENTS_ARCHIVE_REMOVED_AFTER = 30
+COMMENTS_ARCHIVE_DORMANT_AFTER = 365
+COMMENTS_ARCHIVE_BATCH_SIZE = 1000
+
 PUSH_NOTIFICATIONS_SETTINGS = {
     "FCM_API_KEY": "[your api key]",
     "GCM_API_KEY": "[your api key]",
@@ -173,3 +270,14 @@ PUSH_NOTIFICATIONS_SETTINGS = {
     "WP_PRIVATE_KEY": "/path/to/your/private.pem",
     "WP_CLAIMS": {'sub': "mailto: development@example.com"}
 }
+# The aliases of the read replicas of 'default' in DATABASES, e.g.
+# 'replica': dict(DATABASES['default'], HOST='replica.local', TEST={'MIRROR': 'default'}).
+# A replica lagging behind by more than the max lag (seconds) isn't read, its lag is checked once per interval.
+# A user reads their own writes from the default database or a replica having replayed them, for the timeout
+# (seconds) after the write. The writes are kept in the default cache, which has to be shared by the servers.
+COMMENTS_READ_REPLICAS = []
+COMMENTS_REPLICA_MODELS = ('comments.comment', 'comments.history', 'comments.counter')
+COMMENTS_REPLICA_MAX_LAG = 5
+COMMENTS_REPLICA_CHECK_INTERVAL = 1
+COMMENTS_READ_YOUR_WRITES_TIMEOUT = 60
+DATABASE_ROUTERS = ['comments.routers.ReplicaRouter']